@@ -0,0 +1,226 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+"""
+capture backends that hand raw frames (bytes + timestamp) to the sniffers
+
+scapy's sniff() builds a Packet for every frame, but all we ever use is
+packet.load and packet.time. The TPACKET_V3 backend reads frames straight
+from an mmap'ed AF_PACKET ring instead (Linux only).
+"""
+
+import mmap
+import select
+import socket
+import struct
+
+from twitter.common import log
+
+
+SCAPY = "scapy"
+TPACKET = "tpacket"
+CAPTURE_BACKENDS = (SCAPY, TPACKET)
+
+HAS_TPACKET = hasattr(socket, "AF_PACKET") and hasattr(select, "poll")
+
+
+# from linux/if_packet.h & linux/if_ether.h
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+PACKET_FANOUT = 18
+PACKET_FANOUT_HASH = 0
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+TPACKET_REQ3_STRUCT = struct.Struct("=IIIIIII")
+BLOCK_DESC_STRUCT = struct.Struct("=IIIII")     # version, offset_to_priv, status, num_pkts, offset
+BLOCK_STATUS_STRUCT = struct.Struct("=I")
+BLOCK_STATUS_OFFSET = 8
+TPACKET3_HDR_STRUCT = struct.Struct("=IIIIIIHH")  # next, sec, nsec, snaplen, len, status, mac, net
+
+
+class RawPacket(object):
+  """ a captured frame, quacks like the bits of scapy's Packet that we use """
+  __slots__ = ("load", "time")
+
+  def __init__(self, load, time):
+    self.load = load
+    self.time = time
+
+
+class CaptureError(Exception): pass
+
+
+class TPacketV3Capture(object):
+  """
+  Reads frames from a TPACKET_V3 ring. The kernel fills whole blocks of frames
+  and hands them over to us, so there's one poll() per block instead of a
+  recvfrom() + Packet per frame.
+  """
+
+  def __init__(self,
+               iface,
+               pfilter=None,
+               block_size=1 << 20,
+               block_count=64,
+               frame_size=1 << 11,
+               block_timeout_ms=64,
+               fanout_group=None):
+    if not HAS_TPACKET:
+      raise CaptureError("TPACKET_V3 capture is not available on this platform")
+
+    self._iface = iface
+    self._pfilter = pfilter
+    self._block_size = block_size
+    self._block_count = block_count
+    self._frame_size = frame_size
+    self._block_timeout_ms = block_timeout_ms
+    self._fanout_group = fanout_group
+    self._sock = None
+    self._ring = None
+
+  @property
+  def fileno(self):
+    return self._sock.fileno()
+
+  def open(self):
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    try:
+      if self._pfilter:
+        self._attach_filter(sock, self._pfilter)
+
+      sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+      req = TPACKET_REQ3_STRUCT.pack(
+        self._block_size,
+        self._block_count,
+        self._frame_size,
+        (self._block_size // self._frame_size) * self._block_count,
+        self._block_timeout_ms,
+        0,  # sizeof_priv
+        0,  # feature_req_word
+      )
+      sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+
+      if self._iface and self._iface != "any":
+        sock.bind((self._iface, ETH_P_ALL))
+
+      if self._fanout_group is not None:
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT, self._fanout_group | (PACKET_FANOUT_HASH << 16))
+
+      self._ring = mmap.mmap(
+        sock.fileno(),
+        self._block_size * self._block_count,
+        mmap.MAP_SHARED,
+        mmap.PROT_READ | mmap.PROT_WRITE)
+    except (socket.error, EnvironmentError):
+      sock.close()
+      raise
+
+    self._sock = sock
+
+  def close(self):
+    if self._ring is not None:
+      self._ring.close()
+      self._ring = None
+    if self._sock is not None:
+      self._sock.close()
+      self._sock = None
+
+  def set_filter(self, pfilter):
+    """ (re)compile & attach a pcap filter, can be called while capturing """
+    self._pfilter = pfilter
+    if self._sock is not None:
+      self._attach_filter(self._sock, pfilter)
+
+  def _attach_filter(self, sock, pfilter):
+    # scapy knows how to compile pcap expressions into a sock_fprog
+    from scapy.arch.linux import attach_filter
+    iface = self._iface if self._iface and self._iface != "any" else None
+    attach_filter(sock, pfilter, iface)
+
+  def run(self, prn, stop_filter=None):
+    """
+    calls prn(packet) for every captured frame, until stop_filter(packet) returns True.
+    stop_filter is also called (with None) when the ring is idle.
+    """
+    if self._sock is None:
+      self.open()
+
+    poller = select.poll()
+    poller.register(self._sock.fileno(), select.POLLIN | select.POLLERR)
+    block = 0
+
+    try:
+      while True:
+        offset = block * self._block_size
+        if not self._block_ready(offset):
+          if stop_filter is not None and stop_filter(None):
+            return
+          poller.poll(self._block_timeout_ms)
+          continue
+
+        if self._consume_block(offset, prn, stop_filter):
+          return
+
+        block = (block + 1) % self._block_count
+    finally:
+      self.close()
+
+  def _block_ready(self, offset):
+    status, = BLOCK_STATUS_STRUCT.unpack_from(self._ring, offset + BLOCK_STATUS_OFFSET)
+    return status & TP_STATUS_USER
+
+  def _consume_block(self, offset, prn, stop_filter):
+    ring = self._ring
+    _, _, _, num_pkts, pkt_offset = BLOCK_DESC_STRUCT.unpack_from(ring, offset)
+    pkt_offset += offset
+    stop = False
+
+    try:
+      for _ in range(num_pkts):
+        next_offset, sec, nsec, snaplen, _, _, mac, _ = TPACKET3_HDR_STRUCT.unpack_from(
+          ring, pkt_offset)
+        start = pkt_offset + mac
+
+        # the block goes back to the kernel once we are done, so copy the frame out
+        packet = RawPacket(ring[start:start + snaplen], sec + nsec * 1e-9)
+        prn(packet)
+
+        if stop_filter is not None and stop_filter(packet):
+          stop = True
+          break
+
+        pkt_offset += next_offset
+    finally:
+      BLOCK_STATUS_STRUCT.pack_into(ring, offset + BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+
+    return stop
+
+
+def validate_capture_backend(backend):
+  """ returns the backend to use, falling back to scapy when TPACKET_V3 isn't available """
+  if backend not in CAPTURE_BACKENDS:
+    raise ValueError("Unknown capture backend: %s" % backend)
+
+  if backend == TPACKET and not HAS_TPACKET:  # pragma: no cover
+    log.warn("TPACKET_V3 is not available, falling back to scapy")
+    return SCAPY
+
+  return backend
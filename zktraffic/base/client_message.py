@@ -29,6 +29,7 @@ from .util import (
   read_long,
   read_number,
   read_string,
+  skip_string,
   StringTooLong,
 )
 from .zookeeper import (
@@ -86,6 +87,9 @@ class ClientMessage(ClientMessageType('ClientMessageType', (object,), {})):
 
   MAX_REQUEST_SIZE = 100 * 1024 * 1024
 
+  # fields that are only decoded when first accessed, if the message was parsed lazily
+  LAZY_FIELDS = ()
+
   @classmethod
   def with_params(cls, xid, path, watch, data, offset, size, client, server):
     """
@@ -108,7 +112,37 @@ class ClientMessage(ClientMessageType('ClientMessageType', (object,), {})):
     return cls(size, xid, path, client, watch, server)
 
   @classmethod
-  def from_payload(cls, data, client, server):
+  def with_header(cls, xid, path, watch, data, offset, size, client, server):
+    """
+    Like with_params, but only the header fields are decoded. The LAZY_FIELDS will be
+    decoded (via with_params) the first time one of them is accessed.
+
+    Subclasses can override this to decode some more fields eagerly (i.e.: the ones needed
+    by name).
+    """
+    message = cls.__new__(cls)
+    ClientMessage.__init__(message, size, xid, path, client, watch, server)
+    message._lazy_params = (xid, path, watch, data, offset, size, client, server)
+    return message
+
+  def __getattr__(self, name):
+    # only called for missing attributes, so this is a lazy field that hasn't been decoded yet
+    params = self.__dict__.pop("_lazy_params", None) if name in self.LAZY_FIELDS else None
+    if params is None:
+      raise AttributeError(name)
+
+    message = self.with_params(*params)
+    for field in self.LAZY_FIELDS:
+      setattr(self, field, getattr(message, field))
+
+    return getattr(self, name)
+
+  @classmethod
+  def from_payload(cls, data, client, server, lazy=False):
+    """
+    :param lazy: if True, fields that aren't part of the header are only decoded
+                 when first accessed (see LAZY_FIELDS).
+    """
     length, offset = read_number(data, 0)
 
     # Note: the C library doesn't include the length at the start
@@ -136,6 +170,8 @@ class ClientMessage(ClientMessageType('ClientMessageType', (object,), {})):
     length, offset = read_number(data, offset) if length == 0 else (length, offset)
     watch, offset = read_bool(data, offset) if can_set_watch(opcode) else (False, offset)
     handler = ClientMessageType.get(opcode, cls)
+    if lazy and handler.LAZY_FIELDS:
+      return handler.with_header(xid, path, watch, data, offset, length, client, server)
     return handler.with_params(xid, path, watch, data, offset, length, client, server)
 
   @property
@@ -285,6 +321,7 @@ class Acl(namedtuple("Acl", "perm scheme cred")): pass
 
 class CreateRequest(Request):
   OPCODE = OpCodes.CREATE
+  LAZY_FIELDS = ("acls",)
   MAX_ACLS = 10
   MAX_PKT_SIZE = 8192
 
@@ -296,6 +333,20 @@ class CreateRequest(Request):
 
   @classmethod
   def with_params(cls, xid, path, watch, data, offset, size, client, server):
+    acls, ephemeral, sequence = cls.read_acls_and_flags(data, offset)
+    return cls(size, xid, path, client, watch, ephemeral, sequence, acls, server)
+
+  @classmethod
+  def with_header(cls, xid, path, watch, data, offset, size, client, server):
+    message = super(CreateRequest, cls).with_header(
+      xid, path, watch, data, offset, size, client, server)
+    # the flags come after the ACLs, so skip those
+    _, message.ephemeral, message.sequence = cls.read_acls_and_flags(data, offset, False)
+    return message
+
+  @classmethod
+  def read_acls_and_flags(cls, data, offset, decode_acls=True):
+    """ returns (acls, ephemeral, sequence), acls are skipped if decode_acls is False """
     acls = []
     ephemeral = False
     sequence = False
@@ -311,20 +362,23 @@ class CreateRequest(Request):
           perms, offset = read_number(data, offset)
 
           try:
-            scheme, offset = read_string(data, offset)
-            cred, offset = read_string(data, offset)
+            if decode_acls:
+              scheme, offset = read_string(data, offset)
+              cred, offset = read_string(data, offset)
+              acls.append(Acl(perms, scheme, cred))
+            else:
+              offset = skip_string(data, offset)
+              offset = skip_string(data, offset)
           except StringTooLong:
             bad_acls = True
             break
 
-          acls.append(Acl(perms, scheme, cred))
-
         if not bad_acls:
           flags, offset = read_number(data, offset)
           ephemeral = flags & 0x1 == 1
           sequence = flags & 0x2 == 2
 
-    return cls(size, xid, path, client, watch, ephemeral, sequence, acls, server)
+    return (acls, ephemeral, sequence)
 
   @property
   def name(self):
@@ -341,6 +395,7 @@ class Create2Request(CreateRequest):
 
 class ReconfigRequest(Request):
   OPCODE = OpCodes.RECONFIG
+  LAZY_FIELDS = ("joining", "leaving", "new_members")
 
   def __init__(self, size, xid, client, server, joining, leaving, new_members):
     super(ReconfigRequest, self).__init__(size, xid, "", client, False, server)
@@ -368,6 +423,7 @@ class DeleteRequest(Request):
 
 class SetWatchesRequest(Request):
   OPCODE = OpCodes.SETWATCHES
+  LAZY_FIELDS = ("relzxid", "data", "exist", "child")
   MAX_WATCHES = 100
 
   class TooManyWatches(ParsingError): pass
@@ -393,6 +449,12 @@ class SetWatchesRequest(Request):
 
     return cls(size, xid, path, client, relzxid, dataw, existw, childw, server)
 
+  @classmethod
+  def with_header(cls, xid, path, watch, data, offset, size, client, server):
+    # SetWatches always sets watches
+    return super(SetWatchesRequest, cls).with_header(
+      xid, path, True, data, offset, size, client, server)
+
   @classmethod
   def read_strings(cls, data, offset):
     """
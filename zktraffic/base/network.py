@@ -18,11 +18,13 @@
 """ network packets & header processing stuff """
 
 import socket
+import struct
 
 import dpkt
 
 from abc import ABCMeta, abstractmethod
 import six
+from six.moves import intern
 from threading import Thread
 
 class Error(Exception): pass
@@ -43,6 +45,13 @@ def get_ip_packet(data, client_port=0, server_port=0, is_loopback=False):
   if type(tcp_p) != dpkt.tcp.TCP:
     raise BadPacket("Not a TCP packet")
 
+  check_ports(tcp_p, client_port, server_port)
+
+  return header.data
+
+
+def check_ports(tcp_p, client_port=0, server_port=0):
+  """ raises BadPacket unless the TCP packet is between client_port & server_port """
   if tcp_p.dport == server_port:
     if client_port != 0 and tcp_p.sport != client_port:
       raise BadPacket("Request from different client")
@@ -53,7 +62,25 @@ def get_ip_packet(data, client_port=0, server_port=0, is_loopback=False):
     if server_port > 0:
       raise BadPacket("Packet not for/from client/server")
 
-  return header.data
+
+_ETH_IPV4_HDR = struct.Struct("!12xHB8xB2x4s4s")  # ethertype, version & ihl, proto, src, dst
+_TCP_PORTS = struct.Struct("!HH")
+
+
+def peek_flow(data):
+  """
+  the flow (as in PacketContext.flow) of an Ethernet + IPv4 + TCP frame, read straight from
+  its bytes. None for anything else (i.e.: IPv6), or if it's too short.
+  """
+  if len(data) < 54:
+    return None
+
+  ethertype, version_ihl, proto, src, dst = _ETH_IPV4_HDR.unpack_from(data)
+  if ethertype != 0x0800 or proto != 6 or version_ihl >> 4 != 4:
+    return None
+
+  sport, dport = _TCP_PORTS.unpack_from(data, 14 + (version_ihl & 0xf) * 4)
+  return (src, sport, dst, dport)
 
 
 def get_ip(ip_packet, packed_addr):
@@ -61,6 +88,80 @@ def get_ip(ip_packet, packed_addr):
   return socket.inet_ntop(af_type, packed_addr)
 
 
+class PacketContext(object):
+  """
+  A TCP packet that's been decoded once, so it can be handed around (i.e.: from OmniSniffer
+  to the sniffer for its port) without decoding it again. Sniffers take it in place of a
+  captured packet (see decode_packet & packet_addrs).
+
+  flow is (src ip, src port, dst ip, dst port) with packed IPs, cheap to build & hash.
+  src & dst are (ip, port) tuples, src_addr & dst_addr the same as ip:port strings; these
+  are only built if asked for.
+  """
+  __slots__ = ("load", "time", "ip", "tcp", "flow", "_addrs")
+
+  def __init__(self, packet, is_loopback=False):
+    self.load = packet.load
+    self.time = packet.time
+    self.ip = ip_p = get_ip_packet(packet.load, is_loopback=is_loopback)
+    self.tcp = tcp_p = ip_p.data
+    self.flow = (ip_p.src, tcp_p.sport, ip_p.dst, tcp_p.dport)
+    self._addrs = None
+
+  @property
+  def data(self):
+    """ the TCP payload """
+    return self.tcp.data
+
+  @property
+  def src(self):
+    return (self._addrs or self._build_addrs())[0]
+
+  @property
+  def dst(self):
+    return (self._addrs or self._build_addrs())[1]
+
+  @property
+  def src_addr(self):
+    return (self._addrs or self._build_addrs())[2]
+
+  @property
+  def dst_addr(self):
+    return (self._addrs or self._build_addrs())[3]
+
+  def _build_addrs(self):
+    ip_p, tcp_p = self.ip, self.tcp
+    src = (get_ip(ip_p, ip_p.src), tcp_p.sport)
+    dst = (get_ip(ip_p, ip_p.dst), tcp_p.dport)
+    self._addrs = (src, dst, intern("%s:%s" % src), intern("%s:%s" % dst))
+    return self._addrs
+
+
+def decode_packet(packet, client_port=0, server_port=0, is_loopback=False, data=None):
+  """
+  like get_ip_packet, but PacketContexts aren't decoded again
+
+  data is what to decode for captured packets, if not packet.load (i.e.: a memoryview)
+  """
+  if type(packet) is PacketContext:
+    check_ports(packet.tcp, client_port, server_port)
+    return packet.ip
+
+  return get_ip_packet(packet.load if data is None else data, client_port, server_port, is_loopback)
+
+
+def packet_addrs(packet, ip_p):
+  """ returns the packet's src & dst, as interned ip:port strings """
+  if type(packet) is PacketContext:
+    return packet.src_addr, packet.dst_addr
+
+  tcp_p = ip_p.data
+  return (
+    intern("%s:%s" % (get_ip(ip_p, ip_p.src), tcp_p.sport)),
+    intern("%s:%s" % (get_ip(ip_p, ip_p.dst), tcp_p.dport))
+  )
+
+
 @six.add_metaclass(ABCMeta)
 class SnifferBase(Thread):
   def __init__(self):
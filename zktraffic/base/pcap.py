@@ -0,0 +1,231 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+"""
+a streaming reader for pcap & pcapng files, for offline mode
+
+Reading a capture via scapy's sniff(offline=...) builds a Packet per frame (and needs
+libpcap to apply the filter). All the sniffers need is the frame and its timestamp, so
+this reads them straight from the file (with large sequential reads) as RawPackets.
+
+Pcap filters aren't applied: the sniffers check ports (& protocols) themselves.
+"""
+
+import io
+import struct
+
+from .capture import RawPacket
+
+
+BUFFER_SIZE = 1 << 20
+
+# link types, from http://www.tcpdump.org/linktypes.html
+LINKTYPE_NULL = 0       # BSD loopback
+LINKTYPE_ETHERNET = 1
+LINKTYPE_LOOP = 108     # OpenBSD loopback
+LOOPBACK_LINKTYPES = (LINKTYPE_NULL, LINKTYPE_LOOP)
+LINKTYPES = (LINKTYPE_NULL, LINKTYPE_ETHERNET, LINKTYPE_LOOP)
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_IF_TSRESOL = 9
+PCAPNG_OPT_ENDOFOPT = 0
+
+
+class PcapError(Exception): pass
+
+
+class PcapReader(object):
+  """
+  Iterates over the frames in a pcap or pcapng file, as RawPackets. All the interfaces
+  in a pcapng file must have the same link type.
+  """
+
+  def __init__(self, path, buffer_size=BUFFER_SIZE):
+    self._fp = io.open(path, "rb", buffering=buffer_size)
+    self._linktype = None
+    try:
+      head = self._read(4)
+      if len(head) < 4:
+        raise PcapError("%s: not a pcap file (too short)" % path)
+
+      if struct.unpack("=I", head)[0] == PCAPNG_SHB:
+        self._frames = self._pcapng_frames(head)
+      else:
+        self._frames = self._pcap_frames(head)
+
+      # the (first) link type is known once the headers have been read
+      self._first = next(self._frames, None)
+    except Exception:
+      self._fp.close()
+      raise
+
+  @property
+  def linktype(self):
+    return self._linktype
+
+  @property
+  def is_loopback(self):
+    return self._linktype in LOOPBACK_LINKTYPES
+
+  def close(self):
+    self._fp.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __iter__(self):
+    if self._first is None:
+      return
+    yield self._first
+    self._first = None
+    for packet in self._frames:
+      yield packet
+
+  def run(self, prn, stop_filter=None):
+    """
+    calls prn(packet) for every frame, until stop_filter(packet) returns True.
+    Same as TPacketV3Capture.run(), but returns once the whole file has been read.
+    """
+    try:
+      for packet in self:
+        prn(packet)
+        if stop_filter is not None and stop_filter(packet):
+          return
+    finally:
+      self.close()
+
+  def _read(self, size):
+    return self._fp.read(size)
+
+  def _set_linktype(self, linktype):
+    if linktype not in LINKTYPES:
+      raise PcapError("Unsupported link type: %d" % linktype)
+    if self._linktype is not None and self._linktype != linktype:
+      raise PcapError("Interfaces with different link types (%d, %d)" % (self._linktype, linktype))
+    self._linktype = linktype
+
+  def _pcap_frames(self, head):
+    magic_le, = struct.unpack("<I", head)
+    magic_be, = struct.unpack(">I", head)
+    if magic_le in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+      endian, magic = "<", magic_le
+    elif magic_be in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+      endian, magic = ">", magic_be
+    else:
+      raise PcapError("Bad magic: 0x%08x" % magic_le)
+
+    header = self._read(20)
+    if len(header) < 20:
+      raise PcapError("Truncated file header")
+    _, _, _, _, _, linktype = struct.unpack(endian + "HHiIII", header)
+    self._set_linktype(linktype & 0xffff)
+
+    scale = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+    record = struct.Struct(endian + "IIII")  # secs, usecs (or nsecs), caplen, len
+    record_size = record.size
+    unpack = record.unpack
+    read = self._read
+
+    return self._records(read, record_size, unpack, scale)
+
+  @staticmethod
+  def _records(read, record_size, unpack, scale):
+    while True:
+      header = read(record_size)
+      if len(header) < record_size:
+        return  # EOF (a truncated trailing header is ignored, like tcpdump does)
+      secs, frac, caplen, _ = unpack(header)
+      data = read(caplen)
+      if len(data) < caplen:
+        return
+      yield RawPacket(data, secs + frac * scale)
+
+  def _pcapng_frames(self, head):
+    read = self._read
+    endian = None
+    scales = []  # per interface, in the current section
+    snaplens = []
+    timestamp = 0
+
+    block_type = struct.unpack("=I", head)[0]
+    while True:
+      if block_type == PCAPNG_SHB:
+        length_bytes = read(4)
+        magic = read(4)
+        if len(magic) < 4:
+          raise PcapError("Truncated section header")
+        if struct.unpack("<I", magic)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+          endian = "<"
+        elif struct.unpack(">I", magic)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+          endian = ">"
+        else:
+          raise PcapError("Bad byte order magic in section header")
+        length, = struct.unpack(endian + "I", length_bytes)
+        read(length - 12)  # version, section length, options & trailing length
+        scales, snaplens = [], []
+      else:
+        length_bytes = read(4)
+        if len(length_bytes) < 4:
+          return
+        length, = struct.unpack(endian + "I", length_bytes)
+        body = read(length - 8)
+        if len(body) < length - 8:
+          return  # truncated block
+        body = body[:-4]  # drop the trailing block length
+
+        if block_type == PCAPNG_EPB:
+          iface, ts_high, ts_low, caplen, _ = struct.unpack_from(endian + "IIIII", body)
+          timestamp = ((ts_high << 32) | ts_low) * scales[iface]
+          yield RawPacket(body[20:20 + caplen], timestamp)
+        elif block_type == PCAPNG_SPB:
+          origlen, = struct.unpack_from(endian + "I", body)
+          caplen = min(origlen, snaplens[0] or origlen)
+          # simple packets have no timestamp, so go with the last one we saw
+          yield RawPacket(body[4:4 + caplen], timestamp)
+        elif block_type == PCAPNG_IDB:
+          linktype, _, snaplen = struct.unpack_from(endian + "HHI", body)
+          self._set_linktype(linktype)
+          scales.append(self._if_tsresol(body[8:], endian))
+          snaplens.append(snaplen)
+
+      head = read(4)
+      if len(head) < 4:
+        return
+      block_type, = struct.unpack(endian + "I", head)
+
+  @staticmethod
+  def _if_tsresol(options, endian):
+    """ the interface's timestamp unit (in secs), 1 usec unless there's an if_tsresol option """
+    offset = 0
+    while offset + 4 <= len(options):
+      code, length = struct.unpack_from(endian + "HH", options, offset)
+      if code == PCAPNG_OPT_ENDOFOPT:
+        break
+      if code == PCAPNG_IF_TSRESOL and length == 1:
+        resol = ord(options[offset + 4:offset + 5])
+        return 2 ** -(resol & 0x7f) if resol & 0x80 else 10 ** -resol
+      offset += 4 + ((length + 3) & ~3)
+    return 1e-6
@@ -0,0 +1,122 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+"""
+requests waiting for their replies
+
+Replies don't carry their type, so the sniffer keeps a tab of (client, xid) -> opcode
+for the requests it saw. Without bounds this leaks: clients can go away without
+a CloseRequest and replies can get lost (sampling, drops), so entries are evicted
+by age and by a global cap too.
+"""
+
+from collections import OrderedDict
+
+
+class PendingRequests(object):
+  """
+  Entries are removed when:
+
+  * the matching reply is seen
+  * the client (ip:port) starts a new session or its connection is closed
+  * they are older than ttl seconds (as per packet timestamps, not wall clock)
+  * there are more than max_size entries (oldest go first)
+  """
+
+  def __init__(self, max_size=10000, ttl=60):
+    self._pending = OrderedDict()  # (client, xid) -> (opcode, timestamp), oldest first
+    self._xids_by_client = {}      # client -> set of xids
+    self._max_size = max_size
+    self._ttl = ttl
+    self.evicted = 0    # dropped because of max_size
+    self.expired = 0    # dropped because of ttl
+    self.unmatched = 0  # replies for which there was no request
+
+  def __len__(self):
+    return len(self._pending)
+
+  def __contains__(self, key):
+    return key in self._pending
+
+  def add(self, client, xid, opcode, timestamp):
+    key = (client, xid)
+    timestamp = float(timestamp)
+
+    if self._pending.pop(key, None) is None:
+      self._xids_by_client.setdefault(client, set()).add(xid)
+    self._pending[key] = (opcode, timestamp)
+
+    self._expire(timestamp)
+
+    while len(self._pending) > self._max_size:
+      self._remove(*self._pending.popitem(last=False)[0])
+      self.evicted += 1
+
+  def pop(self, client, xid):
+    """ returns the opcode of the matching request, or None """
+    entry = self.pop_entry(client, xid)
+    return None if entry is None else entry[0]
+
+  def pop_entry(self, client, xid):
+    """ returns (opcode, timestamp) for the matching request, or None """
+    entry = self._pending.pop((client, xid), None)
+    if entry is None:
+      self.unmatched += 1
+      return None
+
+    self._remove(client, xid)
+    return entry
+
+  def drop_client(self, client):
+    """ the client's session/connection is gone, so no replies are coming """
+    for xid in self._xids_by_client.pop(client, ()):
+      self._pending.pop((client, xid), None)
+
+  def for_client(self, client):
+    """ a dict-like view of the client's pending requests (xid -> opcode) """
+    return ClientPendingRequests(self, client)
+
+  def _remove(self, client, xid):
+    xids = self._xids_by_client.get(client)
+    if xids is not None:
+      xids.discard(xid)
+      if not xids:
+        del self._xids_by_client[client]
+
+  def _expire(self, now):
+    deadline = now - self._ttl
+    pending = self._pending
+    while pending:
+      key = next(iter(pending))
+      if pending[key][1] >= deadline:
+        break
+      del pending[key]
+      self._remove(*key)
+      self.expired += 1
+
+
+class ClientPendingRequests(object):
+  """ what ServerMessage.from_payload expects: something that pops xids into opcodes """
+  __slots__ = ("_pending", "_client")
+
+  def __init__(self, pending, client):
+    self._pending = pending
+    self._client = client
+
+  def pop(self, xid, default=None):
+    opcode = self._pending.pop(self._client, xid)
+    return default if opcode is None else opcode
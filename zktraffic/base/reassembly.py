@@ -0,0 +1,303 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+"""
+TCP stream reassembly into length prefixed (jute) frames
+
+ZK clients pipeline requests, so a segment can carry many frames. And big
+replies (i.e.: GetData, GetChildren) span many segments. So we keep a tab
+per flow (bounded) and cut frames out of the byte stream.
+"""
+
+from collections import OrderedDict
+
+from .util import INT_STRUCT
+
+
+SEQ_MOD = 1 << 32
+SEQ_HALF = 1 << 31
+
+
+def seq_diff(a, b):
+  """ a - b, taking into account that sequence numbers wrap around """
+  diff = (a - b) % SEQ_MOD
+  return diff - SEQ_MOD if diff >= SEQ_HALF else diff
+
+
+def length_prefixed(buf, offset, end):
+  """
+  the length of the frame that starts at offset: 4 bytes of length + length bytes of
+  payload. None if there aren't enough bytes (up to end) to tell, -1 if it's bogus.
+
+  Other framings can tell as much as they can (i.e.: a lower bound) from what's there.
+  """
+  if end - offset < INT_STRUCT.size:
+    return None
+  length, = INT_STRUCT.unpack_from(buf, offset)
+  return INT_STRUCT.size + length if length >= 0 else -1
+
+
+class Flow(object):
+  __slots__ = ("next_seq", "buf", "out_of_order", "out_of_order_bytes", "skipped")
+
+  def __init__(self, next_seq):
+    self.next_seq = next_seq
+    self.buf = bytearray()
+    self.out_of_order = {}  # seq -> payload
+    self.out_of_order_bytes = 0
+    self.skipped = None  # (start, end) of the last hole we didn't wait for
+
+  @property
+  def pending(self):
+    return len(self.buf) + self.out_of_order_bytes
+
+  def resync(self, next_seq):
+    """ we lost track of frame boundaries, so start over """
+    self.next_seq = next_seq
+    del self.buf[:]
+    self.out_of_order.clear()
+    self.out_of_order_bytes = 0
+
+
+class StreamReassembler(object):
+  """
+  Turns TCP payloads into frames: 4 bytes of length + length bytes of payload, unless
+  frame_length tells them apart otherwise (see length_prefixed).
+
+  Each flow buffers up to max_buffer (a frame can't be bigger, i.e.: ZK's jute.maxbuffer)
+  + max_out_of_order bytes, and all of them up to about max_bytes: past that the least
+  recently used flows are evicted. When a flow goes over its limits its buffers are
+  dropped and the flow gets resynced on the next segment (assuming it starts a frame,
+  which is what the sniffer assumed before there was reassembly).
+
+  A bogus length means there's no length prefix (i.e.: requests from old C clients, see
+  ClientMessage.from_payload) or that we lost track of the frames. Either way, what's
+  buffered is handed over as is (one message per segment, as before reassembly) and
+  the flow starts over.
+
+  A hole found on a frame boundary, with the next segment starting a frame, isn't waited
+  for: when sniffing it's most likely a segment the capture dropped, which will never
+  show up. If it does show up (a retransmit, or just reordering), it's decoded on its own.
+  """
+
+  def __init__(self, max_flows=10000, max_buffer=1024 * 1024, max_out_of_order=64 * 1024,
+               max_bytes=64 * 1024 * 1024, frame_length=length_prefixed):
+    self._flows = OrderedDict()  # flow key -> Flow, LRU order
+    self._frame_length = frame_length
+    self._max_flows = max_flows
+    self._max_buffer = max_buffer
+    self._max_out_of_order = max_out_of_order
+    self._max_bytes = max_bytes
+    self._bytes = 0  # buffered, across all flows
+    self.evicted_flows = 0
+    self.resyncs = 0
+    self.unframed = 0  # payloads handed over without a length prefix
+    self.skipped_holes = 0
+
+  def __len__(self):
+    return len(self._flows)
+
+  @property
+  def buffered(self):
+    """ bytes buffered across all flows """
+    return self._bytes
+
+  def pending(self, key):
+    """ bytes buffered for this flow """
+    flow = self._flows.get(key)
+    return flow.pending if flow else 0
+
+  def close(self, key):
+    """ the flow is done (i.e.: FIN or RST) """
+    flow = self._flows.pop(key, None)
+    if flow is not None:
+      self._bytes -= flow.pending
+
+  def add(self, key, seq, payload, syn=False):
+    """
+    :param key: anything hashable identifying the flow (i.e.: (src, dst))
+    :param seq: the segment's TCP sequence number
+    :param payload: the segment's payload
+    :param syn: whether this is a SYN segment (which takes up one seq number)
+    :returns: a list of complete frames (including their length prefix)
+    """
+    if syn:
+      seq = (seq + 1) % SEQ_MOD
+
+    flow = self._get_flow(key, seq, syn)
+
+    if not payload:
+      return []
+
+    pending = flow.pending
+    frames = self._add(flow, seq, payload)
+    self._bytes += flow.pending - pending
+
+    if self._bytes > self._max_bytes:
+      self._shed(flow)
+
+    return frames
+
+  def _add(self, flow, seq, payload):
+    diff = seq_diff(seq, flow.next_seq)
+
+    if diff < 0:
+      if self._in_skipped(flow, seq, payload):
+        return self._whole_frames(payload)
+      # retransmission or overlap, keep whatever is new
+      if len(payload) <= -diff:
+        return []
+      payload = payload[-diff:]
+    elif diff > 0:
+      if not flow.buf and not flow.out_of_order and self._starts_frame(payload):
+        # nothing to complete, so don't wait for what's missing
+        self.skipped_holes += 1
+        flow.skipped = (flow.next_seq, seq)
+        flow.next_seq = seq
+      # a hole: keep it around until the missing segment shows up
+      elif flow.out_of_order_bytes + len(payload) > self._max_out_of_order:
+        self.resyncs += 1
+        flow.resync(seq)
+      else:
+        self._keep_out_of_order(flow, seq, payload)
+        return []
+
+    flow.buf.extend(payload)
+    flow.next_seq = (flow.next_seq + len(payload)) % SEQ_MOD
+
+    if flow.out_of_order:
+      self._fill_holes(flow)
+
+    return self._frames(flow)
+
+  def _get_flow(self, key, seq, syn):
+    flow = self._flows.pop(key, None)
+
+    if flow is None or syn:
+      if flow is not None:
+        self._bytes -= flow.pending
+      flow = Flow(seq)
+      while len(self._flows) >= self._max_flows:
+        self._evict_oldest()
+
+    self._flows[key] = flow
+    return flow
+
+  def _evict_oldest(self):
+    _, flow = self._flows.popitem(last=False)
+    self._bytes -= flow.pending
+    self.evicted_flows += 1
+
+  def _shed(self, flow):
+    """ over max_bytes: evict the least recently used flows (flow, the current one, is last) """
+    while self._bytes > self._max_bytes and len(self._flows) > 1:
+      self._evict_oldest()
+
+    if self._bytes > self._max_bytes:
+      self._bytes -= flow.pending
+      self.resyncs += 1
+      flow.resync(flow.next_seq)
+
+  @staticmethod
+  def _keep_out_of_order(flow, seq, payload):
+    """ keeps the longest payload seen for seq (i.e.: a retransmit might carry more data) """
+    current = flow.out_of_order.get(seq)
+    if current is not None:
+      if len(current) >= len(payload):
+        return
+      flow.out_of_order_bytes -= len(current)
+    flow.out_of_order[seq] = payload
+    flow.out_of_order_bytes += len(payload)
+
+  @staticmethod
+  def _in_skipped(flow, seq, payload):
+    if flow.skipped is None:
+      return False
+    start, end = flow.skipped
+    return seq_diff(seq, start) >= 0 and seq_diff((seq + len(payload)) % SEQ_MOD, end) <= 0
+
+  def _starts_frame(self, payload):
+    length = self._frame_length(payload, 0, len(payload))
+    return length is not None and 0 <= length <= self._max_buffer + INT_STRUCT.size
+
+  def _whole_frames(self, payload):
+    """ the frames in a payload that isn't part of the stream (i.e.: a hole we skipped) """
+    frames = []
+    offset = 0
+    while offset < len(payload):
+      length = self._frame_length(payload, offset, len(payload))
+      if length is None or length <= 0 or offset + length > len(payload):
+        break
+      frames.append(bytes(payload[offset:offset + length]))
+      offset += length
+    return frames
+
+  def _fill_holes(self, flow):
+    while flow.out_of_order:
+      payload = flow.out_of_order.pop(flow.next_seq, None)
+      if payload is None:
+        # drop anything we already have
+        stale = [s for s in flow.out_of_order if seq_diff(s, flow.next_seq) < 0]
+        if not stale:
+          break
+        for s in stale:
+          payload = flow.out_of_order.pop(s)
+          flow.out_of_order_bytes -= len(payload)
+          overlap = seq_diff(flow.next_seq, s)
+          if overlap < len(payload):
+            self._keep_out_of_order(flow, flow.next_seq, payload[overlap:])
+        continue
+
+      flow.out_of_order_bytes -= len(payload)
+      flow.buf.extend(payload)
+      flow.next_seq = (flow.next_seq + len(payload)) % SEQ_MOD
+
+  def _frames(self, flow):
+    frames = []
+    buf = flow.buf
+    frame_length = self._frame_length
+    max_length = self._max_buffer + INT_STRUCT.size
+    offset = 0
+    available = len(buf)
+
+    while offset < available:
+      length = frame_length(buf, offset, available)
+      if length is None:
+        break
+
+      if length < 0 or length > max_length:
+        # no length prefix (or not a frame boundary), hand it over as is & start over
+        frames.append(bytes(buf[offset:]))
+        self.unframed += 1
+        flow.resync(flow.next_seq)
+        return frames
+
+      end = offset + length
+      if end > available:
+        break
+
+      frames.append(bytes(buf[offset:end]))
+      offset = end
+
+    if offset:
+      del buf[:offset]
+
+    if len(buf) > max_length:
+      self.resyncs += 1
+      flow.resync(flow.next_seq)
+
+    return frames
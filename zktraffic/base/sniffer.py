@@ -15,10 +15,9 @@
 # ==================================================================================================
 
 
-from collections import defaultdict
-from random import random
 from threading import Thread
 
+import dpkt
 import logging
 import os
 import hexdump
@@ -27,17 +26,20 @@ import socket
 import struct
 import sys
 
+from .capture import SCAPY, TPACKET, TPacketV3Capture, validate_capture_backend
 from .client_message import ClientMessage, Request
-from .network import BadPacket, get_ip, get_ip_packet, SnifferBase
+from .pcap import PcapError, PcapReader
+from .pending import PendingRequests
+from .reassembly import StreamReassembler
+from .network import BadPacket, decode_packet, packet_addrs, SnifferBase
 from .server_message import Reply, ServerMessage, WatchEvent
 from .zookeeper import DeserializationError, OpCodes
-from .util import StringTooLong, to_bytes
+from .util import materialize, StringTooLong, to_bytes
 
 from scapy.config import conf as scapy_conf
 scapy_conf.logLevel = logging.ERROR  # shush scapy
 
 from scapy.sendrecv import sniff
-from six.moves import intern
 from twitter.common import log
 
 
@@ -61,6 +63,33 @@ FOUR_LETTER_WORDS = (
 )
 
 
+def four_letter_word(data):
+  """ returns the four letter word data starts with, if any """
+  if len(data) < 4:
+    return None
+  word = materialize(data[0:4])
+  return word if word in FOUR_LETTER_WORDS else None
+
+
+SAMPLING_BUCKETS = 1024
+
+
+def sampling_filter(sampling):
+  """
+  A pcap filter that keeps (roughly) the given percentage of TCP flows, so unsampled
+  packets are dropped by the kernel and requests & their replies are kept together.
+
+  Flows are bucketed by XOR'ing the lower 16 bits of both addresses and both ports,
+  which is the same in both directions. For IPv6, extension headers aren't handled.
+  """
+  mask = SAMPLING_BUCKETS - 1
+  buckets = int(sampling * SAMPLING_BUCKETS)
+  return (
+    "((ip and ((ip[14:2] ^ ip[18:2] ^ tcp[0:2] ^ tcp[2:2]) & %d) < %d) or "
+    "(ip6 and ip6[6] = 6 and ((ip6[22:2] ^ ip6[38:2] ^ ip6[40:2] ^ ip6[42:2]) & %d) < %d))" % (
+      mask, buckets, mask, buckets))
+
+
 class SnifferConfig(object):
   def __init__(self,
       iface="eth0",
@@ -75,17 +104,29 @@ class SnifferConfig(object):
     self.debug = debug
     self.client_port = 0
     self.track_replies = False
-    self.max_queued_requests = 10000
+    self.max_queued_requests = 10000  # requests waiting for replies, across all clients
+    self.pending_requests_ttl = 60    # secs (packet time) before giving up on a reply
     self.zookeeper_port = DEFAULT_PORT
     self.excluded_opcodes = set()
     self.is_loopback = iface in ["lo", "lo0"]
     self.read_timeout_ms = 0
     self.dump_bad_packet = False
-    self.sampling = 1.0  # percentage of packets to inspect [0, 1]
+    self.capture_backend = SCAPY
+    self.reassemble = False  # reassemble TCP streams into ZK frames
+    self.max_reassembly_flows = 10000
+    self.max_reassembly_buffer = 1024 * 1024  # per flow, ZK's default jute.maxbuffer
+    self.max_reassembly_bytes = 64 * 1024 * 1024  # across all flows
+    self.lazy_decode = False  # decode fields that aren't part of a request's header on demand
+    self.fanout_group = None  # PACKET_FANOUT group id, only used by the tpacket backend
+    # frames this big are parsed in place (via memoryview), smaller ones are cheaper to copy
+    self.zero_copy_min_size = 1024
+    # read packets from this pcap (or pcapng) file instead of sniffing, see PcapReader
+    self.offline = None
 
     # These are set after initialization, and require `update_filter` to be called
     self.included_ips = []
     self.excluded_ips = []
+    self.sampling = 1.0  # percentage of TCP flows to inspect [0, 1]
 
     self.update_filter()
     self.exclude_pings()
@@ -100,6 +141,9 @@ class SnifferConfig(object):
     elif self.included_ips:
       self.filter += " and (host " + " or host ".join(self.included_ips) + ")"
 
+    if self.sampling < 1.0:
+      self.filter += " and " + sampling_filter(self.sampling)
+
   def include_pings(self):
     self.update_exclusion_list(OpCodes.PING, False)
 
@@ -127,6 +171,7 @@ filter = %s
 zookeeper_port = %d
 is_loopback = %s
 read_timeout_ms = %d
+capture_backend = %s
 debug = %s
 """ % (self.iface,
           str((self.writes_only)).lower(),
@@ -134,6 +179,7 @@ debug = %s
           self.zookeeper_port,
           str(self.is_loopback),
           self.read_timeout_ms,
+          self.capture_backend,
           str(self.debug).lower())
 
 
@@ -160,8 +206,12 @@ class Sniffer(SnifferBase):
     self._request_handlers = []
     self._reply_handlers = []
     self._event_handlers = []
-    self._requests_xids = defaultdict(dict)  # if tracking replies, keep a tab for seen reqs
+    self._pending_requests = PendingRequests(  # if tracking replies, keep a tab for seen reqs
+      config.max_queued_requests, config.pending_requests_ttl)
     self._four_letter_mode = {}              # key: client addr, val: four letter
+    self._reassembler = StreamReassembler(
+      config.max_reassembly_flows, config.max_reassembly_buffer,
+      max_bytes=config.max_reassembly_bytes) if config.reassemble else None
     self._wants_stop = False
 
     self.config = config
@@ -193,13 +243,26 @@ class Sniffer(SnifferBase):
 
     handlers.append(handler)
 
+  @property
+  def pending_requests(self):
+    """ requests waiting for replies, along with evicted/expired/unmatched counters """
+    return self._pending_requests
+
   def wants_stop(self, *args, **kwargs):  # pragma: no cover
     return self._wants_stop
 
   def run(self):
+    if self.config.offline:
+      self.read_offline(self.config.offline)
+      return
+
     try:
       log.info("Setting filter: %s", self.config.filter)
-      if self.config.iface == "any":  # pragma: no cover
+      if validate_capture_backend(self.config.capture_backend) == TPACKET:  # pragma: no cover
+        capture = TPacketV3Capture(
+          self.config.iface, self.config.filter, fanout_group=self.config.fanout_group)
+        capture.run(self.handle_packet, self.wants_stop)
+      elif self.config.iface == "any":  # pragma: no cover
         sniff(
           filter=self.config.filter,
           store=0,
@@ -223,19 +286,45 @@ class Sniffer(SnifferBase):
       log.info("The sniff loop exited")
       os.kill(os.getpid(), signal.SIGINT)
 
-  def handle_packet(self, packet):
-    sampling = self.config.sampling
-    if sampling < 1.0 and random() > sampling:
+  def read_offline(self, path):
+    """
+    handles all the packets in a pcap (or pcapng) file. Only the ZK port (and the client
+    port, if any) is checked, host filters & sampling aren't applied.
+    """
+    try:
+      reader = PcapReader(path)
+    except (IOError, OSError, PcapError) as ex:
+      if self._error_to_stderr:
+        sys.stderr.write("Error: %s, file: %s\n" % (ex, path))
+      else:
+        log.error("Error: %s, file: %s", ex, path)
       return
 
+    self.config.is_loopback = reader.is_loopback
+    reader.run(self.handle_packet, self.wants_stop)
+    log.info("Done reading %s", path)
+
+  def handle_packet(self, packet):
     try:
-      message = self.message_from_packet(packet)
-      self.handle_message(message)
+      if self._reassembler is None:
+        messages = (self.message_from_packet(packet),)
+      else:
+        messages = self.messages_from_packet(packet)
     except (BadPacket, StringTooLong, DeserializationError, struct.error) as ex:
-      if self.config.dump_bad_packet:
-        print("got: %s" % str(ex))
-        hexdump.hexdump(packet.load)
-        sys.stdout.flush()
+      self._bad_packet(ex, packet.load)
+      return
+
+    for message in messages:
+      try:
+        self.handle_message(message)
+      except BadPacket as ex:
+        self._bad_packet(ex, packet.load)
+
+  def _bad_packet(self, ex, data):
+    if self.config.dump_bad_packet:
+      print("got: %s" % str(ex))
+      hexdump.hexdump(data)
+      sys.stdout.flush()
 
   def handle_message(self, message):
     if message and not self.config.excluded(message.opcode):
@@ -264,57 +353,123 @@ class Sniffer(SnifferBase):
     """
     client_port = self.config.client_port
     zk_port = self.config.zookeeper_port
-    ip_p = get_ip_packet(packet.load, client_port, zk_port, self.config.is_loopback)
+    ip_p = decode_packet(
+      packet, client_port, zk_port, self.config.is_loopback, self._packet_buffer(packet))
 
     if 0 == len(ip_p.data.data):
       return None
 
     if ip_p.data.dport == zk_port:
       data = ip_p.data.data
-      src = intern("%s:%s" % (get_ip(ip_p, ip_p.src), ip_p.data.sport))
-      dst = intern("%s:%s" % (get_ip(ip_p, ip_p.dst), ip_p.data.dport))
-      client, server = src, dst
-      if data.startswith(FOUR_LETTER_WORDS):
-        self._set_four_letter_mode(client, data[0:4])
-        raise BadPacket("Four letter request %s" % data[0:4])
-      client_message = ClientMessage.from_payload(data, client, server)
-      client_message.timestamp = packet.time
-      self._track_client_message(client_message)
-      return client_message
+      client, server = packet_addrs(packet, ip_p)
+      four_letter = four_letter_word(data)
+      if four_letter:
+        self._set_four_letter_mode(client, four_letter)
+        raise BadPacket("Four letter request %s" % four_letter)
+      return self._client_message(data, client, server, packet.time)
 
     if ip_p.data.sport == zk_port:
       data = ip_p.data.data
-      src = intern("%s:%s" % (get_ip(ip_p, ip_p.src), ip_p.data.sport))
-      dst = intern("%s:%s" % (get_ip(ip_p, ip_p.dst), ip_p.data.dport))
-      client, server = dst, src
+      server, client = packet_addrs(packet, ip_p)
       four_letter = self._get_four_letter_mode(client)
       if four_letter:
         self._set_four_letter_mode(client, None)
         raise BadPacket("Four letter response %s" % four_letter)
-      requests_xids = self._requests_xids.get(client, {})
-      server_message = ServerMessage.from_payload(data, client, server, requests_xids)
-      server_message.timestamp = packet.time
-      return server_message
+      return self._server_message(data, client, server, packet.time)
 
     raise BadPacket("Packet to the wrong port?")
 
+  def messages_from_packet(self, packet):
+    """
+    Like message_from_packet, but TCP payloads go through the stream reassembler
+    first. So a packet might carry no messages (i.e.: part of a big reply) or many
+    (i.e.: pipelined requests).
+
+    Frames that can't be deserialized are reported as bad packets and skipped.
+
+    :returns: Returns a list of ClientMessage or ServerMessage (or subclasses)
+    :raises:
+      :exc:`BadPacket` if the packet is for a client we are not tracking
+    """
+    client_port = self.config.client_port
+    zk_port = self.config.zookeeper_port
+    ip_p = decode_packet(
+      packet, client_port, zk_port, self.config.is_loopback, self._packet_buffer(packet))
+    tcp_p = ip_p.data
+
+    if tcp_p.dport == zk_port:
+      client, server = packet_addrs(packet, ip_p)
+      from_client = True
+    elif tcp_p.sport == zk_port:
+      server, client = packet_addrs(packet, ip_p)
+      from_client = False
+    else:
+      raise BadPacket("Packet to the wrong port?")
+
+    key = (client, from_client)
+    data = tcp_p.data
+
+    try:
+      if from_client:
+        four_letter = four_letter_word(data) if self._reassembler.pending(key) == 0 else None
+        if four_letter:
+          self._set_four_letter_mode(client, four_letter)
+          raise BadPacket("Four letter request %s" % four_letter)
+      else:
+        four_letter = self._get_four_letter_mode(client)
+        if four_letter and data:
+          self._set_four_letter_mode(client, None)
+          raise BadPacket("Four letter response %s" % four_letter)
+
+      frames = self._reassembler.add(key, tcp_p.seq, data, tcp_p.flags & dpkt.tcp.TH_SYN)
+
+      messages = []
+      for frame in frames:
+        try:
+          if from_client:
+            messages.append(self._client_message(frame, client, server, packet.time))
+          else:
+            messages.append(self._server_message(frame, client, server, packet.time))
+        except (BadPacket, StringTooLong, DeserializationError, struct.error) as ex:
+          self._bad_packet(ex, frame)
+
+      return messages
+    finally:
+      if tcp_p.flags & (dpkt.tcp.TH_FIN | dpkt.tcp.TH_RST):
+        self._reassembler.close(key)
+        if tcp_p.flags & dpkt.tcp.TH_RST or not from_client:
+          # the server is done sending, so no more replies are coming
+          self._pending_requests.drop_client(client)
+
+  def _packet_buffer(self, packet):
+    """ dpkt slices memoryviews without copying, so big payloads get parsed in place """
+    load = packet.load
+    return memoryview(load) if len(load) >= self.config.zero_copy_min_size else load
+
+  def _client_message(self, data, client, server, timestamp):
+    client_message = ClientMessage.from_payload(data, client, server, self.config.lazy_decode)
+    client_message.timestamp = timestamp
+    self._track_client_message(client_message)
+    return client_message
+
+  def _server_message(self, data, client, server, timestamp):
+    if self.config.track_replies:
+      requests_xids = self._pending_requests.for_client(client)
+    else:
+      requests_xids = {}
+    server_message = ServerMessage.from_payload(data, client, server, requests_xids)
+    server_message.timestamp = timestamp
+    return server_message
+
   def _track_client_message(self, request):
     """
     Any request that is not a ping or a close should be tracked
     """
     if self.config.track_replies and not request.is_ping and not request.is_close:
-      requests_xids = self._requests_xids[request.client]
-      if len(requests_xids) > self.config.max_queued_requests:  # pragma: no cover
-        # TODO: logging the counts of each type of pkts in the queue when this happens
-        #       could be useful.
-        if self._error_to_stderr:
-          sys.stderr.write("Too many queued requests, replies for %s will be lost\n" %
-                           request.client)
-        else:
-          log.error("Too many queued requests, replies for %s will be lost", request.client)
-        return
-
-      requests_xids[request.xid] = request.opcode
+      if request.opcode == OpCodes.CONNECT:
+        # a new session from this ip:port, the old one's replies aren't coming
+        self._pending_requests.drop_client(request.client)
+      self._pending_requests.add(request.client, request.xid, request.opcode, request.timestamp)
 
   def _get_four_letter_mode(self, client):
     return self._four_letter_mode.get(client)
@@ -17,9 +17,13 @@
 
 """ helpers """
 
+from codecs import utf_8_decode
+
 import re
 import struct
 
+from six.moves import intern
+
 
 INT_STRUCT = struct.Struct('!i')
 LONG_STRUCT = struct.Struct('!q')
@@ -32,11 +36,14 @@ REPLY_HEADER_STRUCT = struct.Struct('!iqi')
 STAT_STRUCT = struct.Struct('!qqqqiiiqiiq')
 
 
+BUFFER_TYPES = (bytes, bytearray, memoryview, type(None))
+
+
 def to_bytes(value):
-    """ str to bytes (py3k) """
+    """ str to bytes (py3k), buffers (i.e.: memoryview) are passed through as is """
     vtype = type(value)
 
-    if vtype == bytes or vtype == type(None):
+    if vtype in BUFFER_TYPES:
         return value
 
     try:
@@ -46,6 +53,11 @@ def to_bytes(value):
     return value
 
 
+def materialize(data):
+  """ copy a buffer (i.e.: a memoryview slice) into bytes """
+  return data.tobytes() if type(data) == memoryview else bytes(data)
+
+
 def read_number(data, offset):
   data = to_bytes(data)
   try:
@@ -84,6 +96,8 @@ def read_string(data, offset, maxlen=1024, default="unreadable"):
   """
   Note: even though strings are utf-8 decoded, we need to str()
         them since they can't be used by intern() otherwise.
+
+  If data is a memoryview, the string is decoded straight from it (no copies).
   """
   data = to_bytes(data)
   old = offset
@@ -96,7 +110,7 @@ def read_string(data, offset, maxlen=1024, default="unreadable"):
     return ("", old)
 
   try:
-    s = data[offset:offset + length].decode("utf-8")
+    s, _ = utf_8_decode(data[offset:offset + length], "strict", True)
   except UnicodeDecodeError:
     s = default
 
@@ -109,6 +123,20 @@ def read_string(data, offset, maxlen=1024, default="unreadable"):
   return (s, offset + length)
 
 
+def skip_string(data, offset, maxlen=1024):
+  """ like read_string, but only returns the new offset (nothing gets decoded) """
+  old = offset
+  length, offset = read_number(data, offset)
+
+  if length > maxlen:
+    raise StringTooLong("Length %d is greater than the maximum length (%d)" % (length, maxlen))
+
+  if length < 0:
+    return old
+
+  return offset + length
+
+
 def read_buffer(data, offset, maxlen=1024):
   old = offset
   length, offset = read_number(data, offset)
@@ -118,7 +146,7 @@ def read_buffer(data, offset, maxlen=1024):
   if length > maxlen:
     return (None, old)
 
-  return (data[offset:offset + length], offset + length)
+  return (materialize(data[offset:offset + length]), offset + length)
 
 
 def read_int_bool_int(data, offset):
@@ -147,11 +175,74 @@ def read_int_int(data, offset):
   return (INT_INT_STRUCT.unpack_from(data, offset), offset + INT_INT_STRUCT.size)
 
 
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+  """ 10 or 10s -> 10, 5m -> 300, 1h -> 3600. raises ValueError for bad (or <= 0) values """
+  value = value.strip()
+  unit = DURATION_UNITS.get(value[-1:], None)
+  secs = int(value[:-1] if unit else value) * (unit or 1)
+  if secs <= 0:
+    raise ValueError("Duration must be > 0: %s" % value)
+  return secs
+
+
 def parent_path(path, level):
   """ for level 3 and path /a/b/c/d/e/f this returns /a/b/c """
   return '/'.join(path.split('/')[0:level + 1])
 
 
+class PathCache(object):
+  """
+  Maps (path, depth, suffix) to the interned key for the path aggregated to depth (see
+  parent_path) and suffixed (i.e.: with an IP), so hot paths are split, joined & interned
+  only once.
+
+  Bounded, with (approximate) LRU eviction: keys live in two generations, when the newest
+  one is full it becomes the old one and the old one is dropped. A key used in the old
+  generation moves back to the newest one. So there are up to 2 * max_size keys, and any
+  key used within the last max_size misses is kept.
+  """
+
+  def __init__(self, max_size=65536):
+    self._max_size = max_size
+    self._new = {}
+    self._old = {}
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._new) + len(self._old)
+
+  def key(self, path, depth=0, suffix=None):
+    cache_key = (path, depth, suffix)
+    key = self._new.get(cache_key)
+    if key is not None:
+      self.hits += 1
+      return key
+
+    key = self._old.pop(cache_key, None)
+    if key is not None:
+      self.hits += 1
+    else:
+      self.misses += 1
+      if depth > 0 and path:
+        path = parent_path(path, depth)
+      key = intern(path if suffix is None else ':'.join((path, suffix)))
+
+    if len(self._new) >= self._max_size:
+      self._old = self._new
+      self._new = {}
+
+    self._new[cache_key] = key
+    return key
+
+
+# shared by the accumulators & printers (per process)
+PATH_CACHE = PathCache()
+
+
 class QuorumConfig(object):
   class BadConfig(ParsingError):
     pass
@@ -16,9 +16,10 @@
 
 import sys
 
-from .printer import Printer
+from .printer import close_output, Printer, printer_output, stop_printers
 
 from zktraffic import __version__
+from zktraffic.base.capture import CAPTURE_BACKENDS, SCAPY
 from zktraffic.fle.message import Message
 from zktraffic.network.sniffer import Sniffer
 
@@ -31,8 +32,14 @@ def setup():
 
   app.add_option('--iface', default='eth0', type=str)
   app.add_option('--port', default=3888, type=int)
+  app.add_option('--capture-backend', default=SCAPY, type='choice', choices=CAPTURE_BACKENDS)
+  app.add_option('--offline', default=None, type=str, metavar='<file>',
+                 help='Read packets from a pcap (or pcapng) file instead of sniffing')
   app.add_option('-c', '--colors', default=False, action='store_true')
   app.add_option('--dump-bad-packet', default=False, action='store_true')
+  app.add_option('--buffered-output', default=False, action='store_true',
+                 help='Buffer output and write it out in batches (every 64KB or 50ms) instead of '
+                      'a line at a time. Ignored for terminals')
   app.add_option('--version', default=False, action='store_true')
 
 
@@ -42,15 +49,25 @@ def main(_, options):
     sys.stdout.write("%s\n" % __version__)
     sys.exit(0)
 
-  printer = Printer(options.colors)
-  sniffer = Sniffer(options.iface, options.port, Message, printer.add, options.dump_bad_packet)
+  output = printer_output(options.buffered_output)
+  printer = Printer(options.colors, output=output)
+  sniffer = Sniffer(options.iface, options.port, Message, printer.add, options.dump_bad_packet,
+                    start=not options.offline, capture_backend=options.capture_backend)
 
   try:
-    while printer.isAlive():
-      sniffer.join(1)
+    if options.offline:
+      sniffer.run(offline=options.offline)
+      stop_printers(printer)
+    else:
+      while printer.isAlive():
+        sniffer.join(1)
   except (KeyboardInterrupt, SystemExit):
     pass
 
+  try:
+    close_output(output)
+  except IOError: pass
+
 
 if __name__ == '__main__':
   setup()
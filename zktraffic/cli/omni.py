@@ -18,18 +18,25 @@
 # ==================================================================================================
 
 import sys
-import time
 
 from twitter.common import app
 from twitter.common.log.options import LogOptions
 
 from zktraffic import __version__
-from zktraffic.cli.printer import Printer as Printer, DefaultPrinter as ZKDefaultPrinter
+from zktraffic.base.capture import CAPTURE_BACKENDS, SCAPY
+from zktraffic.cli.printer import (
+  close_output,
+  DefaultPrinter as ZKDefaultPrinter,
+  Printer as Printer,
+  printer_output,
+  stop_printers,
+)
 from zktraffic.base.sniffer import Sniffer as ZKSniffer, SnifferConfig as ZKSnifferConfig
 from zktraffic.network.sniffer import Sniffer
 import zktraffic.fle.message as FLE
 import zktraffic.zab.quorum_packet as ZAB
 from zktraffic.omni.omni_sniffer import OmniSniffer
+from zktraffic.omni.workers import OmniPipeline, PipelinedOmniSniffer
 
 
 def setup():
@@ -37,12 +44,25 @@ def setup():
 
   app.add_option('--packet-filter', default='tcp', type=str,
                  help='pcap filter string. e.g. "tcp portrange 11221-32767" for JUnit tests')
+  app.add_option('--keep-packet-filter', default=False, action='store_true',
+                 help='Don\'t narrow the packet filter to the quorum\'s ports once they are known '
+                      '(only done with the tpacket capture backend)')
+  app.add_option('--iface', default='any', type=str,
+                 help='The interface to sniff on, only used by the tpacket capture backend')
+  app.add_option('--capture-backend', default=SCAPY, type='choice', choices=CAPTURE_BACKENDS,
+                 help='How to capture packets: scapy or tpacket (AF_PACKET TPACKET_V3 ring, Linux only)')
   app.add_option('-c', '--colors', default=False, action='store_true')
   app.add_option('--dump-bad-packet', default=False, action='store_true')
   app.add_option('--include-pings', default=False, action='store_true',
                  help='Whether to include ZAB/ZK pings')
   app.add_option('--offline', default=None, type=str,
-                 help='offline mode with a pcap file')
+                 help='offline mode with a pcap (or pcapng) file')
+  app.add_option('--buffered-output', default=False, action='store_true',
+                 help='Buffer output and write it out in batches (every 64KB or 50ms) instead of '
+                      'a line at a time. Ignored for terminals')
+  app.add_option('--workers', default=0, type=int,
+                 help='Decode ZAB & ZK traffic in this many worker processes (per protocol), '
+                      'output is merged in timestamp order. 0 decodes everything in-process')
   app.add_option('--version', default=False, action='store_true')
 
 
@@ -51,10 +71,14 @@ def main(_, options):
     sys.stdout.write("%s\n" % __version__)
     sys.exit(0)
 
+  output = printer_output(options.buffered_output)
+  if options.workers > 0:
+    return main_pipelined(options, output)
+
   printer = Printer(options.colors,
-                    output=sys.stdout,
+                    output=output,
                     skip_print=None if options.include_pings else lambda msg: isinstance(msg, ZAB.Ping))
-  zk_printer = ZKDefaultPrinter(options.colors, loopback=False, output=sys.stdout)
+  zk_printer = ZKDefaultPrinter(options.colors, loopback=False, output=output)
   zk_printer.start()
 
   def fle_sniffer_factory(port):
@@ -84,7 +108,10 @@ def main(_, options):
       zab_sniffer_factory,
       zk_sniffer_factory,
       pfilter=options.packet_filter,
-      dump_bad_packet=options.dump_bad_packet)
+      dump_bad_packet=options.dump_bad_packet,
+      iface=options.iface,
+      capture_backend=options.capture_backend,
+      auto_filter=not options.keep_packet_filter)
   else:
     sniffer = OmniSniffer(
       fle_sniffer_factory,
@@ -101,15 +128,68 @@ def main(_, options):
   except (KeyboardInterrupt, SystemExit):
     pass
 
-  # consume all messages
-  while not printer.empty or not zk_printer.empty:
-    time.sleep(0.0001)
+  # print what's queued & stop
+  stop_printers(printer, zk_printer)
+
+  try:
+    close_output(output)
+  except IOError: pass
+
+
+def main_pipelined(options, output):
+  """ FLE is decoded here, ZAB & ZK in the workers (see zktraffic.omni.workers) """
+  pipeline = OmniPipeline(
+    options.workers,
+    output=output,
+    colors=options.colors,
+    include_pings=options.include_pings,
+    dump_bad_packet=options.dump_bad_packet)
+  printer = Printer(options.colors, output=pipeline.local_output, start=False)
+
+  def fle_sniffer_factory(port):
+    return Sniffer(None, port, FLE.Message, printer.print_message, options.dump_bad_packet,
+                   start=False)
+
+  # these only tell the ports apart, the workers have their own sniffers
+  def zab_sniffer_factory(port):
+    return Sniffer(None, port, ZAB.QuorumPacket, None, options.dump_bad_packet, start=False)
+
+  def zk_sniffer_factory(port):
+    config = ZKSnifferConfig(None)
+    config.zookeeper_port = port
+    config.client_port = 0
+    return ZKSniffer(config)
+
+  pipeline.start()
+  sniffer = PipelinedOmniSniffer(
+    pipeline,
+    fle_sniffer_factory,
+    zab_sniffer_factory,
+    zk_sniffer_factory,
+    pfilter=options.packet_filter,
+    dump_bad_packet=options.dump_bad_packet,
+    iface=options.iface,
+    capture_backend=options.capture_backend,
+    auto_filter=not options.keep_packet_filter,
+    start=False)
+
+  if options.offline:
+    sniffer.run(offline=options.offline)
+  else:
+    sniffer.start()
+    try:
+      while sniffer.isAlive():
+        sniffer.join(1)
+    except (KeyboardInterrupt, SystemExit):
+      pass
+
+  # write out what's in flight & stop the workers
+  pipeline.stop()
+
+  try:
+    close_output(output)
+  except IOError: pass
 
-  # stop it
-  printer.stop()
-  zk_printer.stop()
-  while not printer.stopped or not zk_printer.stopped:
-    time.sleep(0.0001)
 
 if __name__ == '__main__':
   setup()
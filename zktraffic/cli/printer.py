@@ -18,12 +18,13 @@
 
 from collections import defaultdict, deque
 from datetime import datetime
-from threading import Thread
+from threading import Event, Lock, Thread
 
 import sys
 import time
 
-from zktraffic.stats.util import percentile
+from zktraffic.base.util import PATH_CACHE
+from zktraffic.stats.histogram import LogHistogram
 
 from tabulate import tabulate
 
@@ -33,18 +34,137 @@ import colors
 NUM_COLORS = len(colors.COLORS)
 
 
+class BufferedOutput(object):
+  """
+  Coalesces writes: the printers flush() after every message, but here that only
+  writes out once max_bytes are buffered. A thread flushes whatever is left every
+  max_delay secs, and close() flushes everything on exit.
+  """
+
+  def __init__(self, output, max_bytes=64 * 1024, max_delay=0.05):
+    self._output = output
+    self._max_bytes = max_bytes
+    self._max_delay = max_delay
+    self._lock = Lock()
+    self._chunks = []
+    self._size = 0
+    self._closed = Event()
+    self._flusher = Thread(target=self._flush_periodically)
+    self._flusher.daemon = True
+    self._flusher.start()
+
+  def write(self, data):
+    with self._lock:
+      self._chunks.append(data)
+      self._size += len(data)
+
+  def flush(self):
+    if self._size >= self._max_bytes:
+      self._flush()
+
+  def close(self):
+    self._closed.set()
+    self._flush()
+
+  def isatty(self):
+    return False
+
+  def _flush(self):
+    with self._lock:
+      if not self._chunks:
+        return
+      data = self._chunks[0][:0].join(self._chunks)  # str or bytes
+      self._chunks = []
+      self._size = 0
+      self._output.write(data)
+      self._output.flush()
+
+  def _flush_periodically(self):
+    while not self._closed.wait(self._max_delay):
+      try:
+        self._flush()
+      except IOError:  # PIPE broken, most likely
+        break
+
+
+def printer_output(buffered, output=sys.stdout, binary=False):
+  """
+  output for the printers: buffered (see BufferedOutput), unless it's a terminal. If
+  binary, it takes bytes (i.e.: stdout's underlying buffer on py3k)
+  """
+  if binary:
+    output = getattr(output, "buffer", output)
+
+  if buffered and not output.isatty():
+    return BufferedOutput(output)
+  return output
+
+
+def close_output(output):
+  """ flushes whatever a BufferedOutput has left """
+  if isinstance(output, BufferedOutput):
+    output.close()
+
+
+def stop_printers(*printers):
+  """ stops the printers once they are done with what's queued (i.e.: at the end of a pcap) """
+  for printer in printers:
+    printer.stop()
+  for printer in printers:
+    printer.join()
+
+
+class MessageQueue(object):
+  """
+  A deque the printer threads can block on, instead of polling it. Producers (the sniffer
+  threads) only pay for waking up the printer when it's idle, waiting for messages.
+  """
+
+  def __init__(self, max_wait=0.5):
+    self._messages = deque()
+    self._ready = Event()
+    self._idle = False
+    self._max_wait = max_wait
+
+  def __len__(self):
+    return len(self._messages)
+
+  def append(self, msg):
+    self._messages.append(msg)
+    if self._idle:
+      self._ready.set()
+
+  def wakeup(self):
+    self._ready.set()
+
+  def drain(self, block=True):
+    """ returns whatever is queued, waiting up to max_wait secs for something to show up """
+    messages = self._messages
+    if not messages and block:
+      self._idle = True
+      # check again, something might have been appended before we went idle
+      if not messages:
+        self._ready.wait(self._max_wait)
+      self._ready.clear()
+      self._idle = False
+
+    popleft = messages.popleft
+    return [popleft() for _ in range(len(messages))]
+
+
 class Printer(Thread):
   """ simple printer thread to use with FLE & ZAB messages """
-  def __init__(self, colors, output=sys.stdout, skip_print=None):
+  def __init__(self, colors, output=sys.stdout, skip_print=None, start=True):
     super(Printer, self).__init__()
     self.setDaemon(True)
-    self._queue = deque()
+    self._queue = MessageQueue()
     self._print = self._print_color if colors else self._print_default
     self._output = output
     self._stopped = True
     self._wants_stopped = False
     self._skip_print = skip_print  # a callable that takes msg and returns a bool
-    self.start()
+    if start:
+      self.start()
 
   @property
   def stopped(self):
@@ -52,6 +172,7 @@ class Printer(Thread):
 
   def stop(self):
     self._wants_stopped = True
+    self._queue.wakeup()
 
   @property
   def empty(self):
@@ -60,18 +181,25 @@ class Printer(Thread):
   def run(self):
     self._stopped = False
 
-    while not self._wants_stopped:
-      try:
-        msg = self._queue.popleft()
-        if not self._skip_print or not self._skip_print(msg):
-          self._print(msg)
-      except IndexError:
-        time.sleep(0.1)
-      except IOError:  # PIPE broken, most likely
-        break
+    try:
+      while not self._wants_stopped:
+        self._print_batch(self._queue.drain())
+      # whatever was queued before stop() was called
+      self._print_batch(self._queue.drain(block=False))
+    except IOError:  # PIPE broken, most likely
+      pass
 
     self._stopped = True
 
+  def _print_batch(self, msgs):
+    for msg in msgs:
+      if not self._skip_print or not self._skip_print(msg):
+        self._print(msg)
+
+  def print_message(self, msg):
+    """ prints msg right away, for when the printer's thread isn't running """
+    self._print_batch((msg,))
+
   def _print_default(self, msg):
     self._output.write(str(msg))
     self._output.flush()
@@ -110,11 +238,20 @@ class Requests(object):
 
 
 class BasePrinter(Thread):
-  """ base printer for client-side messages """
+  """
+  base printer for client-side messages
 
-  def __init__(self, colors, loopback, output=sys.stdout):
+  if there's a serializer (see zktraffic.cli.serializers), messages are written as
+  records instead of as text
+  """
+
+  def __init__(self, colors, loopback, output=sys.stdout, serializer=None):
     super(BasePrinter, self).__init__()
-    self.write = self.colored_write if colors else self.simple_write
+    if serializer is not None:
+      self.write = self.serialized_write
+    else:
+      self.write = self.colored_write if colors else self.simple_write
+    self._serializer = serializer
     self.loopback = loopback
     self._output = output
     self.setDaemon(True)
@@ -164,13 +301,27 @@ class BasePrinter(Thread):
       self._output.write("%s%s %s" % (right_arrow(i), format_timestamp(m.timestamp), m))
     self._output.flush()
 
+  def serialized_write(self, *msgs):
+    """ msgs are either a single message or request(s) & their reply, which gets the latency """
+    serialize = self._serializer.serialize
+    last = len(msgs) - 1
+    for i, m in enumerate(msgs):
+      latency = m.timestamp - msgs[0].timestamp if 0 < i == last else None
+      self._output.write(serialize(m, latency))
+    self._output.flush()
+
   def cancel(self, *args, **kwargs):  # pragma: no cover
     """ will be called on KeyboardInterrupt """
     pass
 
   def stop(self):
-    """" request the printer to stop """
+    """" request the printer to stop, once it's done with what's already queued """
     self._wants_stopped = True
+    self.wakeup()
+
+  def wakeup(self):  # pragma: no cover
+    """ wake up the printer's thread, if it's waiting for messages """
+    pass
 
   @property
   def empty(self):  # pragma: no cover
@@ -179,38 +330,40 @@ class BasePrinter(Thread):
 
 
 class DefaultPrinter(BasePrinter):
-  def __init__(self, colors, loopback, output=sys.stdout):
-    super(DefaultPrinter, self).__init__(colors, loopback, output)
+  def __init__(self, colors, loopback, output=sys.stdout, serializer=None):
+    super(DefaultPrinter, self).__init__(colors, loopback, output, serializer)
     self._requests_by_client = defaultdict(Requests)
-    self._replies = deque()
+    self._replies = MessageQueue()
 
   @property
   def empty(self):
     """ returns true if nothing is queued """
     return not any(self._requests_by_client.values()) and len(self._replies) == 0
 
+  def wakeup(self):
+    self._replies.wakeup()
+
   def run(self):
     self._stopped = False
 
-    while not self._wants_stopped:
-      try:
-        rep = self._replies.popleft()
-      except IndexError:
-        time.sleep(0.0001)
-        continue
+    try:
+      while not self._wants_stopped:
+        self._write_replies(self._replies.drain())
+      self._write_replies(self._replies.drain(block=False))
+    except IOError:  # PIPE broken, most likely
+      pass
+
+    self._stopped = True
 
+  def _write_replies(self, replies):
+    for rep in replies:
       reqs = self._requests_by_client[rep.client].pop(rep.xid)
       if not reqs:
         continue
 
       # HACK: if we are on the loopback, drop dupes
       msgs = reqs[0:1] + [rep] if self.loopback else reqs + [rep]
-      try:
-        self.write(*msgs)
-      except IOError:  # PIPE broken, most likely
-        break
-
-    self._stopped = True
+      self.write(*msgs)
 
   def request_handler(self, req):
     # close requests don't have a reply, dispatch it immediately
@@ -225,6 +378,11 @@ class DefaultPrinter(BasePrinter):
     self._replies.append(rep)
     self._seen_replies += 1
 
+  def write_reply(self, rep):
+    """ like reply_handler, but writes right away, for when the printer's thread isn't running """
+    self._write_replies((rep,))
+    self._seen_replies += 1
+
   def event_handler(self, evt):
     """ TODO: a queue for this would be good to avoid blocking pcap """
     self.write(evt)
@@ -232,29 +390,29 @@ class DefaultPrinter(BasePrinter):
 
 
 class UnpairedPrinter(BasePrinter):
-  def __init__(self, colors, loopback, output=sys.stdout):
-    super(UnpairedPrinter, self).__init__(colors, loopback, output)
-    self._messages = deque()
+  def __init__(self, colors, loopback, output=sys.stdout, serializer=None):
+    super(UnpairedPrinter, self).__init__(colors, loopback, output, serializer)
+    self._messages = MessageQueue()
 
   @property
   def empty(self):
     """ returns true if nothing is queued """
     return len(self._messages) == 0
 
+  def wakeup(self):
+    self._messages.wakeup()
+
   def run(self):
     self._stopped = False
 
-    while not self._wants_stopped:
-      try:
-        msg = self._messages.popleft()
-      except IndexError:
-        time.sleep(0.0001)
-        continue
-
-      try:
+    try:
+      while not self._wants_stopped:
+        for msg in self._messages.drain():
+          self.write(msg)
+      for msg in self._messages.drain(block=False):
         self.write(msg)
-      except IOError:  # PIPE broken, most likely
-        break
+    except IOError:  # PIPE broken, most likely
+      pass
 
     self._stopped = True
 
@@ -274,7 +432,7 @@ class UnpairedPrinter(BasePrinter):
 def key_of(msg, group_by, depth):
   """ get the msg's attribute to be used as key for grouping """
   if group_by == "path":
-    key = msg.path if depth == 0 else msg.parent_path(depth)
+    key = msg.path if depth == 0 else PATH_CACHE.key(msg.path, depth)
   elif group_by == "type":
     key = msg.name
   elif group_by == "client":
@@ -292,12 +450,13 @@ class CountPrinter(BasePrinter):
     self.count, self.group_by, self.aggregation_depth = count, group_by, aggregation_depth
     self.seen = 0
     self.requests = defaultdict(int)
+    self._done = Event()
 
   def run(self):
     self._stopped = False
 
-    while self.seen < self.count:
-      time.sleep(0.001)
+    while self.seen < self.count and not self._wants_stopped:
+      self._done.wait(0.5)
 
     results = sorted(self.requests.items(), key=lambda item: item[1], reverse=True)
     for res in results:
@@ -328,11 +487,23 @@ class CountPrinter(BasePrinter):
     # this is only called from a single thread.
     self.requests[key] += 1
     self.seen += 1
+    if self.seen >= self.count:
+      self._done.set()
+
+  def wakeup(self):
+    self._done.set()
 
 
 class LatencyPrinter(BasePrinter):
-  """ measures latencies between requests and replies """
-  def __init__(self, count, group_by, loopback, aggregation_depth, sort_by, output=sys.stdout, include_pings=True):
+  """
+  measures latencies between requests and replies
+
+  latencies are kept in fixed memory histograms (see LogHistogram), so percentiles are
+  within 1% of the real ones and memory doesn't grow with count. While collecting, the
+  percentiles so far are printed every progress_secs.
+  """
+  def __init__(self, count, group_by, loopback, aggregation_depth, sort_by, output=sys.stdout,
+               include_pings=True, progress_secs=1.0):
     super(LatencyPrinter, self).__init__(False, loopback, output)
     self._count, self._group_by, self._aggregation_depth = count, group_by, aggregation_depth
     self._sort_by = sort_by
@@ -340,9 +511,11 @@ class LatencyPrinter(BasePrinter):
     # FIXME: accounting pings is broken because their uniqueness is based on timestamps,
     #        so we disable them for tests.
     self._include_pings = include_pings
-    self._latencies_by_group = defaultdict(list)
+    self._latencies_by_group = defaultdict(LogHistogram)
+    self._latencies = LogHistogram()
+    self._progress_secs = progress_secs
     self._requests_by_client = defaultdict(Requests)
-    self._replies = deque()
+    self._replies = MessageQueue()
     self._report_done = False
 
   def run(self):
@@ -352,29 +525,46 @@ class LatencyPrinter(BasePrinter):
     self._stopped = True
 
   def wait_for_requests(self):
-    """ spin until we've collected all requests """
+    """ wait until we've collected all requests """
+    last_progress = 0
     while self._seen < self._count:
-      try:
-        rep = self._replies.popleft()
-      except IndexError:
-        time.sleep(0.001)
-        continue
-
-      # FIXME: this drops extra pings
-      reqs = self._requests_by_client[rep.client].pop(rep.xid)
-      if not reqs:
-        continue
-
-      req = reqs[0]
-      key = key_of(req, self._group_by, self._aggregation_depth)
-      latency = rep.timestamp - req.timestamp
+      # once stopped, only what's already queued is measured
+      replies = self._replies.drain(block=not self._wants_stopped)
+      for rep in replies:
+        # FIXME: this drops extra pings
+        reqs = self._requests_by_client[rep.client].pop(rep.xid)
+        if not reqs:
+          continue
+
+        req = reqs[0]
+        key = key_of(req, self._group_by, self._aggregation_depth)
+        latency = rep.timestamp - req.timestamp
+
+        self._latencies_by_group[key].add(latency)
+        self._latencies.add(latency)
+        self._seen += 1
+
+        # update status
+        now = time.time()
+        if now - last_progress >= self._progress_secs or self._seen == self._count:
+          last_progress = now
+          self._output.write("\rCollecting (%d/%d) %s" % (
+            self._seen, self._count, self.format_progress(self._latencies)))
+          self._output.flush()
+
+        if self._seen >= self._count:
+          break
+
+      if self._wants_stopped:
+        break
 
-      self._latencies_by_group[key].append(latency)
-      self._seen += 1
+  def wakeup(self):
+    self._replies.wakeup()
 
-      # update status
-      self._output.write("\rCollecting (%d/%d)" % (self._seen, self._count))
-      self._output.flush()
+  @staticmethod
+  def format_progress(latencies):
+    p50, p95, p99 = latencies.quantiles((0.5, 0.95, 0.99))
+    return "p50=%.6f p95=%.6f p99=%.6f" % (p50, p95, p99)
 
   def report(self):
     """ calculate & display latencies """
@@ -384,6 +574,7 @@ class LatencyPrinter(BasePrinter):
       return
     if self._seen < self._count:  # force wait_for_requests to finish
       self._seen = self._count
+      self.wakeup()
     self._report_done = True
 
     # clear the line
@@ -392,10 +583,8 @@ class LatencyPrinter(BasePrinter):
     results = {}
     for key, latencies in self._latencies_by_group.items():
       result = {}
-      result["avg"] = sum(latencies) / len(latencies)
-      latencies = sorted(latencies)
-      result["p95"] = percentile(latencies, 0.95)
-      result["p99"] = percentile(latencies, 0.99)
+      result["avg"] = latencies.avg
+      result["p95"], result["p99"] = latencies.quantiles((0.95, 0.99))
       results[key] = result
 
     headers = [self._group_by, "avg", "p95", "p99"]
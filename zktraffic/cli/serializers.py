@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Machine readable output for zk-dump: one record per message, with typed fields
+(see FIELDS), instead of the messages' __str__.
+
+The binary encoding of a record is:
+
+  length    uint32   (of what follows)
+  present   uint8    (bitmask of the optional fields below that are set)
+  timestamp float64
+  xid       int64
+  zxid      int64    (optional, replies & events)
+  size      int32    (optional, requests)
+  error     int32    (optional, replies & events)
+  latency   float64  (optional, paired replies)
+  opcode, client, server, path: each as uint16 length + utf-8 bytes
+
+All in network byte order.
+'''
+
+from json.encoder import encode_basestring_ascii as json_string
+
+import struct
+
+from zktraffic.base.client_message import ConnectRequest
+from zktraffic.base.server_message import ServerMessage
+
+
+FIELDS = ("timestamp", "client", "server", "opcode", "xid", "zxid", "path", "size", "error",
+          "latency")
+
+# optional fields, in the order of their bits in the present mask
+OPTIONAL_FIELDS = ("zxid", "size", "error", "latency")
+
+LENGTH_STRUCT = struct.Struct("!I")
+HEADER_STRUCT = struct.Struct("!Bdqqiid")
+STRING_LENGTH_STRUCT = struct.Struct("!H")
+
+
+def optional_fields(msg):
+  """ (zxid, size, error), None for those that don't apply to the msg """
+  if isinstance(msg, ServerMessage):
+    return msg.zxid, None, msg.error
+
+  # of the requests, only Connect has a zxid (the last one the client saw)
+  return msg.zxid if isinstance(msg, ConnectRequest) else None, msg.size, None
+
+
+def record_of(msg, latency=None):
+  """ a dict of FIELDS, as the serializers write them (missing strings are empty) """
+  zxid, size, error = optional_fields(msg)
+  return {
+    "timestamp": float(msg.timestamp),  # scapy's are Decimals
+    "client": msg.client or "",
+    "server": msg.server or "",
+    "opcode": msg.name,
+    "xid": msg.xid,
+    "zxid": zxid,
+    "path": msg.path or "",
+    "size": size,
+    "error": error,
+    "latency": None if latency is None else float(latency),
+  }
+
+
+JSON_RECORD = (
+  '{"timestamp":%r,"client":%s,"server":%s,"opcode":%s,"xid":%d,"zxid":%s,"path":%s,'
+  '"size":%s,"error":%s,"latency":%s}\n'
+)
+
+
+def json_int(value):
+  return "null" if value is None else "%d" % value
+
+
+class JsonLinesSerializer(object):
+  """
+  a JSON object per line: record_of(msg), formatted by hand since json.dumps() of a
+  record dict is about twice as slow
+  """
+  BINARY = False
+
+  def serialize(self, msg, latency=None):
+    zxid, size, error = optional_fields(msg)
+    return JSON_RECORD % (
+      float(msg.timestamp),
+      json_string(msg.client or ""),
+      json_string(msg.server or ""),
+      json_string(msg.name),
+      msg.xid,
+      json_int(zxid),
+      json_string(msg.path or ""),
+      json_int(size),
+      json_int(error),
+      "null" if latency is None else repr(float(latency)),
+    )
+
+
+def encode_string(value):
+  data = (value or "").encode("utf-8")[:0xffff]
+  return STRING_LENGTH_STRUCT.pack(len(data)) + data
+
+
+class BinarySerializer(object):
+  """ length prefixed records, see the module's docs """
+  BINARY = True
+
+  def serialize(self, msg, latency=None):
+    zxid, size, error = optional_fields(msg)
+
+    present = 0
+    for bit, value in enumerate((zxid, size, error, latency)):
+      if value is not None:
+        present |= 1 << bit
+
+    body = b"".join((
+      HEADER_STRUCT.pack(
+        present,
+        float(msg.timestamp),
+        msg.xid,
+        zxid or 0,
+        size or 0,
+        error or 0,
+        float(latency or 0.0),
+      ),
+      encode_string(msg.name),
+      encode_string(msg.client),
+      encode_string(msg.server),
+      encode_string(msg.path),
+    ))
+
+    return LENGTH_STRUCT.pack(len(body)) + body
+
+
+def read_binary_records(data):
+  """ decodes what BinarySerializer wrote (i.e.: for tooling & tests), yields dicts of FIELDS """
+  offset = 0
+  while offset + LENGTH_STRUCT.size <= len(data):
+    length, = LENGTH_STRUCT.unpack_from(data, offset)
+    offset += LENGTH_STRUCT.size
+    end = offset + length
+
+    present, timestamp, xid, zxid, size, error, latency = HEADER_STRUCT.unpack_from(data, offset)
+    record = {
+      "timestamp": timestamp,
+      "xid": xid,
+      "zxid": zxid,
+      "size": size,
+      "error": error,
+      "latency": latency,
+    }
+    for bit, field in enumerate(OPTIONAL_FIELDS):
+      if not present & (1 << bit):
+        record[field] = None
+
+    offset += HEADER_STRUCT.size
+    for field in ("opcode", "client", "server", "path"):
+      slen, = STRING_LENGTH_STRUCT.unpack_from(data, offset)
+      offset += STRING_LENGTH_STRUCT.size
+      record[field] = data[offset:offset + slen].decode("utf-8")
+      offset += slen
+
+    offset = end
+    yield record
+
+
+TEXT = "text"
+SERIALIZERS = {
+  "json": JsonLinesSerializer,
+  "binary": BinarySerializer,
+}
+OUTPUT_FORMATS = (TEXT,) + tuple(sorted(SERIALIZERS))
@@ -20,8 +20,10 @@ import sys
 import time
 
 from zktraffic import __version__
+from zktraffic.base.capture import CAPTURE_BACKENDS, SCAPY, TPACKET
 from zktraffic.endpoints.stats_server import StatsServer
 from zktraffic.base.process import ProcessOptions
+from zktraffic.base.util import parse_duration
 
 from twitter.common import app, log
 from twitter.common.http import HttpServer
@@ -34,6 +36,17 @@ def setup():
                  metavar="IFACE",
                  default="eth0",
                  help="interface to capture packets from")
+  app.add_option("--capture-backend",
+                 dest="capture_backend",
+                 type="choice",
+                 choices=CAPTURE_BACKENDS,
+                 default=SCAPY,
+                 help="how to capture packets: scapy or tpacket (AF_PACKET TPACKET_V3 ring, Linux only)")
+  app.add_option("--offline",
+                 metavar="FILE",
+                 default=None,
+                 help="read packets from a pcap (or pcapng) file instead of capturing them, "
+                      "then keep serving the stats")
   app.add_option("--http-port",
                  dest="http_port",
                  metavar="HTTPPORT",
@@ -54,7 +67,9 @@ def setup():
                  dest="aggregation_depth",
                  type=int,
                  default=0,
-                 help="aggregate paths up to a certain depth")
+                 help="aggregate paths up to a certain depth. With --path-stats-any-depth "
+                      "that's the default for /json/paths, and other depths can be asked for "
+                      "via ?depth=")
   app.add_option("--max-results",
                  dest="max_results",
                  type=int,
@@ -76,10 +91,15 @@ def setup():
                  type=str,
                  default=None,
                  help="A comma-separated list of CPU cores to pin this process to")
+  app.add_option("--workers",
+                 type=int,
+                 default=1,
+                 help="number of processes capturing & accumulating stats (needs the tpacket backend)")
   app.add_option("--sampling",
                  type=float,
                  default=1.0,
-                 help="Percentage of packets to inspect [0, 1]")
+                 help="Percentage of TCP flows to inspect [0, 1], packets from the rest are "
+                      "dropped by the capture filter")
   app.add_option("--max-queued-requests",
                  type=int,
                  default=400000,
@@ -92,6 +112,51 @@ def setup():
                  type=int,
                  default=400000,
                  help="max queued events")
+  app.add_option("--disable-reassembly", default=False, action='store_true',
+                 help="Assume one ZK message per TCP segment, instead of reassembling TCP streams")
+  app.add_option("--window-bucket-secs",
+                 type=int,
+                 default=60,
+                 help="stats are accumulated in buckets (sub-windows) of this many secs. "
+                      "Smaller buckets (i.e.: --window-bucket-secs 1 --window-buckets 300) "
+                      "allow for finer windows, but each bucket keeps its own tables")
+  app.add_option("--window-buckets",
+                 type=int,
+                 default=2,
+                 help="how many buckets to keep, endpoints can ask for windows up to "
+                      "window-bucket-secs * window-buckets via ?window= (i.e.: 10s, 5m)")
+  app.add_option("--window",
+                 type=str,
+                 default="60s",
+                 help="the window returned by the endpoints when not asked for one (i.e.: 60s, 5m)")
+  app.add_option("--heavy-hitters",
+                 type=int,
+                 default=0,
+                 metavar="N",
+                 help="count only (about) the top N paths per op, in fixed memory (Space-Saving). "
+                      "Counts are overestimated by at most <op>ErrorBound. 0 means exact counts")
+  app.add_option("--path-stats-any-depth", default=False, action='store_true',
+                 help="count exact paths, so /json/paths?depth= can aggregate them to any depth. "
+                      "Takes a counter per distinct path per window bucket (beware of sequential "
+                      "znodes). Can't be used with --heavy-hitters")
+  app.add_option("--path-counts-width",
+                 type=int,
+                 default=0,
+                 metavar="N",
+                 help="serve approximate counts for any path via /json/path?p=<path>, using a "
+                      "Count-Min sketch of 4 x N counters per window bucket (N=2048 takes 64KB "
+                      "per bucket). Counts are overestimated by at most 2.7 * requests / N. "
+                      "0 disables it")
+  app.add_option("--latencies", default=False, action='store_true',
+                 help="pair replies with their requests and serve latency quantiles per op "
+                      "& path via /json/latencies")
+  app.add_option("--zab-port",
+                 type=int,
+                 default=0,
+                 metavar="PORT",
+                 help="also sniff the leader's ZAB (quorum) port and serve each learner's lag "
+                      "(acked vs proposed zxid) and DIFF/TRUNC/SNAP sync times via "
+                      "/json/learners. 0 disables it")
   app.add_option("--exclude-bytes", default=False, action='store_true',
                  help="Exclude stats for bytes per path and request type")
   app.add_option('--version', default=False, action='store_true')
@@ -120,6 +185,44 @@ def main(_, opts):
     sys.stdout.write("--sampling takes values within [0, 1]\n")
     sys.exit(1)
 
+  if opts.workers < 1:
+    sys.stdout.write("--workers must be >= 1\n")
+    sys.exit(1)
+
+  if opts.workers > 1 and opts.capture_backend != TPACKET:
+    sys.stdout.write("--workers > 1 requires --capture-backend=%s\n" % TPACKET)
+    sys.exit(1)
+
+  if opts.offline and (opts.workers > 1 or opts.sampling < 1):
+    sys.stdout.write("--offline can't be used with --workers > 1 or --sampling\n")
+    sys.exit(1)
+
+  if opts.zab_port > 0 and opts.workers > 1:
+    sys.stdout.write("--zab-port can't be used with --workers > 1\n")
+    sys.exit(1)
+
+  if opts.window_bucket_secs < 1 or opts.window_buckets < 1:
+    sys.stdout.write("--window-bucket-secs and --window-buckets must be >= 1\n")
+    sys.exit(1)
+
+  if opts.heavy_hitters < 0:
+    sys.stdout.write("--heavy-hitters must be >= 0\n")
+    sys.exit(1)
+
+  if opts.path_stats_any_depth and opts.heavy_hitters > 0:
+    sys.stdout.write("--path-stats-any-depth can't be used with --heavy-hitters\n")
+    sys.exit(1)
+
+  if opts.path_counts_width < 0:
+    sys.stdout.write("--path-counts-width must be >= 0\n")
+    sys.exit(1)
+
+  try:
+    window = parse_duration(opts.window)
+  except ValueError:
+    sys.stdout.write("Bad --window: %s\n" % opts.window)
+    sys.exit(1)
+
   stats = StatsServer(opts.iface,
                       opts.zookeeper_port,
                       opts.aggregation_depth,
@@ -128,7 +231,19 @@ def main(_, opts):
                       opts.max_queued_replies,
                       opts.max_queued_events,
                       sampling=opts.sampling,
-                      include_bytes=not opts.exclude_bytes)
+                      include_bytes=not opts.exclude_bytes,
+                      capture_backend=opts.capture_backend,
+                      workers=opts.workers,
+                      reassemble=not opts.disable_reassembly,
+                      bucket_secs=opts.window_bucket_secs,
+                      window_buckets=opts.window_buckets,
+                      window=window,
+                      heavy_hitters=opts.heavy_hitters,
+                      path_counts_width=opts.path_counts_width,
+                      latencies=opts.latencies,
+                      offline=opts.offline,
+                      zab_port=opts.zab_port,
+                      any_depth=opts.path_stats_any_depth)
 
   log.info("Starting with opts: %s" % (opts))
 
@@ -139,7 +254,17 @@ def main(_, opts):
   server.mount_routes(stats)
   server.run(opts.http_addr, opts.http_port)
 
-  stats.sniffer.join()
+  if opts.workers > 1:
+    for worker in stats.workers:
+      worker.join()
+  else:
+    stats.sniffer.join()
+
+  if opts.offline:
+    log.info("Done reading %s, still serving stats" % opts.offline)
+    stats.freeze()
+    while True:
+      time.sleep(60)
 
 
 if __name__ == '__main__':
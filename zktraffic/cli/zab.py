@@ -16,14 +16,17 @@
 
 import sys
 
-from .printer import Printer
+from .printer import close_output, Printer, printer_output, stop_printers
 
 from zktraffic import __version__
+from zktraffic.base.capture import CAPTURE_BACKENDS, SCAPY
 from zktraffic.network.sniffer import Sniffer
 from zktraffic.zab.quorum_packet import (
   Ping,
   QuorumPacket
 )
+from zktraffic.zab.latency import ProposalTracker
+from zktraffic.zab.learners import LearnerMonitor
 
 from twitter.common import app
 from twitter.common.log.options import LogOptions
@@ -34,14 +37,28 @@ def setup():
 
   app.add_option('--iface', default='eth0', type=str,
                  help='The interface to sniff on')
+  app.add_option('--capture-backend', default=SCAPY, type='choice', choices=CAPTURE_BACKENDS,
+                 help='How to capture packets: scapy or tpacket (AF_PACKET TPACKET_V3 ring, Linux only)')
   app.add_option('--port', default=2889, type=int,
                  help='The ZAB port used by the leader')
+  app.add_option('--offline', default=None, type=str, metavar='<file>',
+                 help='Read packets from a pcap (or pcapng) file instead of sniffing')
   app.add_option('-c', '--colors', default=False, action='store_true',
                  help='Color each learner/leader stream differently')
   app.add_option('--dump-bad-packet', default=False, action='store_true',
                  help='Dump packets that cannot be deserialized')
   app.add_option('--include-pings', default=False, action='store_true',
                  help='Whether to include pings send from learners to the leader')
+  app.add_option('--measure-latency', default=False, action='store_true',
+                 help='Instead of printing packets, print the quorum & commit latency of each '
+                      'proposal and a table of ack (per follower), quorum & commit latencies '
+                      'when done')
+  app.add_option('--learners', default=False, action='store_true',
+                 help='Instead of printing packets, print each learner sync (DIFF, TRUNC or SNAP) '
+                      'and its duration, and a table of learner lag & sync times when done')
+  app.add_option('--buffered-output', default=False, action='store_true',
+                 help='Buffer output and write it out in batches (every 64KB or 50ms) instead of '
+                      'a line at a time. Ignored for terminals')
   app.add_option('--version', default=False, action='store_true')
 
 
@@ -50,16 +67,49 @@ def main(_, options):
     sys.stdout.write("%s\n" % __version__)
     sys.exit(0)
 
-  skip = None if options.include_pings else lambda msg: isinstance(msg, Ping)
-  printer = Printer(options.colors, output=sys.stdout, skip_print=skip)
-  sniffer = Sniffer(options.iface, options.port, QuorumPacket, printer.add, options.dump_bad_packet)
+  output = printer_output(options.buffered_output)
+  write_line = lambda item: output.write("%s\n" % item)
+
+  analyzers = []  # they have handle() & report()
+  if options.measure_latency:
+    analyzers.append(ProposalTracker(on_commit=write_line))
+  if options.learners:
+    analyzers.append(LearnerMonitor(on_sync=write_line))
+
+  sniffer = Sniffer(options.iface, options.port, QuorumPacket, None, options.dump_bad_packet,
+                    start=False, capture_backend=options.capture_backend)
+  if analyzers:
+    printer = None
+    for analyzer in analyzers:
+      sniffer.add_handler(analyzer.handle)
+  else:
+    skip = None if options.include_pings else lambda msg: isinstance(msg, Ping)
+    printer = Printer(options.colors, output=output, skip_print=skip)
+    sniffer.add_handler(printer.add)
+
+  if not options.offline:
+    sniffer.start()
 
   try:
-    while printer.isAlive():
-      sniffer.join(1)
+    if options.offline:
+      sniffer.run(offline=options.offline)
+      if printer:
+        stop_printers(printer)
+    else:
+      while sniffer.isAlive() and (printer is None or printer.isAlive()):
+        sniffer.join(1)
   except (KeyboardInterrupt, SystemExit):
     pass
 
+  try:
+    for analyzer in analyzers:
+      analyzer.report(output)
+  except IOError: pass
+
+  try:
+    close_output(output)
+  except IOError: pass
+
 
 if __name__ == '__main__':
   setup()
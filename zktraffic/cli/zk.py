@@ -21,13 +21,18 @@ import sys
 import time
 
 from .printer import (
+  close_output,
   CountPrinter,
   LatencyPrinter,
+  printer_output,
+  stop_printers,
   UnpairedPrinter,
   DefaultPrinter
 )
+from .serializers import OUTPUT_FORMATS, SERIALIZERS, TEXT
 
 from zktraffic import __version__
+from zktraffic.base.capture import CAPTURE_BACKENDS, SCAPY
 from zktraffic.base.sniffer import Sniffer, SnifferConfig
 
 from twitter.common.log.options import LogOptions
@@ -40,12 +45,19 @@ def setup():
 
   app.add_option('--iface', default='eth0', type=str, metavar='<iface>',
                  help='The interface to sniff on')
+  app.add_option('--capture-backend', default=SCAPY, type='choice', choices=CAPTURE_BACKENDS,
+                 help='How to capture packets: scapy or tpacket (AF_PACKET TPACKET_V3 ring, Linux only)')
+  app.add_option('--offline', default=None, type=str, metavar='<file>',
+                 help='Read packets from a pcap (or pcapng) file instead of sniffing. '
+                      'Can\'t be used with --include-host or --exclude-host')
   app.add_option('--client-port', default=0, type=int, metavar='<client_port>',
                  help='The client port to filter by')
   app.add_option('--zookeeper-port', default=2181, type=int, metavar='<server_port>',
                  help='The ZooKeeper server port to filter by')
   app.add_option('--max-queued-requests', default=10000, type=int, metavar='<max>',
-                 help='The maximum number of requests queued to be deserialized')
+                 help='The maximum number of requests (across all clients) waiting for replies')
+  app.add_option('--pending-requests-ttl', default=60, type=int, metavar='<secs>',
+                 help='How long a request waits for its reply before being forgotten')
   app.add_option('--exclude-host',
                  dest='excluded_hosts',
                  metavar='<host>',
@@ -68,6 +80,14 @@ def setup():
                  help='Used with --measure-latency. Possible values: avg, p95 and p99')
   app.add_option("--aggregation-depth", default=0, type=int, metavar='<depth>',
                  help="Aggregate paths up to a certain depth. Used with --count-requests or --measure-latency")
+  app.add_option('--reassemble', default=False, action='store_true',
+                 help='Reassemble TCP streams, to handle pipelined requests & multi-segment replies')
+  app.add_option('--buffered-output', default=False, action='store_true',
+                 help='Buffer output and write it out in batches (every 64KB or 50ms) instead of '
+                      'a line at a time. Ignored for terminals')
+  app.add_option('--output-format', default=TEXT, type='choice', choices=OUTPUT_FORMATS,
+                 help='text, json (a JSON object per line) or binary (length prefixed records, '
+                      'see zktraffic.cli.serializers). Used by the default & --unpaired printers')
   app.add_option('--unpaired', default=False, action='store_true',
                  help='Don\'t pair reqs/reps')
   app.add_option('-p', '--include-pings', default=False, action='store_true',
@@ -132,14 +152,22 @@ def main(_, options):
 
   config = SnifferConfig(options.iface)
   config.track_replies = True
+  config.capture_backend = options.capture_backend
   config.zookeeper_port = options.zookeeper_port
   config.max_queued_requests = options.max_queued_requests
+  config.pending_requests_ttl = options.pending_requests_ttl
+  config.reassemble = options.reassemble
   config.client_port = options.client_port if options.client_port != 0 else config.client_port
+  config.offline = options.offline
 
   if options.excluded_hosts and options.included_hosts:
     sys.stderr.write("The flags --include-host and --exclude-host can't be mixed.\n")
     sys.exit(1)
 
+  if options.offline and (options.excluded_hosts or options.included_hosts):
+    sys.stderr.write("--offline can't be used with --include-host or --exclude-host.\n")
+    sys.exit(1)
+
   if options.excluded_hosts:
     config.excluded_ips += expand_hosts(options.excluded_hosts)
   elif options.included_hosts:
@@ -158,21 +186,31 @@ def main(_, options):
     sys.stderr.write("The flags --count-requests and --measure-latency can't be mixed.\n")
     sys.exit(1)
 
+  if options.output_format != TEXT and (options.count_requests > 0 or options.measure_latency > 0):
+    sys.stderr.write("--output-format can't be used with --count-requests or --measure-latency.\n")
+    sys.exit(1)
+
+  serializer_cls = SERIALIZERS.get(options.output_format)
+  serializer = serializer_cls() if serializer_cls else None
+  output = printer_output(
+    options.buffered_output, binary=serializer is not None and serializer.BINARY)
+
   if options.count_requests > 0:
     validate_group_by(options.group_by)
     validate_aggregation_depth(options.aggregation_depth)
-    p = CountPrinter(options.count_requests, options.group_by, loopback, options.aggregation_depth)
+    p = CountPrinter(
+      options.count_requests, options.group_by, loopback, options.aggregation_depth, output)
   elif options.measure_latency > 0:
     validate_group_by(options.group_by)
     validate_aggregation_depth(options.aggregation_depth)
     validate_sort_by(options.sort_by)
     p = LatencyPrinter(
       options.measure_latency, options.group_by, loopback, options.aggregation_depth,
-      options.sort_by)
+      options.sort_by, output)
   elif options.unpaired:
-    p = UnpairedPrinter(options.colors, loopback)
+    p = UnpairedPrinter(options.colors, loopback, output, serializer)
   else:
-    p = DefaultPrinter(options.colors, loopback)
+    p = DefaultPrinter(options.colors, loopback, output, serializer)
   p.start()
 
   sniffer = Sniffer(
@@ -186,7 +224,11 @@ def main(_, options):
 
   try:
     while p.isAlive():
-      time.sleep(0.5)
+      if options.offline and not sniffer.isAlive():
+        # the whole file has been read, so print what's left
+        stop_printers(p)
+        break
+      sniffer.join(0.5)
   except (KeyboardInterrupt, SystemExit):
     p.cancel()
 
@@ -195,6 +237,19 @@ def main(_, options):
   while sniffer.isAlive():
     time.sleep(0.001)
 
+  try:
+    close_output(output)
+  except IOError: pass
+
+  pending = sniffer.pending_requests
+  if pending.evicted or pending.expired or pending.unmatched:
+    sys.stderr.write(
+      "Requests without replies: %d evicted, %d expired; replies without requests: %d\n" % (
+        pending.evicted, pending.expired, pending.unmatched))
+
+  if serializer is not None:
+    return
+
   try:
     sys.stdout.write("\033[0m")
     sys.stdout.flush()
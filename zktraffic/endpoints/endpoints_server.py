@@ -15,6 +15,7 @@
 # ==================================================================================================
 
 
+from zktraffic.base.capture import SCAPY
 from zktraffic.base.sniffer import Sniffer, SnifferConfig
 
 from twitter.common.http import HttpServer
@@ -25,11 +26,18 @@ class EndpointsServer(HttpServer):
 
   def __init__(
       self, iface, zkport, request_handler,
-      reply_handler=None, event_handler=None, start_sniffer=True, sampling=1.0):
+      reply_handler=None, event_handler=None, start_sniffer=True, sampling=1.0,
+      capture_backend=SCAPY, reassemble=False, lazy_decode=False, track_replies=False,
+      offline=None):
     config = SnifferConfig(iface=iface)
     config.zookeeper_port = zkport
-    config.update_filter()
     config.sampling = sampling
+    config.update_filter()
+    config.capture_backend = capture_backend
+    config.reassemble = reassemble
+    config.lazy_decode = lazy_decode
+    config.track_replies = track_replies
+    config.offline = offline
 
     self._sniffer = Sniffer(config, request_handler, reply_handler, event_handler)
 
@@ -15,21 +15,63 @@
 # ==================================================================================================
 
 
+from functools import partial
+from threading import Thread
+
 import multiprocessing
 
+from zktraffic.base.capture import SCAPY
 from zktraffic.base.process import ProcessOptions
+from zktraffic.base.util import parse_duration, PATH_CACHE
 from zktraffic.stats.loaders import QueueStatsLoader
 from zktraffic.stats.accumulators import (
+  LatencyStatsAccumulator,
+  PathCountsAccumulator,
   PerAuthStatsAccumulator,
   PerIPStatsAccumulator,
   PerPathStatsAccumulator,
+  PerPathTrieStatsAccumulator,
 )
+from zktraffic.stats.workers import StatsWorkerPool
+from zktraffic.network.sniffer import Sniffer as ZabSniffer
+from zktraffic.zab.learners import LearnerMonitor
+from zktraffic.zab.quorum_packet import QuorumPacket
 
 from .endpoints_server import EndpointsServer
 
 from twitter.common.http import HttpServer
 
 
+def stats_accumulators(aggregation_depth, include_bytes, window_buckets=1, capacity=0,
+                       path_counts_width=0, latencies=False, any_depth=False):
+  """
+  capacity > 0 means approximate (but fixed memory) counting, see SpaceSaving.
+
+  any_depth counts exact paths so per_path stats can be had for any depth (see
+  PerPathTrieStatsAccumulator), at the cost of a counter per distinct path per bucket.
+  Otherwise paths are aggregated to aggregation_depth as they are counted
+
+  path_counts_width > 0 enables counts for any path, see PathCountsAccumulator
+
+  latencies enables latency histograms, see LatencyStatsAccumulator
+  """
+  per_path_cls = PerPathTrieStatsAccumulator if any_depth else PerPathStatsAccumulator
+  accumulators = {
+    'per_path': per_path_cls(aggregation_depth, include_bytes, window_buckets, capacity),
+    'per_ip': PerIPStatsAccumulator(aggregation_depth, include_bytes, window_buckets, capacity),
+    'per_auth': PerAuthStatsAccumulator(aggregation_depth, include_bytes, window_buckets, capacity),
+  }
+
+  if path_counts_width > 0:
+    accumulators['path_counts'] = PathCountsAccumulator(
+      path_counts_width, window_buckets=window_buckets)
+
+  if latencies:
+    accumulators['latencies'] = LatencyStatsAccumulator(aggregation_depth, window_buckets)
+
+  return accumulators
+
+
 class StatsServer(EndpointsServer):
   def __init__(self,
                iface,
@@ -42,22 +84,102 @@ class StatsServer(EndpointsServer):
                start_sniffer=True,
                timer=None,
                sampling=1.0,
-               include_bytes=True):
+               include_bytes=True,
+               capture_backend=SCAPY,
+               workers=1,
+               reassemble=False,
+               lazy_decode=True,
+               bucket_secs=60,
+               window_buckets=1,
+               window=None,
+               heavy_hitters=0,
+               path_counts_width=0,
+               latencies=False,
+               offline=None,
+               zab_port=0,
+               any_depth=False):
+    """
+    stats are accumulated into window_buckets buckets of bucket_secs each, and the
+    endpoints return the last window secs (all the buckets, if None) unless they are
+    asked for a different ?window=
+
+    if heavy_hitters > 0, only (about) that many paths per op are counted (see SpaceSaving)
+
+    if path_counts_width > 0, /json/path?p= returns (approximate) counts for any path
+    (see PathCountsAccumulator)
+
+    if latencies, replies are paired with their requests and /json/latencies returns
+    latency quantiles per op & path (see LatencyStatsAccumulator)
+
+    if offline is a pcap (or pcapng) file, packets are read from it instead of captured,
+    into a single bucket which is kept once freeze() is called (i.e.: when the read is done)
+
+    if any_depth, /json/paths?depth= can aggregate paths to any depth (see
+    PerPathTrieStatsAccumulator). Not available with heavy_hitters > 0
+
+    if zab_port > 0, the leader's ZAB traffic on that port is sniffed too and /json/learners
+    returns each learner's lag & syncs (see LearnerMonitor). Not available with workers > 1
+    """
 
     # Forcing a load of the multiprocessing module here
     # seem to be hitting http://bugs.python.org/issue8200
     multiprocessing.current_process().name
 
     self._max_results = max_results
+    self._window = window
+    self._path_counts = path_counts_width > 0
+    self._latencies = latencies
+    self._zab_sniffer = None
+
+    accumulators_factory = partial(
+      stats_accumulators, aggregation_depth, include_bytes, window_buckets, heavy_hitters,
+      path_counts_width, latencies, any_depth)
+
+    if any_depth and heavy_hitters > 0:
+      raise ValueError("Heavy hitters can't be aggregated to other depths")
+
+    if workers > 1 and zab_port > 0:
+      raise ValueError("Learner stats aren't available with more than 1 worker")
+
+    if workers > 1:
+      # each worker runs its own sniffer, so ours is never started
+      super(StatsServer, self).__init__(
+        iface,
+        zkport,
+        None,
+        start_sniffer=False,
+        sampling=sampling,
+        capture_backend=capture_backend,
+        reassemble=reassemble,
+        lazy_decode=lazy_decode,
+        track_replies=latencies)
 
-    self._stats = QueueStatsLoader(max_reqs, max_reps, max_events, timer)
+      self._stats = StatsWorkerPool(
+        workers, self.sniffer.config, accumulators_factory, max_reqs, max_reps, max_events,
+        bucket_secs, window_buckets)
+      if start_sniffer:  # pragma: no cover
+        self._stats.start()
+      return
 
-    self._stats.register_accumulator(
-      'per_path', PerPathStatsAccumulator(aggregation_depth, include_bytes))
-    self._stats.register_accumulator(
-      'per_ip', PerIPStatsAccumulator(aggregation_depth, include_bytes))
-    self._stats.register_accumulator(
-      'per_auth', PerAuthStatsAccumulator(aggregation_depth, include_bytes))
+    self._stats = QueueStatsLoader(
+      max_reqs, max_reps, max_events, timer, bucket_secs=bucket_secs, offline=bool(offline))
+
+    for name, accumulator in accumulators_factory().items():
+      self._stats.register_accumulator(name, accumulator)
+
+    if zab_port > 0:
+      learners = LearnerMonitor(window_buckets)
+      self._stats.register_accumulator('learners', learners)
+      self._zab_sniffer = ZabSniffer(
+        iface, zab_port, QuorumPacket, learners.handle, start=False,
+        capture_backend=capture_backend)
+      if start_sniffer:  # pragma: no cover
+        if offline:
+          reader = Thread(target=self._zab_sniffer.run, kwargs={"offline": offline})
+          reader.setDaemon(True)
+          reader.start()
+        else:
+          self._zab_sniffer.start()
 
     self._stats.start()
 
@@ -68,17 +190,37 @@ class StatsServer(EndpointsServer):
       self._stats.handle_reply,
       self._stats.handle_event,
       start_sniffer,
-      sampling=sampling)
+      sampling=sampling,
+      capture_backend=capture_backend,
+      reassemble=reassemble,
+      lazy_decode=lazy_decode,
+      track_replies=latencies,
+      offline=offline)
 
   def wakeup(self):
     self._stats.wakeup()
 
+  def freeze(self):
+    """ keeps the stats as they are, i.e.: once the offline pcap has been read """
+    self._stats.freeze()
+
+  @property
+  def zab_sniffer(self):
+    """ the sniffer for the leader's ZAB port, if learner stats are enabled """
+    return self._zab_sniffer
+
+  @property
+  def workers(self):
+    """ the worker processes, if running with more than one """
+    return self._stats.workers if isinstance(self._stats, StatsWorkerPool) else []
+
   @property
   def has_stats(self):
     return len(self._get_stats('per_path')) > 0
 
-  def _get_stats(self, name, prefix=''):
-    stats_by_opname = self._stats.stats(name, self._max_results)
+  def _get_stats(self, name, prefix='', window=None, depth=None):
+    stats_by_opname = self._stats.stats(
+      name, self._max_results, window or self._window, depth)
 
     stats = {}
     for opname, opstats in stats_by_opname.items():
@@ -87,17 +229,80 @@ class StatsServer(EndpointsServer):
 
     return stats
 
+  def _requested_window(self):
+    """ the window asked for via ?window= (i.e.: 10s, 5m), if any """
+    window = HttpServer.request.query.get('window')
+    if window is None:
+      return None
+
+    try:
+      return parse_duration(window)
+    except ValueError:
+      HttpServer.abort(400, "Bad window: %s" % window)
+
+  def _requested_depth(self):
+    """ the aggregation depth asked for via ?depth=, if any """
+    depth = HttpServer.request.query.get('depth')
+    if depth is None:
+      return None
+
+    try:
+      depth = int(depth)
+      if depth < 0:
+        raise ValueError("negative depth")
+    except ValueError:
+      HttpServer.abort(400, "Bad depth: %s" % depth)
+
+    return depth
+
   @HttpServer.route("/json/paths")
   def json_paths(self):
-    return self._get_stats('per_path')
+    window = self._requested_window()
+    depth = self._requested_depth()
+    try:
+      return self._get_stats('per_path', window=window, depth=depth)
+    except ValueError as ex:
+      HttpServer.abort(400, str(ex))
 
   @HttpServer.route("/json/ips")
   def json_ips(self):
-    return self._get_stats('per_ip', 'per_ip/')
+    return self._get_stats('per_ip', 'per_ip/', self._requested_window())
 
   @HttpServer.route("/json/auths")
   def json_auths(self):
-    return self._get_stats('per_auth', 'per_auth/')
+    return self._get_stats('per_auth', 'per_auth/', self._requested_window())
+
+  @HttpServer.route("/json/path")
+  def json_path(self):
+    """ per op counts for the path given via ?p= """
+    if not self._path_counts:
+      HttpServer.abort(404, "Path counts are disabled")
+
+    path = HttpServer.request.query.get('p')
+    if not path or not path.startswith('/'):
+      HttpServer.abort(400, "Bad path: %s" % path)
+
+    window = self._requested_window() or self._window
+    counts = self._stats.counts('path_counts', path, window)
+    return dict(("%s%s" % (opname, path), count) for opname, count in counts.items())
+
+  @HttpServer.route("/json/latencies")
+  def json_latencies(self):
+    """ latency quantiles (in secs) per op & for the busiest paths """
+    if not self._latencies:
+      HttpServer.abort(404, "Latencies are disabled")
+
+    window = self._requested_window() or self._window
+    return self._stats.stats('latencies', self._max_results, window)
+
+  @HttpServer.route("/json/learners")
+  def json_learners(self):
+    """ the leader's last proposed zxid, each learner's lag and sync times per mode """
+    if self._zab_sniffer is None:
+      HttpServer.abort(404, "Learner stats are disabled")
+
+    window = self._requested_window() or self._window
+    return self._stats.stats('learners', self._max_results, window)
 
   @HttpServer.route("/json/auths-dump")
   def json_auths_dump(self):
@@ -108,5 +313,11 @@ class StatsServer(EndpointsServer):
     """ general info about this instance """
     proc = ProcessOptions()
     return {
-      "uptime": proc.uptime
+      "uptime": proc.uptime,
+      # this process' (each worker has its own)
+      "path_cache": {
+        "size": len(PATH_CACHE),
+        "hits": PATH_CACHE.hits,
+        "misses": PATH_CACHE.misses,
+      },
     }
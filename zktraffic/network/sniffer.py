@@ -18,6 +18,7 @@ from __future__ import print_function
 from collections import defaultdict
 from threading import Thread
 
+import dpkt
 import hexdump
 import logging
 import os
@@ -26,11 +27,13 @@ import socket
 import struct
 import sys
 
-from zktraffic.base.network import BadPacket, get_ip, get_ip_packet, SnifferBase
+from zktraffic.base.capture import SCAPY, TPACKET, TPacketV3Capture, validate_capture_backend
+from zktraffic.base.network import BadPacket, decode_packet, packet_addrs, SnifferBase
+from zktraffic.base.pcap import PcapError, PcapReader
+from zktraffic.base.reassembly import StreamReassembler
 
 from scapy.sendrecv import sniff
 from scapy.config import conf as scapy_conf
-from six.moves import intern
 
 
 scapy_conf.logLevel = logging.ERROR  # shush scappy
@@ -42,10 +45,15 @@ MAX_PACKET_SIZE = 65535
 class Sniffer(SnifferBase):
   """
   A generic & simple packet sniffer
+
+  If msg_cls knows how to tell its messages apart in a byte stream (i.e.: QuorumPacket,
+  see frame_length) TCP streams are reassembled, so a segment can carry many messages
+  (or part of one). Otherwise, it's one message per segment.
   """
   class RegistrationError(Exception): pass
 
-  def __init__(self, iface, port, msg_cls, handler=None, dump_bad_packet=False, start=True):
+  def __init__(self, iface, port, msg_cls, handler=None, dump_bad_packet=False, start=True,
+               capture_backend=SCAPY):
     super(Sniffer, self).__init__()
     self.setDaemon(True)
 
@@ -56,6 +64,10 @@ class Sniffer(SnifferBase):
     self._handlers = []
     self._dump_bad_packet = dump_bad_packet
     self._is_loopback = iface in ["lo", "lo0"]
+    self._capture_backend = capture_backend
+    frame_length = getattr(msg_cls, "frame_length", None)
+    self._reassembler = StreamReassembler(
+      frame_length=frame_length) if frame_length is not None else None
 
     if handler is not None:
       self.add_handler(handler)
@@ -75,35 +87,46 @@ class Sniffer(SnifferBase):
   def run(self, *args, **kwargs):
     pfilter = "port %d" % self._port
     try:
+      if "offline" in kwargs:
+        reader = PcapReader(kwargs["offline"])
+        self._is_loopback = reader.is_loopback
+        reader.run(self.handle_packet)
+        return
+
+      if validate_capture_backend(self._capture_backend) == TPACKET:
+        TPacketV3Capture(self._iface, pfilter).run(self.handle_packet)  # pragma: no cover
+        return  # pragma: no cover
+
       sniff_kwargs = {"filter": pfilter, "store": 0, "prn": self.handle_packet}
       if self._iface != "any":
         sniff_kwargs["iface"] = self._iface
 
-      if "offline" in kwargs:
-        sniff_kwargs["offline"] = kwargs["offline"]
-
       sniff(**sniff_kwargs)
     except socket.error as ex:
       sys.stderr.write("Error: %s, device: %s\n" % (ex, self._iface))
+    except (IOError, OSError, PcapError) as ex:
+      sys.stderr.write("Error: %s, file: %s\n" % (ex, kwargs.get("offline")))
     finally:
       if "offline" not in kwargs:
         os.kill(os.getpid(), signal.SIGINT)
 
   def handle_packet(self, packet):
     try:
-      message = self.message_from_packet(packet)
-      if message:
+      for message in self.messages_from_packet(packet):
         self.handle_message(message)
     except (BadPacket, struct.error) as ex:
-      if self._dump_bad_packet:
-        print("got: %s" % str(ex))
-        hexdump.hexdump(packet.load)
-        sys.stdout.flush()
+      self._bad_packet(ex, packet.load)
     except Exception as ex:
       print("got: %s" % str(ex))
       hexdump.hexdump(packet.load)
       sys.stdout.flush()
 
+  def _bad_packet(self, ex, data):
+    if self._dump_bad_packet:
+      print("got: %s" % str(ex))
+      hexdump.hexdump(data)
+      sys.stdout.flush()
+
   def handle_message(self, message):
     for h in self._handlers:
       h(message)
@@ -116,16 +139,47 @@ class Sniffer(SnifferBase):
       :exc:`DeserializationError` if deserialization failed
       :exc:`struct.error` if deserialization failed
     """
-    ip_p = get_ip_packet(packet.load, 0, self._port, self._is_loopback)
+    ip_p = decode_packet(packet, 0, self._port, self._is_loopback)
     if 0 == len(ip_p.data.data):
       return None
 
     if ip_p.data.sport != self._port and ip_p.data.dport != self._port:
       raise BadPacket("Wrong port")
 
-    return self._msg_cls.from_payload(
-      ip_p.data.data,
-      intern("%s:%s" % (get_ip(ip_p, ip_p.src), ip_p.data.sport)),
-      intern("%s:%s" % (get_ip(ip_p, ip_p.dst), ip_p.data.dport)),
-      packet.time
-    )
+    src, dst = packet_addrs(packet, ip_p)
+    return self._msg_cls.from_payload(ip_p.data.data, src, dst, packet.time)
+
+  def messages_from_packet(self, packet):
+    """
+    Like message_from_packet, but TCP payloads go through the stream reassembler first
+    (if there's one). So a packet might carry no messages or many.
+
+    Frames that can't be deserialized are reported as bad packets and skipped.
+
+    :returns: Returns a list of Message
+    """
+    if self._reassembler is None:
+      message = self.message_from_packet(packet)
+      return [message] if message else []
+
+    ip_p = decode_packet(packet, 0, self._port, self._is_loopback)
+    tcp_p = ip_p.data
+    if tcp_p.sport != self._port and tcp_p.dport != self._port:
+      raise BadPacket("Wrong port")
+
+    src, dst = packet_addrs(packet, ip_p)
+    key = (src, dst)
+    try:
+      frames = self._reassembler.add(key, tcp_p.seq, tcp_p.data, tcp_p.flags & dpkt.tcp.TH_SYN)
+    finally:
+      if tcp_p.flags & (dpkt.tcp.TH_FIN | dpkt.tcp.TH_RST):
+        self._reassembler.close(key)
+
+    messages = []
+    for frame in frames:
+      try:
+        messages.append(self._msg_cls.from_payload(frame, src, dst, packet.time))
+      except (BadPacket, struct.error) as ex:
+        self._bad_packet(ex, frame)
+
+    return messages
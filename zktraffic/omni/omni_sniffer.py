@@ -27,10 +27,16 @@ import sys
 import time
 import traceback
 
-from scapy.packet import Raw, Packet
 from scapy.sendrecv import sniff
 
-from zktraffic.base.network import BadPacket, get_ip, get_ip_packet, SnifferBase
+from zktraffic.base.capture import (
+  SCAPY,
+  TPACKET,
+  TPacketV3Capture,
+  validate_capture_backend,
+)
+from zktraffic.base.network import BadPacket, PacketContext, peek_flow, SnifferBase
+from zktraffic.base.pcap import PcapError, PcapReader
 from zktraffic.base.sniffer import Sniffer as ZKSniffer
 from zktraffic.base.util import read_long, read_string, QuorumConfig
 from zktraffic.network.sniffer import Sniffer
@@ -38,14 +44,93 @@ import zktraffic.fle.message as FLE
 import zktraffic.zab.quorum_packet as ZAB
 
 
+IGNORED = "ignored"  # flows that aren't ZK, ZAB or FLE
+
+
+def quorum_filter(pfilter, ports):
+  """ the pcap filter, restricted to the given ports """
+  return "(%s) and (%s)" % (pfilter, " or ".join("port %d" % port for port in sorted(ports)))
+
+
+def check_tcp_seq(last_tcp_seq, packet):
+  """
+  check tcp seq duplicates
+  NOTE: TX/RX duplicate happens on loopback interfaces
+  :param last_tcp_seq: dict[flow, int], the last seq seen per flow
+  :param packet: PacketContext
+  :return: None
+  """
+  tcp = packet.tcp
+  flow = packet.flow
+  if tcp.flags & dpkt.tcp.TH_RST:
+    if flow in last_tcp_seq:
+      del last_tcp_seq[flow]
+  else:
+    if not tcp.data: raise BadPacket("no payload")
+    if flow in last_tcp_seq:
+      last_seq = last_tcp_seq[flow]
+      if tcp.seq <= last_seq:
+        # this exception eliminates dups
+        raise BadPacket("This sequence(%d<=%d) seen before" % (tcp.seq, last_seq))
+    last_tcp_seq[flow] = tcp.seq
+
+
+class FlowCache(object):
+  """
+  Maps flows (see PacketContext.flow) to the sniffer for them, or to IGNORED if they
+  aren't for a known port and didn't start with an FLE initial message.
+
+  Bounded, with the same (approximate) LRU eviction as PathCache: when the newest
+  generation is full it becomes the old one and the old one is dropped.
+  """
+
+  def __init__(self, max_size=65536):
+    self._max_size = max_size
+    self._new = {}
+    self._old = {}
+
+  def __len__(self):
+    return len(self._new) + len(self._old)
+
+  def get(self, flow):
+    value = self._new.get(flow)
+    if value is None:
+      value = self._old.pop(flow, None)
+      if value is not None:
+        self.put(flow, value)
+    return value
+
+  def put(self, flow, value):
+    if len(self._new) >= self._max_size:
+      self._old = self._new
+      self._new = {}
+    self._new[flow] = value
+
+  def clear(self):
+    self._new = {}
+    self._old = {}
+
+
 class OmniSniffer(SnifferBase):
+  """
+  Finds the quorum by looking at FLE traffic and sniffs its FLE, ZAB & ZK ports.
+
+  If auto_filter, once the quorum's ports are known (from an FLE notification) the capture
+  filter is narrowed to them so the rest of the traffic is dropped by the kernel. This is
+  only possible with the tpacket backend.
+  """
+
   def __init__(self,
                fle_sniffer_factory,
                zab_sniffer_factory,
                zk_sniffer_factory,
                pfilter="tcp",
                dump_bad_packet=False,
-               start=True):
+               start=True,
+               iface="any",
+               capture_backend=SCAPY,
+               auto_filter=True,
+               max_flows=65536):
     super(OmniSniffer, self).__init__()
     self.setDaemon(True)
 
@@ -55,28 +140,48 @@ class OmniSniffer(SnifferBase):
     self._sniffers = {}  # dict[(str,int), SnifferBase]
 
     self._pfilter = pfilter
+    self._iface = iface
+    self._capture_backend = capture_backend
     self._dump_bad_packet = dump_bad_packet
-    self._last_tcp_seq = {}  # dict[((str,int),(str,int)), int]
+    self._last_tcp_seq = {}  # dict[flow, int]
+    self._flows = FlowCache(max_flows)
+    self._auto_filter = auto_filter
+    self._filter_ports = frozenset()
+    self._capture = None
 
     if start:  # pragma: no cover
       self.start()
 
   def run(self, *args, **kwargs):
     try:
-      sniff_kwargs = {"filter": self._pfilter, "store": 0, "prn": self.handle_packet}
-
       if "offline" in kwargs:
-        sniff_kwargs["offline"] = kwargs["offline"]
+        # the packet filter isn't applied, non TCP packets are dropped as bad packets
+        PcapReader(kwargs["offline"]).run(self.handle_packet)
+        return
+
+      if validate_capture_backend(self._capture_backend) == TPACKET:
+        self._capture = TPacketV3Capture(self._iface, self._pfilter)  # pragma: no cover
+        self._capture.run(self.handle_packet)  # pragma: no cover
+        return  # pragma: no cover
 
-      sniff(**sniff_kwargs)
+      sniff(filter=self._pfilter, store=0, prn=self.handle_packet)
     except socket.error as ex:
       sys.stderr.write("Error: %s, filter: %s\n" % (ex, self._pfilter))
+    except (IOError, OSError, PcapError) as ex:
+      sys.stderr.write("Error: %s, file: %s\n" % (ex, kwargs.get("offline")))
     finally:
       if "offline" not in kwargs:
         os.kill(os.getpid(), signal.SIGINT)
 
   def handle_packet(self, packet):
+    # most traffic isn't ours, drop it before decoding it
+    flow = peek_flow(packet.load)
+    if flow is not None and self._flows.get(flow) is IGNORED:
+      return
+
     try:
+      # decode once, the sniffer for the packet's port reuses it
+      packet = PacketContext(packet)
       message = self.message_from_packet(packet)
       sniffer = self._find_sniffer_for_packet(packet)
       sniffer.handle_message(message)
@@ -100,9 +205,15 @@ class OmniSniffer(SnifferBase):
   def message_from_packet(self, packet):
     """
 
-    :param packet: scapy.packet.Packet
+    :param packet: a captured packet (i.e.: scapy.packet.Packet) or a PacketContext
     :return: message
     """
+    if type(packet) is not PacketContext:
+      packet = PacketContext(packet)
+
+    if self._flows.get(packet.flow) is IGNORED:
+      raise BadPacket("Not a ZK, ZAB or FLE flow")
+
     self._check_packet(packet)
 
     message = self._dispatch_message_from_packet(packet)
@@ -117,22 +228,23 @@ class OmniSniffer(SnifferBase):
       self._setup_on_fle_initial(packet, message)
       return message
 
+    # FLE connections start with an initial message, so this flow isn't interesting
+    # (unless its ports show up in a quorum config later, see _regist_sniffer)
+    self._flows.put(packet.flow, IGNORED)
+    self._last_tcp_seq.pop(packet.flow, None)
     raise BadPacket("Unknown packet")
 
-  def _parse_packet_src_dst(self, packet):
-    assert isinstance(packet, Packet)
-    ip_p = get_ip_packet(packet.load)
-    src = (get_ip(ip_p, ip_p.src), ip_p.data.sport)
-    dst = (get_ip(ip_p, ip_p.dst), ip_p.data.dport)
-    ret = (src, dst)
-    return ret
-
   def _find_sniffer_for_packet(self, packet):
-    sniffer = None
-    src, dst = self._parse_packet_src_dst(packet)
-    if src in self._sniffers: sniffer = self._sniffers[src]
-    if dst in self._sniffers: sniffer = self._sniffers[dst]
-    assert sniffer is None or isinstance(sniffer, SnifferBase)
+    sniffer = self._flows.get(packet.flow)
+    if sniffer is None:
+      sniffer = self._sniffers.get(packet.dst) or self._sniffers.get(packet.src)
+      if sniffer is None:
+        return None
+      self._flows.put(packet.flow, sniffer)
+    elif sniffer is IGNORED:
+      return None
+
+    assert isinstance(sniffer, SnifferBase)
     return sniffer
 
   def _dispatch_message_from_packet(self, packet):
@@ -145,37 +257,13 @@ class OmniSniffer(SnifferBase):
     return message
 
   def _fle_message_from_packet(self, packet):
-    src, dst = self._parse_packet_src_dst(packet)
-    data = get_ip_packet(packet.load).data.data
-    message = FLE.Message.from_payload(data,
-                                       '%s:%d' % (src[0], src[1]),
-                                       '%s:%d' % (dst[0], dst[1]),
-                                       time.time())
-    return message
+    return FLE.Message.from_payload(packet.data, packet.src_addr, packet.dst_addr, time.time())
 
   def _check_packet(self, packet):
-    """
-    check tcp seq duplicates
-    NOTE: TX/RX duplicate happens on loopback interfaces
-    :param packet:
-    :return: None
-    """
-    src, dst = self._parse_packet_src_dst(packet)
-    tcp = get_ip_packet(packet.load).data
-    if tcp.flags & dpkt.tcp.TH_RST:
-      if (src, dst) in self._last_tcp_seq:
-        del self._last_tcp_seq[(src, dst)]
-    else:
-      if not tcp.data: raise BadPacket("no payload")
-      if (src, dst) in self._last_tcp_seq:
-        last_seq = self._last_tcp_seq[(src, dst)]
-        if tcp.seq <= last_seq:
-          # this exception eliminates dups
-          raise BadPacket("This sequence(%d<=%d) seen before" % (tcp.seq, last_seq))
-      self._last_tcp_seq[(src, dst)] = tcp.seq
+    check_tcp_seq(self._last_tcp_seq, packet)
 
   def _is_packet_fle_initial(self, packet):
-    data = get_ip_packet(packet.load).data.data
+    data = packet.data
 
     proto, offset = read_long(data, 0)
     if proto != FLE.Initial.PROTO_VER: return False
@@ -198,8 +286,7 @@ class OmniSniffer(SnifferBase):
     :param message:
     """
     assert isinstance(message, FLE.Initial)
-    src, dst = self._parse_packet_src_dst(packet)
-    self._regist_sniffer(dst[0], dst[1], 'fle')
+    self._regist_sniffer(packet.dst[0], packet.dst[1], 'fle')
 
   def _setup_on_fle_notification(self, packet, message):
     """
@@ -208,7 +295,7 @@ class OmniSniffer(SnifferBase):
     :param message:
     """
     assert isinstance(message, FLE.Notification)
-    src, dst = self._parse_packet_src_dst(packet)
+    src, dst = packet.src, packet.dst
     config = QuorumConfig(message.config)
     servers = [x for x in config.entries if isinstance(x, QuorumConfig.Server)]
     for server in servers:
@@ -233,6 +320,18 @@ class OmniSniffer(SnifferBase):
       self._regist_sniffer(zab_fle_ip, server.zab_port, 'zab')
       self._regist_sniffer(zk_ip, server.zk_port, 'zk')
 
+    if self._auto_filter and self._capture is not None:  # pragma: no cover
+      self._update_filter()
+
+  def _update_filter(self):
+    """ narrow the capture filter to the ports we know about, if there are new ones """
+    ports = frozenset(port for _, port in self._sniffers)
+    if ports == self._filter_ports:
+      return
+
+    self._filter_ports = ports
+    self._capture.set_filter(quorum_filter(self._pfilter, ports))
+
   def _regist_sniffer(self, ip, port, type):
     if (ip, port) in self._sniffers:
       current_sniffer = self._sniffers[(ip, port)]
@@ -251,6 +350,9 @@ class OmniSniffer(SnifferBase):
     print('OMNI DUMP REGISTERED SNIFFER %s(%s) (%s,%d)' % (sniffer, type, ip, port))
     self._sniffers[(ip, port)] = sniffer
 
+    # flows for this port might have been ignored
+    self._flows.clear()
+
   def _get_sniffer_type(self, sniffer):
     if isinstance(sniffer, Sniffer):
       if sniffer._msg_cls == FLE.Message:
@@ -0,0 +1,451 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+'''
+Runs the ZAB & ZK decoders (and their printers) for zk-omni-dump in worker processes, so
+a busy ZAB stream doesn't starve the decoding of client traffic (or vice versa).
+
+The sniffer's process keeps finding the quorum (FLE is decoded there), but ZAB & ZK frames
+are only classified by their flow and shipped, in batches, to the worker for their protocol.
+There are N workers per protocol and a flow always goes to the same one (picked by its peer,
+i.e.: the client or the learner), so requests & replies get paired and dups get dropped.
+
+Workers send back what their printers wrote, tagged with the time of the packet that got it
+written, along with a watermark: the time of the newest packet dispatched when their batch
+was sent. Everything a worker writes afterwards is newer, so the MergeWriter writes records
+once they are older than every source's watermark, in timestamp order.
+'''
+
+from heapq import heappop, heappush
+from threading import Lock, Thread
+
+import hexdump
+import multiprocessing
+import signal
+import struct
+import sys
+import time
+import traceback
+
+from zktraffic.base.capture import RawPacket
+from zktraffic.base.network import BadPacket, PacketContext, peek_flow
+from zktraffic.base.sniffer import Sniffer as ZKSniffer, SnifferConfig as ZKSnifferConfig
+from zktraffic.base.util import StringTooLong
+from zktraffic.base.zookeeper import DeserializationError
+from zktraffic.cli.printer import DefaultPrinter as ZKDefaultPrinter, Printer
+from zktraffic.network.sniffer import Sniffer
+import zktraffic.zab.quorum_packet as ZAB
+
+from .omni_sniffer import check_tcp_seq, FlowCache, IGNORED, OmniSniffer
+
+
+PROTOCOLS = ('zab', 'zk')
+PARENT = 'omni'  # the source id for what's written by the sniffer's process (i.e.: FLE)
+
+
+class RecordOutput(object):
+  """
+  A file-like for printers: what's written is kept as (timestamp, text) records, with
+  the timestamp of the packet being handled.
+  """
+
+  def __init__(self):
+    self.timestamp = 0.0
+    self._records = []
+    self._lock = Lock()
+
+  def write(self, data):
+    with self._lock:
+      self._records.append((self.timestamp, data))
+
+  def flush(self):
+    pass
+
+  def take(self):
+    """ returns (& forgets) what's been written so far """
+    with self._lock:
+      records, self._records = self._records, []
+    return records
+
+
+class ProtocolDecoder(object):
+  """ decodes & prints the frames for one protocol, with a sniffer per port """
+
+  def __init__(self, protocol, output, colors=False, include_pings=False, dump_bad_packet=False):
+    if protocol not in PROTOCOLS:
+      raise ValueError('Unknown protocol %s' % protocol)
+
+    self._protocol = protocol
+    self._output = output
+    self._include_pings = include_pings
+    self._dump_bad_packet = dump_bad_packet
+    self._sniffers = {}  # dict[int, SnifferBase]
+    self._last_tcp_seq = {}  # dict[flow, int]
+
+    if protocol == 'zab':
+      skip_print = None if include_pings else lambda msg: isinstance(msg, ZAB.Ping)
+      self._printer = Printer(colors, output=output, skip_print=skip_print, start=False)
+    else:
+      self._printer = ZKDefaultPrinter(colors, loopback=False, output=output)
+
+  def _sniffer_for(self, port):
+    sniffer = self._sniffers.get(port)
+    if sniffer is not None:
+      return sniffer
+
+    if self._protocol == 'zab':
+      sniffer = Sniffer(None, port, ZAB.QuorumPacket, self._printer.print_message,
+                        self._dump_bad_packet, start=False)
+    else:
+      config = ZKSnifferConfig(None)
+      config.track_replies = True
+      config.zookeeper_port = port
+      config.client_port = 0
+      if self._include_pings:
+        config.include_pings()
+      sniffer = ZKSniffer(
+        config,
+        self._printer.request_handler,
+        self._printer.write_reply,
+        self._printer.event_handler,
+        error_to_stderr=True
+      )
+
+    self._sniffers[port] = sniffer
+    return sniffer
+
+  def handle(self, port, load, timestamp):
+    self._output.timestamp = timestamp
+    try:
+      packet = PacketContext(RawPacket(load, timestamp))
+      check_tcp_seq(self._last_tcp_seq, packet)
+      sniffer = self._sniffer_for(port)
+      if self._protocol == 'zab':
+        # one segment might carry many QuorumPackets (or part of one)
+        for message in sniffer.messages_from_packet(packet):
+          sniffer.handle_message(message)
+      else:
+        message = sniffer.message_from_packet(packet)
+        if message:
+          sniffer.handle_message(message)
+    except (BadPacket, StringTooLong, DeserializationError, struct.error) as ex:
+      if self._dump_bad_packet:
+        print("got: %s" % str(ex))
+        hexdump.hexdump(load)
+        traceback.print_exc()
+        sys.stdout.flush()
+    except Exception as ex:
+      # keep going, a dead worker would stall the merged output
+      print("got: %s" % str(ex))
+      hexdump.hexdump(load)
+      traceback.print_exc()
+      sys.stdout.flush()
+
+
+class OmniWorker(multiprocessing.Process):
+  """ decodes the batches of frames sent its way & ships what got written to results """
+
+  def __init__(self, worker_id, protocol, packets, results,
+               colors=False, include_pings=False, dump_bad_packet=False):
+    super(OmniWorker, self).__init__()
+    self.daemon = True
+
+    self._worker_id = worker_id
+    self._protocol = protocol
+    self._packets = packets
+    self._results = results
+    self._colors = colors
+    self._include_pings = include_pings
+    self._dump_bad_packet = dump_bad_packet
+
+  @property
+  def worker_id(self):
+    return self._worker_id
+
+  def run(self):  # pragma: no cover
+    # the parent stops us (once everything's been sent) on ^C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    output = RecordOutput()
+    decoder = ProtocolDecoder(
+      self._protocol, output, self._colors, self._include_pings, self._dump_bad_packet)
+
+    while True:
+      batch = self._packets.get()
+      if batch is None:
+        break
+      watermark, packets = batch
+      for port, load, timestamp in packets:
+        decoder.handle(port, load, timestamp)
+      self._results.put((self._worker_id, watermark, output.take()))
+
+    self._results.put((self._worker_id, None, output.take()))
+
+
+class MergeWriter(Thread):
+  """
+  Writes the records from the given sources in timestamp order. Sources send
+  (source id, watermark, records) and a None watermark once they are done.
+  """
+
+  def __init__(self, sources, results, output=sys.stdout):
+    super(MergeWriter, self).__init__()
+    self.setDaemon(True)
+
+    self._watermarks = dict((source, 0.0) for source in sources)
+    self._results = results
+    self._output = output
+    self._pending = []  # heap of (timestamp, seq, text)
+    self._seq = 0
+
+  @property
+  def pending(self):
+    return len(self._pending)
+
+  def run(self):
+    try:
+      while self._watermarks:
+        self.add(*self._results.get())
+        self.write_ready()
+    except IOError:  # PIPE broken, most likely
+      pass
+
+  def add(self, source, watermark, records):
+    for timestamp, text in records:
+      heappush(self._pending, (timestamp, self._seq, text))
+      self._seq += 1
+
+    if watermark is None:
+      self._watermarks.pop(source, None)
+    else:
+      self._watermarks[source] = max(watermark, self._watermarks.get(source, 0.0))
+
+  def write_ready(self):
+    """ writes the records that no source can precede anymore """
+    pending = self._pending
+    if not pending:
+      return
+
+    limit = min(self._watermarks.values()) if self._watermarks else float('inf')
+    write = self._output.write
+    while pending and pending[0][0] <= limit:
+      write(heappop(pending)[2])
+    self._output.flush()
+
+
+class OmniPipeline(object):
+  """
+  The sniffer's side of the workers: batches frames per worker, ships them every
+  batch_size frames (or max_delay secs) and merges what comes back into output. A worker
+  that dies is taken out of the merge, so it doesn't hold back everyone else's output.
+
+  Whoever dispatches must hold lock while handling a packet (see tick & forward).
+  """
+
+  WRITER_GRACE = 5  # secs
+
+  def __init__(self, workers, output=sys.stdout, colors=False, include_pings=False,
+               dump_bad_packet=False, batch_size=512, max_delay=0.05):
+    if workers < 1:
+      raise ValueError('Need at least 1 worker per protocol')
+
+    self.lock = Lock()
+    self.local_output = RecordOutput()  # for the sniffer's own printer (FLE)
+
+    self._shards = workers
+    self._batch_size = batch_size
+    self._max_delay = max_delay
+    self._now = 0.0
+    self._stopped = False
+    self._results = multiprocessing.Queue()
+    self._queues = {}  # dict[(protocol, shard), Queue]
+    self._pending = {}  # dict[(protocol, shard), list of (port, load, timestamp)]
+    self._workers = []
+    self._gone = set()  # ids of the workers that exited
+
+    for protocol in PROTOCOLS:
+      for shard in range(workers):
+        key = (protocol, shard)
+        self._queues[key] = multiprocessing.Queue()
+        self._pending[key] = []
+        self._workers.append(OmniWorker(
+          '%s-%d' % key, protocol, self._queues[key], self._results,
+          colors, include_pings, dump_bad_packet))
+
+    self._writer = MergeWriter(
+      [PARENT] + [worker.worker_id for worker in self._workers], self._results, output)
+    self._flusher = Thread(target=self._flush_loop)
+    self._flusher.setDaemon(True)
+
+  @property
+  def shards(self):
+    return self._shards
+
+  @property
+  def workers(self):
+    return self._workers
+
+  def start(self):
+    for worker in self._workers:
+      worker.start()
+    self._writer.start()
+    self._flusher.start()
+
+  def tick(self, timestamp):
+    """ the time of the packet being dispatched """
+    self._now = timestamp
+    self.local_output.timestamp = timestamp
+
+  def forward(self, key, port, load, timestamp):
+    """ queue the frame for the worker for key (a protocol & shard) """
+    pending = self._pending[key]
+    pending.append((port, load, timestamp))
+    if len(pending) >= self._batch_size:
+      self._send(key)
+
+  def flush(self):
+    """ ship what's queued, and the sniffer's own records """
+    with self.lock:
+      if self._stopped:
+        return
+      for key in self._pending:
+        self._send(key)
+      self._results.put((PARENT, self._now, self.local_output.take()))
+
+  def stop(self, timeout=None):
+    """
+    ship what's left, wait for the workers to finish it & for it to be written out. That's
+    up to timeout secs or, if None, for as long as a worker is alive (& WRITER_GRACE secs
+    more for the writer)
+    """
+    with self.lock:
+      if self._stopped:
+        return
+      for key in self._pending:
+        self._send(key)
+        self._queues[key].put(None)
+      self._results.put((PARENT, None, self.local_output.take()))
+      self._stopped = True
+
+    deadline = None if timeout is None else time.time() + timeout
+    while self._writer.is_alive():
+      if deadline is not None and time.time() >= deadline:
+        break
+      if self._reap() == 0:
+        # every worker is gone, so the writer has all it'll ever get
+        grace = self.WRITER_GRACE if deadline is None else max(0, deadline - time.time())
+        self._writer.join(grace)
+        break
+      self._writer.join(self._max_delay)
+
+    for worker in self._workers:
+      worker.join(None if deadline is None else max(0, deadline - time.time()))
+
+  def _reap(self):
+    """
+    ends the merge for the workers that exited: those that crashed never will. Returns how
+    many are still alive
+    """
+    alive = 0
+    for worker in self._workers:
+      if worker.worker_id in self._gone:
+        continue
+      if worker.exitcode is None:
+        alive += 1
+        continue
+      self._gone.add(worker.worker_id)
+      if worker.exitcode != 0:
+        sys.stderr.write("Worker %s died (exit code %s)\n" % (worker.worker_id, worker.exitcode))
+      # what it sent is already queued, so this comes last (and is a no-op if it was done)
+      self._results.put((worker.worker_id, None, []))
+    return alive
+
+  def _send(self, key):
+    # empty batches move the worker's watermark along
+    self._queues[key].put((self._now, self._pending[key]))
+    self._pending[key] = []
+
+  def _flush_loop(self):  # pragma: no cover
+    while not self._stopped:
+      time.sleep(self._max_delay)
+      self.flush()
+      self._reap()
+
+
+class PipelinedOmniSniffer(OmniSniffer):
+  """
+  An OmniSniffer that hands ZAB & ZK frames to an OmniPipeline instead of decoding them.
+  FLE is still decoded here, since that's how the quorum is found.
+  """
+
+  def __init__(self, pipeline, *args, **kwargs):
+    start = kwargs.pop('start', True)
+    kwargs['start'] = False
+    super(PipelinedOmniSniffer, self).__init__(*args, **kwargs)
+    self._pipeline = pipeline
+    self._routes = FlowCache(kwargs.get('max_flows', 65536))
+
+    if start:  # pragma: no cover
+      self.start()
+
+  def handle_packet(self, packet):
+    pipeline = self._pipeline
+    timestamp = float(packet.time)
+
+    with pipeline.lock:
+      pipeline.tick(timestamp)
+
+      flow = peek_flow(packet.load)
+      route = self._routes.get(flow) if flow is not None else None
+      if route is None:
+        if flow is not None and self._flows.get(flow) is IGNORED:
+          return
+        route = self._route(packet)
+
+      if route is not None:
+        pipeline.forward(route[0], route[1], packet.load, timestamp)
+        return
+
+      super(PipelinedOmniSniffer, self).handle_packet(packet)
+
+  def _route(self, packet):
+    """ the (protocol, shard) & port for a ZAB or ZK packet, None for anything else """
+    try:
+      packet = PacketContext(packet)
+    except (BadPacket, struct.error):
+      return None  # OmniSniffer.handle_packet deals with it
+
+    sniffer = self._find_sniffer_for_packet(packet)
+    if sniffer is None:
+      return None
+
+    protocol = self._get_sniffer_type(sniffer)
+    if protocol not in PROTOCOLS:
+      return None
+
+    flow = packet.flow
+    if packet.dst in self._sniffers:
+      port, peer = packet.dst[1], flow[0:2]
+    else:
+      port, peer = packet.src[1], flow[2:4]
+
+    route = ((protocol, hash(peer) % self._pipeline.shards), port)
+    self._routes.put(flow, route)
+    return route
+
+  def _regist_sniffer(self, ip, port, type):
+    super(PipelinedOmniSniffer, self)._regist_sniffer(ip, port, type)
+    self._routes.clear()
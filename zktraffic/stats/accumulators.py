@@ -20,21 +20,43 @@ Contains various accumulators that build stats into dictionary objects driven
 by input from the queued stats loader
 '''
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from heapq import nlargest
+from operator import itemgetter
 
-from six.moves import intern
+from zktraffic.base.pending import PendingRequests
+from zktraffic.base.util import PATH_CACHE
+
+from .histogram import LogHistogram
+from .sketches import CountMinSketch, SpaceSaving
+from .trie import PathTrie
 
 
 class TopStatsAccumulator(object):
-  def __init__(self, aggregation_depth, include_bytes=True):
+  def __init__(self, aggregation_depth, include_bytes=True, window_buckets=1, capacity=0,
+               path_cache=PATH_CACHE):
     """
     if aggregation_depth > 0 then we aggregate for paths up to that depth
     as a safety measure set a cap on the num of requests, replies & events
+
+    the stats of the last window_buckets accumulation periods are kept around, so
+    stats() can return sliding windows made of the most recent buckets
+
+    if capacity > 0 then only (about) the top capacity paths per op are counted, in fixed
+    memory (see SpaceSaving), and stats() also returns the error bounds of the counts
+
+    paths are turned into keys via path_cache (see PathCache), shared by default
     """
 
     self._prev_stats = {}
+    self._capacity = capacity
+    self._buckets = deque(maxlen=window_buckets)  # accumulated stats, newest last
+    # reset on every accumulation
+    self._merged_cache = {}  # buckets -> merged stats
+    self._windows_cache = {}  # (buckets, top, depth) -> top stats
     self._aggregation_depth = aggregation_depth
     self._include_bytes = include_bytes
+    self._path_cache = path_cache
 
     self.init_cur_stats()
 
@@ -47,13 +69,31 @@ class TopStatsAccumulator(object):
   def update_event_stats(self, event):  # pragma: no cover
     raise NotImplementedError
 
+  def update_request_stats_batch(self, requests):
+    update = self.update_request_stats
+    for request in requests:
+      update(request)
+
+  def update_reply_stats_batch(self, replies):
+    update = self.update_reply_stats
+    for reply in replies:
+      update(reply)
+
+  def update_event_stats_batch(self, events):
+    update = self.update_event_stats
+    for event in events:
+      update(event)
+
   def accumulate_stats(self):
     self._prev_stats = self._cur_stats
+    self._buckets.append(self._cur_stats)
+    self._merged_cache = {}
+    self._windows_cache = {}
     self.init_cur_stats()
 
   def init_cur_stats(self):
     """Initialize the _cur_stats dictionary with defaults to avoid no data issues"""
-    self._cur_stats = defaultdict(lambda: defaultdict(int))
+    self._cur_stats = defaultdict(self.new_table)
     self._cur_stats["writes"]["/"] = 0
     self._cur_stats["reads"]["/"] = 0
     self._cur_stats["total"]["/writes"] = 0
@@ -65,26 +105,53 @@ class TopStatsAccumulator(object):
       self._cur_stats["total"]["/writeBytes"] = 0
       self._cur_stats["total"]["/readBytes"] = 0
 
-  def get_path(self, message, suffix=None):
-    if self._aggregation_depth > 0 and message.path:
-      path = message.parent_path(self._aggregation_depth)
-    else:
-      path = message.path
-
-    return intern(path if suffix is None else ':'.join((path, suffix)))
+  def new_table(self):
+    """ a table of path -> count, for a given op """
+    return SpaceSaving(self._capacity) if self._capacity > 0 else defaultdict(int)
 
-  def stats(self, top):
-    top_stats = {}
-
-    if top == 0:  # pragma: no cover
-      return self._prev_stats
-
-    for op, per_path_s in self._prev_stats.items():
-      paths = sorted(per_path_s.keys(), lambda a, b: per_path_s[b] - per_path_s[a])
-      top_stats[op] = dict((p, per_path_s[p]) for p in paths[0:top])
+  def get_path(self, message, suffix=None):
+    return self._path_cache.key(message.path, self._aggregation_depth, suffix)
 
-    return top_stats
+  def stats(self, top, buckets=None, depth=None):
+    """
+    top stats, merged across the last N buckets (or all of them, if buckets is None)
+    and aggregated to the given depth (see aggregate)
+    """
+    merged_cache, cache = self._merged_cache, self._windows_cache
+    window = list(self._buckets)
+    if buckets is not None:
+      window = window[-buckets:]
+
+    key = (len(window), top, depth)
+    top_s = cache.get(key)
+    if top_s is None:
+      merged = merged_cache.get(len(window))
+      if merged is None:
+        merged = window[0] if len(window) == 1 else merge_stats(window)
+        merged_cache[len(window)] = merged
+      top_s = cache[key] = top_stats(self.aggregate(merged, depth), top)
+
+    return top_s
+
+  def stats_from_snapshots(self, snapshots, top, depth=None):
+    """ like stats(), but for snapshots (i.e.: from different processes) """
+    return top_stats(self.aggregate(merge_stats(snapshots), depth), top)
+
+  def aggregate(self, stats_by_op, depth=None):
+    """
+    paths are aggregated as they are counted, so aggregation_depth is the only depth
+    there is (None means that one)
+    """
+    if depth is not None and depth != self._aggregation_depth:
+      raise ValueError("Stats are only aggregated to depth %d" % self._aggregation_depth)
+    return stats_by_op
 
+  def snapshot(self):
+    """ a plain (picklable) copy of the last accumulated stats (the newest bucket) """
+    return dict(
+      (op, per_path_s if isinstance(per_path_s, SpaceSaving) else dict(per_path_s))
+      for op, per_path_s in self._prev_stats.items()
+    )
 
   def _update_request_stats(self, path, request):
     """ here we actually update the stats for a given request """
@@ -131,6 +198,26 @@ class PerPathStatsAccumulator(TopStatsAccumulator):
     self._cur_stats[event.name][path] += 1
 
 
+class PerPathTrieStatsAccumulator(PerPathStatsAccumulator):
+  """
+  Counts exact paths, and aggregates them when stats are asked for (see PathTrie). So
+  stats for any depth can be had (aggregation_depth is just the default one), and there's
+  no parent_path() per request.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(PerPathTrieStatsAccumulator, self).__init__(*args, **kwargs)
+    self._trie = PathTrie()
+
+  def get_path(self, message, suffix=None):
+    return self._path_cache.key(message.path)
+
+  def aggregate(self, stats_by_op, depth=None):
+    if depth is None:
+      depth = self._aggregation_depth
+    return aggregate_stats(stats_by_op, depth, self._trie) if depth > 0 else stats_by_op
+
+
 class PerIPStatsAccumulator(TopStatsAccumulator):
   def update_request_stats(self, request):
     self._update_request_stats(self.get_path(request, request.ip), request)
@@ -151,3 +238,256 @@ class PerAuthStatsAccumulator(TopStatsAccumulator):
 
   def update_event_stats(self, event):  # pragma: no cover
     pass
+
+
+LATENCY_QUANTILES = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("p999", 0.999))
+
+
+class LatencyStatsAccumulator(object):
+  """
+  Pairs requests & replies by (client, xid) and keeps LogHistograms of their latencies
+  (in secs), per op and per path (aggregated to aggregation_depth). Only the first
+  max_paths paths of each bucket get their own histogram, the rest count only per op.
+
+  Requests waiting for their replies are bounded by max_pending & ttl (see PendingRequests).
+  """
+
+  def __init__(self, aggregation_depth, window_buckets=1, accuracy=0.01, max_paths=10000,
+               max_pending=100000, ttl=60, path_cache=PATH_CACHE):
+    self._aggregation_depth = aggregation_depth
+    self._accuracy = accuracy
+    self._max_paths = max_paths
+    self._path_cache = path_cache
+    self._pending = PendingRequests(max_pending, ttl)
+    self._buckets = deque(maxlen=window_buckets)  # {"ops": .., "paths": ..}, newest last
+    self._windows_cache = {}  # (buckets, top) -> stats, reset on every accumulation
+
+    self.init_cur_stats()
+
+  @property
+  def pending(self):
+    return self._pending
+
+  def init_cur_stats(self):
+    self._cur_stats = {"ops": {}, "paths": {}}
+
+  def _histogram(self, table, key):
+    histogram = table.get(key)
+    if histogram is None:
+      histogram = table[key] = LogHistogram(self._accuracy)
+    return histogram
+
+  def update_request_stats_batch(self, requests):
+    add = self._pending.add
+    key = self._path_cache.key
+    depth = self._aggregation_depth
+    for request in requests:
+      if request.is_ping or request.is_auth or request.is_close:
+        continue
+      add(request.client, request.xid, (request.name, key(request.path, depth)),
+          request.timestamp)
+
+  def update_reply_stats_batch(self, replies):
+    pop_entry = self._pending.pop_entry
+    ops = self._cur_stats["ops"]
+    paths = self._cur_stats["paths"]
+    for reply in replies:
+      if reply.is_ping:
+        continue
+
+      entry = pop_entry(reply.client, reply.xid)
+      if entry is None:
+        continue
+
+      (name, path), timestamp = entry
+      latency = reply.timestamp - timestamp
+      self._histogram(ops, name).add(latency)
+      if path in paths or len(paths) < self._max_paths:
+        self._histogram(paths, path or '/').add(latency)
+
+  def accumulate_stats(self):
+    self._buckets.append(self._cur_stats)
+    self._windows_cache = {}
+    self.init_cur_stats()
+
+  def stats(self, top, buckets=None, depth=None):
+    """ latency quantiles for each op & the top (busiest) paths, across the last N buckets """
+    window = list(self._buckets)
+    if buckets is not None:
+      window = window[-buckets:]
+
+    key = (len(window), top)
+    stats = self._windows_cache.get(key)
+    if stats is None:
+      stats = self._windows_cache[key] = self.stats_from_snapshots(window, top, depth)
+
+    return stats
+
+  def stats_from_snapshots(self, snapshots, top, depth=None):
+    if depth is not None and depth != self._aggregation_depth:
+      raise ValueError("Latencies are only aggregated to depth %d" % self._aggregation_depth)
+
+    merged = {}
+    for table in ("ops", "paths"):
+      histograms = defaultdict(list)
+      for snapshot in snapshots:
+        for key, histogram in snapshot[table].items():
+          histograms[key].append(histogram)
+      merged[table] = dict((k, LogHistogram.merged(h)) for k, h in histograms.items())
+
+    paths = merged["paths"]
+    if top > 0:
+      busiest = nlargest(top, paths, key=lambda path: paths[path].count)
+      paths = dict((path, paths[path]) for path in busiest)
+
+    return {
+      "ops": dict((op, latency_stats(h)) for op, h in merged["ops"].items()),
+      "paths": dict((path, latency_stats(h)) for path, h in paths.items()),
+    }
+
+  def snapshot(self):
+    """ the histograms of the newest bucket """
+    return self._buckets[-1] if self._buckets else {"ops": {}, "paths": {}}
+
+
+def latency_stats(histogram):
+  stats = dict(zip(
+    (name for name, _ in LATENCY_QUANTILES),
+    histogram.quantiles([q for _, q in LATENCY_QUANTILES])))
+  stats["count"] = histogram.count
+  stats["avg"] = histogram.avg
+  return stats
+
+
+class PathCountsAccumulator(object):
+  """
+  Approximate request counts per op for *any* path (not just the top ones), in fixed
+  memory: one CountMinSketch of width * depth counters per bucket, keyed by op + path.
+
+  Paths aren't aggregated, so counts are for exact paths.
+  """
+
+  def __init__(self, width=2048, depth=4, window_buckets=1):
+    self._width = width
+    self._depth = depth
+    self._ops = set()  # every op seen so far, to know what to ask the sketches for
+    self._buckets = deque(maxlen=window_buckets)  # sketches, newest last
+    self._windows_cache = {}  # buckets -> merged sketch, reset on every accumulation
+
+    self.init_cur_stats()
+
+  def init_cur_stats(self):
+    self._cur_sketch = CountMinSketch(self._width, self._depth)
+
+  def update_request_stats_batch(self, requests):
+    ops = self._ops
+    add = self._cur_sketch.add
+    for request in requests:
+      name = request.name
+      if name not in ops:
+        ops.add(name)
+      add(name + (request.path or '/'))
+
+  def accumulate_stats(self):
+    self._buckets.append(self._cur_sketch)
+    self._windows_cache = {}
+    self.init_cur_stats()
+
+  def counts(self, path, buckets=None):
+    """ op -> count for the given path, across the last N buckets (or all of them) """
+    window = list(self._buckets)
+    if buckets is not None:
+      window = window[-buckets:]
+
+    if not window:
+      return {}
+
+    sketch = self._windows_cache.get(len(window))
+    if sketch is None:
+      sketch = self._windows_cache[len(window)] = CountMinSketch.merge(window)
+
+    return path_counts(sketch, self._ops, path)
+
+  def snapshot(self):
+    """ the ops seen so far & the newest bucket """
+    return (tuple(self._ops), self._buckets[-1] if self._buckets else None)
+
+
+def path_counts(sketch, ops, path):
+  """ op -> (approximate) count for path, leaving out the ops it has no requests for """
+  counts = {}
+  for op in ops:
+    count = sketch.query(op + path)
+    if count > 0:
+      counts[op] = count
+  return counts
+
+
+def merge_path_counts(snapshots, path):
+  """ like PathCountsAccumulator.counts, but from snapshots of different accumulators """
+  ops = set()
+  sketches = []
+  for snapshot_ops, sketch in snapshots:
+    ops.update(snapshot_ops)
+    if sketch is not None:
+      sketches.append(sketch)
+
+  if not sketches:
+    return {}
+
+  return path_counts(CountMinSketch.merge(sketches), ops, path)
+
+
+def top_stats(stats_by_op, top):
+  """
+  keep the top N paths for each op
+
+  for ops counted with SpaceSaving, the error bounds of the top paths are
+  returned as <op>ErrorBound
+  """
+  top_s = {}
+  for op, per_path_s in stats_by_op.items():
+    if top == 0:  # pragma: no cover
+      top_s[op] = dict(per_path_s.items())
+    else:
+      # O(n log top), instead of sorting every path
+      top_s[op] = dict(nlargest(top, per_path_s.items(), key=itemgetter(1)))
+
+    if isinstance(per_path_s, SpaceSaving):
+      top_s["%sErrorBound" % op] = dict((p, per_path_s.error(p)) for p in top_s[op])
+
+  return top_s
+
+
+def aggregate_stats(stats_by_op, depth, trie):
+  """ sums up the counts of paths (see PerPathTrieStatsAccumulator) to the given depth """
+  aggregated = {}
+  prefix = trie.prefix
+  for op, per_path_s in stats_by_op.items():
+    aggregated_op = aggregated[op] = defaultdict(int)
+    for path, value in per_path_s.items():
+      aggregated_op[prefix(path, depth)] += value
+
+  return aggregated
+
+
+def merge_stats(snapshots):
+  """ sum up snapshots (see TopStatsAccumulator.snapshot) from different accumulators """
+  tables_by_op = defaultdict(list)
+  for snapshot in snapshots:
+    for op, per_path_s in snapshot.items():
+      tables_by_op[op].append(per_path_s)
+
+  merged = defaultdict(lambda: defaultdict(int))
+
+  for op, tables in tables_by_op.items():
+    if isinstance(tables[0], SpaceSaving):
+      merged[op] = SpaceSaving.merge(tables)
+      continue
+
+    merged_op = merged[op]
+    for per_path_s in tables:
+      for path, value in per_path_s.items():
+        merged_op[path] += value
+
+  return merged
@@ -0,0 +1,130 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+'''
+Fixed memory histograms of positive values (i.e.: latencies), for quantiles that
+can be merged across time buckets & processes.
+'''
+
+import math
+
+
+class LogHistogram(object):
+  """
+  Counts values into logarithmic buckets: bucket i holds values in (gamma^(i-1), gamma^i],
+  with gamma = (1 + accuracy) / (1 - accuracy). So quantiles are off by at most accuracy
+  (relative to the real value), like DDSketch (Masson et al.).
+
+  Values below min_value are counted in the first bucket and values above max_value in the
+  last one, so there are at most log(max_value / min_value) / log(gamma) buckets (~1000
+  for latencies between 1us and 1000s, with 1% accuracy), no matter how many values.
+  """
+
+  __slots__ = ("_accuracy", "_gamma", "_log_gamma", "_min_index", "_max_index",
+               "_buckets", "count", "sum", "min", "max")
+
+  def __init__(self, accuracy=0.01, min_value=1e-6, max_value=1e3):
+    self._accuracy = accuracy
+    self._gamma = (1 + accuracy) / (1 - accuracy)
+    self._log_gamma = math.log(self._gamma)
+    self._min_index = self._index(min_value)
+    self._max_index = self._index(max_value)
+    self._buckets = {}  # index -> count
+    self.count = 0
+    self.sum = 0.0
+    self.min = None
+    self.max = None
+
+  def __len__(self):
+    return self.count
+
+  @property
+  def accuracy(self):
+    return self._accuracy
+
+  def _index(self, value):
+    return int(math.ceil(math.log(value) / self._log_gamma))
+
+  def add(self, value, count=1):
+    if value <= 0:
+      index = self._min_index
+    else:
+      index = min(max(self._index(value), self._min_index), self._max_index)
+
+    buckets = self._buckets
+    buckets[index] = buckets.get(index, 0) + count
+    self.count += count
+    self.sum += value * count
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  @property
+  def avg(self):
+    return self.sum / self.count if self.count else 0.0
+
+  def quantile(self, q):
+    """ the value below which a fraction q of the values are, None if there are none """
+    if self.count == 0:
+      return None
+    if q <= 0:
+      return self.min
+    if q >= 1:
+      return self.max
+
+    # nearest rank: the smallest value with at least q * count values up to it
+    rank = q * self.count
+    seen = 0
+    for index in sorted(self._buckets):
+      seen += self._buckets[index]
+      if seen >= rank:
+        break
+
+    # the middle of the bucket (relative to its bounds) is within accuracy of its values
+    value = 2 * self._gamma ** index / (self._gamma + 1)
+    return min(max(value, self.min), self.max)
+
+  def quantiles(self, qs):
+    return [self.quantile(q) for q in qs]
+
+  def merge(self, other):
+    """ adds other's counts (both must have the same accuracy) to this one """
+    if other._gamma != self._gamma:
+      raise ValueError("Can't merge histograms with different accuracies")
+
+    buckets = self._buckets
+    for index, count in other._buckets.items():
+      buckets[index] = buckets.get(index, 0) + count
+
+    self.count += other.count
+    self.sum += other.sum
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    if other.max is not None and (self.max is None or other.max > self.max):
+      self.max = other.max
+
+    return self
+
+  @classmethod
+  def merged(cls, histograms):
+    """ a new histogram with the counts of all of them """
+    histograms = list(histograms)
+    merged = cls(histograms[0].accuracy) if histograms else cls()
+    for histogram in histograms:
+      merged.merge(histogram)
+    return merged
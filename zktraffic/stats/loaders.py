@@ -17,14 +17,14 @@
 
 '''
 Captures different stats using the same infrastructure. Registers a handler with the sniffer
-and queues all packets. A separate thread dequeues each request and delivers it to multiple
-stats handler.
+and queues all packets. A separate thread dequeues requests in batches and delivers each
+batch to multiple stats handler.
 '''
 
 from collections import defaultdict
-from threading import Condition
+from threading import Event
 
-import time
+import math
 
 from zktraffic.base.deque import Deque
 
@@ -35,12 +35,38 @@ from twitter.common import log
 from twitter.common.exceptions import ExceptionalThread
 
 
-class QueueStatsLoader(ExceptionalThread):
+def for_each(handler):
+  """ turns a handler of single items into one that takes batches """
+  def batch_handler(items):
+    for item in items:
+      handler(item)
+  return batch_handler
+
 
-  def __init__(self, max_reqs=400000, max_reps=400000, max_events=400000, timer=None):
+class QueueStatsLoader(ExceptionalThread):
+  """
+  The sniffer's thread appends to the queues (deque appends are atomic, so no locks) and
+  wakes up the loader once a queue has a full batch. Otherwise, the loader wakes up after
+  max_delay secs. Accumulators get whole batches (see update_request_stats_batch & co).
+
+  Every bucket_secs the accumulators are told to accumulate their stats (i.e.: move on to
+  a new bucket), until freeze() is called. If offline (i.e.: reading a pcap), everything
+  goes into a single bucket until freeze(), since buckets would be about how long the
+  read took rather than about the capture.
+  """
+
+  def __init__(self, max_reqs=400000, max_reps=400000, max_events=400000, timer=None,
+               batch_size=512, max_delay=0.25, bucket_secs=60, offline=False):
     self._accumulators = {}
-    self._cv = Condition()
+    self._offline = offline
+    self._bucket_secs = bucket_secs
+    self._ready = Event()
+    self._batch_size = batch_size
+    self._max_delay = max_delay
     self._stopped = True
+    self._freezing = False
+    self._frozen = False
+    self._counted = False  # anything since the last bucket?
     self._requests = Deque(maxlen=max_reqs)
     self._replies = Deque(maxlen=max_reps)
     self._events = Deque(maxlen=max_events)
@@ -53,8 +79,7 @@ class QueueStatsLoader(ExceptionalThread):
     self.setDaemon(True)
 
   def wakeup(self):
-    with self._cv:
-      self._cv.notify()
+    self._ready.set()
 
   @property
   def auth_by_client(self):
@@ -63,17 +88,31 @@ class QueueStatsLoader(ExceptionalThread):
   def register_accumulator(self, name, accumulator):
     # TODO : Disallow registration after thread start
     self._accumulators[name] = accumulator
-    if hasattr(accumulator, 'update_request_stats'):
-      self._request_handlers.add(accumulator.update_request_stats)
-    if hasattr(accumulator, 'update_reply_stats'):
-      self._reply_handlers.add(accumulator.update_reply_stats)
-    if hasattr(accumulator, 'update_event_stats'):
-      self._event_handlers.add(accumulator.update_event_stats)
+    for kind, handlers in (('request', self._request_handlers),
+                           ('reply', self._reply_handlers),
+                           ('event', self._event_handlers)):
+      handler = getattr(accumulator, 'update_%s_stats_batch' % kind, None)
+      if handler is None and hasattr(accumulator, 'update_%s_stats' % kind):
+        handler = for_each(getattr(accumulator, 'update_%s_stats' % kind))
+      if handler is not None:
+        handlers.add(handler)
 
   def stop(self):
-    with self._cv:
-      self._stopped = True
-      self._cv.notify()
+    self._stopped = True
+    self._ready.set()
+
+  def freeze(self):
+    """
+    stop moving on to new buckets (i.e.: once an offline read is done): what's queued goes
+    into a last bucket and from then on the stats stay as they are
+    """
+    self._freezing = True
+    self._ready.set()
+
+  @property
+  def frozen(self):
+    """ True once what was queued before freeze() has made it into the stats """
+    return self._frozen
 
   def run(self):
     """ compute stats from queued requests """
@@ -82,34 +121,59 @@ class QueueStatsLoader(ExceptionalThread):
 
     self._timer.reset()
     while not self._stopped:
-      # update stats for available requests/replies/events
+      # wait for a full batch, or until it's been too long
+      self._ready.wait(self._max_delay)
+      self._ready.clear()
+      self._load()
 
-      self._process_queue(self._requests, self._request_handlers)
-      self._process_queue(self._replies, self._reply_handlers)
-      self._process_queue(self._events, self._event_handlers)
+  def _load(self):
+    """ update stats for available requests/replies/events, then rotate or freeze buckets """
+    # read before draining the queues, so everything queued before freeze() makes it in
+    freezing = self._freezing
 
-      if self._timer.after(60):
-        for accumulator in self._accumulators.values():
-          accumulator.accumulate_stats()
-        self._timer.reset()
+    self._process_queue(self._requests, self._request_handlers)
+    self._process_queue(self._replies, self._reply_handlers)
+    self._process_queue(self._events, self._event_handlers)
 
-      # no need to wake up immediately to process the new packets
-      time.sleep(1)
+    if self._frozen:
+      return
+
+    if freezing:
+      if self._counted:
+        self._accumulate_stats()
+        self._counted = False
+      self._frozen = True
+    elif not self._offline:
+      self._rotate_buckets()
+
+  def _rotate_buckets(self):
+    """ move on to a new bucket, if the current one is done """
+    if self._timer.after(self._bucket_secs):
+      self._accumulate_stats()
+      self._counted = False
+      # the next bucket starts when this one was due, not when we got around to it
+      self._timer.reset(self._timer.start + self._bucket_secs)
+
+  def _accumulate_stats(self):
+    for accumulator in self._accumulators.values():
+      accumulator.accumulate_stats()
 
   def _process_queue(self, queue, handlers):
-    while True:
-      try:
-        item = queue.pop()
-      except IndexError:
-        break
-
-      try:
-        _ = [handler(item) for handler in handlers]
-      except Exception as ex:
-        name = getattr(item, "name", "")
-        path = getattr(item, "path", "")
-        ip = getattr(item, "ip", "")
-        log.error("Handler call for item %s, %s, %s failed: %s", name, path, ip, ex)
+    batch_size = self._batch_size
+    popleft = queue.popleft
+
+    if queue:
+      self._counted = True
+
+    # we are the only consumer, so there are at least len(queue) items
+    while queue:
+      batch = [popleft() for _ in range(min(len(queue), batch_size))]
+
+      for handler in handlers:
+        try:
+          handler(batch)
+        except Exception as ex:
+          log.error("Handler call for a batch of %d items failed: %s", len(batch), ex)
 
   def handle_request(self, request):
     if request.is_auth:
@@ -128,11 +192,25 @@ class QueueStatsLoader(ExceptionalThread):
   def add_to_queue(self, queue, item, label):
     """ queue items send to us by the sniffer """
     count = len(queue)
-    if count > queue.maxlength():  # pragma: no cover
+    if count >= queue.maxlength():  # pragma: no cover
       log.warn("Too many %s queued (%d)", label, count)
       return
 
-    queue.appendleft(item)
+    queue.append(item)
+
+    # only signal once per batch, when crossing the threshold
+    if count + 1 == self._batch_size:
+      self._ready.set()
+
+  def buckets_for(self, window):
+    """ how many buckets make up a window of the given secs (None means all of them) """
+    if window is None:
+      return None
+    return max(1, int(math.ceil(float(window) / self._bucket_secs)))
+
+  def stats(self, name, top, window=None, depth=None):
+    return self._accumulators[name].stats(top, self.buckets_for(window), depth)
 
-  def stats(self, name, top):
-    return self._accumulators[name].stats(top)
+  def counts(self, name, path, window=None):
+    """ per op counts for any path (see PathCountsAccumulator) """
+    return self._accumulators[name].counts(path, self.buckets_for(window))
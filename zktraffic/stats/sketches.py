@@ -0,0 +1,208 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+'''
+Fixed memory summaries, for when there are too many distinct keys (i.e.: paths) to
+count them all.
+'''
+
+from array import array
+from hashlib import md5
+from operator import add
+from heapq import heapify, heappop, heappush, heapreplace, nlargest
+
+import struct
+
+
+TWO_WORDS = struct.Struct("<II")
+
+
+class SpaceSaving(object):
+  """
+  Space-Saving (Metwally et al.) counts for at most capacity keys.
+
+  When a new key shows up and there's no room left, the key with the smallest count
+  is replaced and the new key inherits that count as its error. So counts are
+  overestimates, by at most error(key), and any key seen more than total / capacity
+  times is guaranteed to be tracked.
+
+  Quacks like a defaultdict(int), so table[key] += n works.
+  """
+
+  __slots__ = ("_capacity", "_counts", "_errors", "_heap", "_floor")
+
+  def __init__(self, capacity):
+    self._capacity = capacity
+    self._counts = {}
+    self._errors = {}
+    self._heap = []   # (count, key) for each tracked key, counts might be stale
+    self._floor = 0   # max count of an untracked key while there's room left (see merge)
+
+  @property
+  def capacity(self):
+    return self._capacity
+
+  def __len__(self):
+    return len(self._counts)
+
+  def __contains__(self, key):
+    return key in self._counts
+
+  def __iter__(self):
+    return iter(self._counts)
+
+  def __getitem__(self, key):
+    return self._counts.get(key, 0)
+
+  def __setitem__(self, key, value):
+    counts = self._counts
+    if key in counts:
+      counts[key] = value
+      return
+
+    if len(counts) < self._capacity:
+      error = 0
+    else:
+      error = self._evict_min()
+
+    counts[key] = error + value
+    self._errors[key] = error
+    heappush(self._heap, (error + value, key))
+
+  def keys(self):
+    return self._counts.keys()
+
+  def items(self):
+    return self._counts.items()
+
+  def error(self, key):
+    """ how much key's count might be overestimated """
+    return self._errors.get(key, self.min_count)
+
+  @property
+  def min_count(self):
+    """ the most an untracked key could have been seen """
+    if len(self._counts) < self._capacity:
+      return self._floor
+
+    heap = self._heap
+    while True:
+      count, key = heap[0]
+      current = self._counts[key]
+      if current == count:
+        return count
+      heapreplace(heap, (current, key))
+
+  def _evict_min(self):
+    heap = self._heap
+    while True:
+      count, key = heappop(heap)
+      current = self._counts[key]
+      if current == count:
+        del self._counts[key]
+        del self._errors[key]
+        return count
+      # stale, since it was incremented
+      heappush(heap, (current, key))
+
+  @classmethod
+  def merge(cls, tables, capacity=None):
+    """
+    Merges summaries (i.e.: from different time buckets or processes). A key that's
+    missing from a summary might have been seen up to its min_count times there, so
+    that's added to both its count and its error.
+    """
+    capacity = capacity or max(t.capacity for t in tables)
+    floors = [t.min_count for t in tables]
+    floor = sum(floors)
+
+    counts = {}
+    errors = {}
+    for table, table_floor in zip(tables, floors):
+      for key, count in table._counts.items():
+        counts[key] = counts.get(key, floor) + count - table_floor
+        errors[key] = errors.get(key, floor) + table._errors[key] - table_floor
+
+    keys = nlargest(capacity, counts, key=counts.get)
+
+    merged = cls(capacity)
+    merged._counts = dict((key, counts[key]) for key in keys)
+    merged._errors = dict((key, errors[key]) for key in keys)
+    merged._heap = [(counts[key], key) for key in keys]
+    merged._floor = floor
+    heapify(merged._heap)
+
+    return merged
+
+
+class CountMinSketch(object):
+  """
+  Count-Min sketch (Cormode & Muthukrishnan): approximate counts for any key, in
+  fixed memory (width * depth counters). Counts are never underestimated, and are
+  overestimated by at most e * total / width with probability 1 - e^-depth.
+
+  Keys are hashed with md5 (instead of hash(), which is randomized per process) so
+  sketches from different processes can be merged.
+  """
+
+  __slots__ = ("_width", "_depth", "_rows", "total")
+
+  def __init__(self, width=2048, depth=4):
+    self._width = width
+    self._depth = depth
+    self._rows = [array("l", [0]) * width for _ in range(depth)]
+    self.total = 0
+
+  @property
+  def width(self):
+    return self._width
+
+  @property
+  def depth(self):
+    return self._depth
+
+  def _indexes(self, key):
+    if not isinstance(key, bytes):
+      key = key.encode("utf-8")
+    # double hashing: h1 + i * h2 is as good as depth independent hashes, as long as h2
+    # isn't a multiple of width (then every row would use the same column)
+    h1, h2 = TWO_WORDS.unpack_from(md5(key).digest())
+    width = self._width
+    if width & (width - 1) == 0:
+      h2 |= 1  # odd, so coprime with a power of two
+    else:
+      h2 = 1 + h2 % (width - 1)
+    return [(h1 + i * h2) % width for i in range(self._depth)]
+
+  def add(self, key, count=1):
+    for row, index in zip(self._rows, self._indexes(key)):
+      row[index] += count
+    self.total += count
+
+  def query(self, key):
+    return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+  @classmethod
+  def merge(cls, sketches):
+    """ sketches must have the same width & depth """
+    first = sketches[0]
+    merged = cls(first.width, first.depth)
+    for sketch in sketches:
+      if (sketch.width, sketch.depth) != (first.width, first.depth):
+        raise ValueError("Can't merge sketches with different dimensions")
+      merged._rows = [array("l", map(add, a, b)) for a, b in zip(merged._rows, sketch._rows)]
+      merged.total += sketch.total
+    return merged
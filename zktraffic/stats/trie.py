@@ -0,0 +1,69 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+'''
+Paths as a tree of interned prefixes, so aggregating paths to a given depth
+doesn't need to split & join them every time (see zktraffic.base.util.parent_path).
+'''
+
+from six.moves import intern
+
+
+class PathNode(object):
+  __slots__ = ("path", "depth", "parent")
+
+  def __init__(self, path, depth, parent):
+    self.path = path
+    self.depth = depth
+    self.parent = parent
+
+
+class PathTrie(object):
+  """
+  Every path is split once, the first time it's seen. After that, its prefix at
+  any depth is a dict lookup & a walk up the tree.
+
+  Holds up to max_nodes nodes, then starts over (paths are cheap to add back).
+  """
+
+  def __init__(self, max_nodes=1000000):
+    self._nodes = {}  # path -> PathNode
+    self._max_nodes = max_nodes
+
+  def __len__(self):
+    return len(self._nodes)
+
+  def node(self, path):
+    node = self._nodes.get(path)
+    if node is not None:
+      return node
+
+    if len(self._nodes) >= self._max_nodes:
+      self._nodes.clear()
+
+    # /a/b/c is at depth 3, under /a/b
+    depth = path.count('/')
+    parent = self.node(path.rsplit('/', 1)[0]) if depth > 1 else None
+    node = self._nodes[path] = PathNode(intern(path), depth, parent)
+    return node
+
+  def prefix(self, path, depth):
+    """ same as parent_path(path, depth) """
+    node = self.node(path)
+    while node.depth > depth:
+      node = node.parent
+    return node.path
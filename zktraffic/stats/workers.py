@@ -0,0 +1,209 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+'''
+Runs the sniffer & the stats loader in N processes, so stats gathering isn't bound to a
+single GIL. Each worker opens its own capture socket in the same PACKET_FANOUT_HASH group,
+so the kernel keeps every TCP flow on the same worker. Every time a worker accumulates its
+stats it ships a snapshot of them (the newest bucket) to the parent, which keeps the last
+window_buckets of them per worker and merges them when asked.
+'''
+
+from collections import deque
+from threading import Event, Lock
+
+import copy
+import math
+import multiprocessing
+import os
+import time
+
+from zktraffic.base.capture import TPACKET
+from zktraffic.base.sniffer import Sniffer
+
+from .accumulators import merge_path_counts, merge_stats, top_stats
+from .loaders import QueueStatsLoader
+
+from twitter.common import log
+from twitter.common.exceptions import ExceptionalThread
+
+
+class WorkerStatsLoader(QueueStatsLoader):
+  """ a stats loader that ships its accumulated stats to the parent process """
+
+  def __init__(self, worker_id, results, *args, **kwargs):
+    super(WorkerStatsLoader, self).__init__(*args, **kwargs)
+    self._worker_id = worker_id
+    self._results = results
+
+  def _accumulate_stats(self):
+    super(WorkerStatsLoader, self)._accumulate_stats()
+
+    snapshots = dict((name, acc.snapshot()) for name, acc in self._accumulators.items())
+    self._results.put((self._worker_id, snapshots, dict(self.auth_by_client)))
+
+
+class StatsWorker(multiprocessing.Process):
+  def __init__(self, worker_id, config, results, accumulators_factory,
+               max_reqs=400000, max_reps=400000, max_events=400000, bucket_secs=60,
+               freeze=None):
+    """
+    accumulators_factory returns a dict of name -> accumulator, it's called
+    within the worker process.
+
+    Once freeze (a multiprocessing.Event) is set, the worker ships what it has left
+    and exits. Either way, it sends (worker id, None, None) when it's done.
+    """
+    super(StatsWorker, self).__init__()
+    self.daemon = True
+
+    self._worker_id = worker_id
+    self._config = config
+    self._results = results
+    self._accumulators_factory = accumulators_factory
+    self._max_reqs = max_reqs
+    self._max_reps = max_reps
+    self._max_events = max_events
+    self._bucket_secs = bucket_secs
+    self._freeze = freeze if freeze is not None else multiprocessing.Event()
+
+  def run(self):  # pragma: no cover
+    loader = WorkerStatsLoader(
+      self._worker_id, self._results, self._max_reqs, self._max_reps, self._max_events,
+      bucket_secs=self._bucket_secs)
+    for name, accumulator in self._accumulators_factory().items():
+      loader.register_accumulator(name, accumulator)
+    loader.start()
+
+    sniffer = Sniffer(self._config, loader.handle_request, loader.handle_reply, loader.handle_event)
+    sniffer.start()
+    while sniffer.is_alive() and not self._freeze.wait(1):
+      pass
+
+    if self._freeze.is_set():
+      loader.freeze()
+      while loader.is_alive() and not loader.frozen:
+        time.sleep(0.05)
+
+    self._results.put((self._worker_id, None, None))
+
+
+class StatsWorkerPool(ExceptionalThread):
+  """
+  Quacks like a QueueStatsLoader, but stats come from N worker processes.
+  """
+
+  def __init__(self, workers, config, accumulators_factory,
+               max_reqs=400000, max_reps=400000, max_events=400000,
+               bucket_secs=60, window_buckets=1):
+    super(StatsWorkerPool, self).__init__()
+    self.setDaemon(True)
+
+    if config.capture_backend != TPACKET:
+      raise ValueError("Multiple workers need the %s capture backend" % TPACKET)
+
+    config = copy.copy(config)
+    config.fanout_group = os.getpid() & 0xffff
+
+    self._lock = Lock()
+    self._freeze = multiprocessing.Event()
+    self._done = set()  # ids of the workers that are done
+    self._drained = Event()
+    self._results = multiprocessing.Queue()
+    self._bucket_secs = bucket_secs
+    self._snapshots = dict(  # worker id -> buckets of (dict of accumulator name -> snapshot)
+      (i, deque(maxlen=window_buckets)) for i in range(workers))
+    self._auth_by_client = {}  # worker id -> auth by client
+    # the workers ship plain snapshots, these know how to aggregate them
+    self._aggregators = accumulators_factory()
+    self._workers = [
+      StatsWorker(
+        i, config, self._results, accumulators_factory, max_reqs, max_reps, max_events,
+        bucket_secs, self._freeze)
+      for i in range(workers)
+    ]
+
+  @property
+  def workers(self):
+    return self._workers
+
+  def start(self):
+    for worker in self._workers:
+      worker.start()
+    super(StatsWorkerPool, self).start()
+
+  def run(self):
+    """ collect the snapshots sent by the workers """
+    log.info("Collecting stats from %d workers ...", len(self._workers))
+    while True:
+      worker_id, snapshots, auth_by_client = self._results.get()
+      if snapshots is None:
+        self._done.add(worker_id)
+        if len(self._done) == len(self._workers):
+          self._drained.set()
+        continue
+
+      with self._lock:
+        self._snapshots[worker_id].append(snapshots)
+        self._auth_by_client[worker_id] = auth_by_client
+
+  def wakeup(self):  # pragma: no cover
+    pass
+
+  def freeze(self, timeout=30):
+    """
+    has the workers ship what they have left & exit (i.e.: once an offline read is done),
+    from then on the stats stay as they are
+    """
+    self._freeze.set()
+    self._drained.wait(timeout)
+    for worker in self._workers:
+      if worker.is_alive():
+        worker.join(timeout)
+
+  @property
+  def auth_by_client(self):
+    merged = {}
+    with self._lock:
+      for auth_by_client in self._auth_by_client.values():
+        merged.update(auth_by_client)
+    return merged
+
+  def buckets_for(self, window):
+    """ how many buckets make up a window of the given secs (None means all of them) """
+    if window is None:
+      return None
+    return max(1, int(math.ceil(float(window) / self._bucket_secs)))
+
+  def _snapshots_for(self, name, window):
+    buckets = self.buckets_for(window)
+    with self._lock:
+      buckets_by_worker = [list(b) for b in self._snapshots.values()]
+
+    if buckets is not None:
+      buckets_by_worker = [b[-buckets:] for b in buckets_by_worker]
+
+    return [s[name] for b in buckets_by_worker for s in b if name in s]
+
+  def stats(self, name, top, window=None, depth=None):
+    snapshots = self._snapshots_for(name, window)
+    aggregator = self._aggregators.get(name)
+    if aggregator is None:
+      return top_stats(merge_stats(snapshots), top)
+    return aggregator.stats_from_snapshots(snapshots, top, depth)
+
+  def counts(self, name, path, window=None):
+    return merge_path_counts(self._snapshots_for(name, window), path)
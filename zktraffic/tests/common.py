@@ -17,7 +17,7 @@
 
 import os
 
-from scapy.sendrecv import sniff
+from zktraffic.base.pcap import PcapReader
 
 
 _resources_dir = os.path.join(
@@ -31,7 +31,7 @@ def get_full_path(name):
 
 
 def consume_packets(capture_file, sniffer):
-  sniff(offline=get_full_path(capture_file), prn=sniffer.handle_packet)
+  PcapReader(get_full_path(capture_file)).run(sniffer.handle_packet)
 
 def is_ci_env():
   # Travis CI: CI=true, TRAVIS=true
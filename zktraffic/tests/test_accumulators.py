@@ -17,11 +17,20 @@
 
 import time
 
+from zktraffic.base.pcap import PcapReader
 from zktraffic.base.sniffer import Sniffer, SnifferConfig
 from zktraffic.stats.loaders import QueueStatsLoader
-from zktraffic.stats.accumulators import PerPathStatsAccumulator
+from zktraffic.stats.timer import Timer
+from zktraffic.base.util import parent_path
+from zktraffic.stats.accumulators import (
+  LatencyStatsAccumulator,
+  PerPathStatsAccumulator,
+  PerPathTrieStatsAccumulator,
+  top_stats,
+)
+from zktraffic.stats.trie import PathTrie
 
-from .common import consume_packets
+from .common import consume_packets, get_full_path
 
 
 class TestablePerPathAccumulator(PerPathStatsAccumulator):
@@ -227,3 +236,255 @@ def test_exclude_bytes():
     assert "Bytes" not in key
 
   stats.stop()
+
+
+class FakeRequest(object):
+  is_auth = False
+  client = "10.0.0.1:5000"
+
+
+class BatchAccumulator(object):
+  def __init__(self):
+    self.batches = []
+
+  def update_request_stats_batch(self, requests):
+    self.batches.append(len(requests))
+
+
+def test_batches():
+  loader = QueueStatsLoader(batch_size=4, max_delay=60)
+  accumulator = BatchAccumulator()
+  loader.register_accumulator('0', accumulator)
+  loader.start()
+
+  # a full batch wakes up the loader
+  for _ in range(4):
+    loader.handle_request(FakeRequest())
+
+  slept = 0
+  while sum(accumulator.batches) < 4 and slept < SLEEP_MAX:
+    time.sleep(0.001)
+    slept += 0.001
+
+  assert accumulator.batches == [4]
+
+  # a partial one needs a wakeup (or max_delay)
+  loader.handle_request(FakeRequest())
+  time.sleep(0.05)
+  assert accumulator.batches == [4]
+
+  loader.wakeup()
+  slept = 0
+  while sum(accumulator.batches) < 5 and slept < SLEEP_MAX:
+    time.sleep(0.001)
+    slept += 0.001
+
+  assert accumulator.batches == [4, 1]
+
+  loader.stop()
+
+
+def test_windows():
+  accumulator = PerPathStatsAccumulator(aggregation_depth=0, include_bytes=False, window_buckets=3)
+
+  for i in range(1, 6):
+    accumulator._cur_stats["writes"]["/a"] = i
+    accumulator.accumulate_stats()
+
+  # only the last 3 buckets are kept: 3, 4 & 5
+  assert accumulator.stats(10, 1)["writes"]["/a"] == 5
+  assert accumulator.stats(10, 2)["writes"]["/a"] == 9
+  assert accumulator.stats(10)["writes"]["/a"] == 12
+  assert accumulator.stats(10, 10)["writes"]["/a"] == 12
+
+  # merged windows are cached until the next accumulation, whatever the top
+  assert accumulator.stats(10, 2) is accumulator.stats(10, 2)
+  assert accumulator.stats(1, 2)["writes"]["/a"] == 9
+  assert sorted(accumulator._merged_cache) == [1, 2, 3]
+  accumulator.accumulate_stats()
+  assert accumulator.stats(10, 2)["writes"]["/a"] == 5
+
+  loader = QueueStatsLoader(bucket_secs=10)
+  loader.register_accumulator('0', accumulator)
+  assert loader.buckets_for(None) is None
+  assert loader.buckets_for(1) == 1
+  assert loader.buckets_for(10) == 1
+  assert loader.buckets_for(25) == 3
+  assert loader.stats('0', 10, 20)["writes"]["/a"] == 5
+
+
+class ManualTimer(Timer):
+  def __init__(self):
+    self.current = 1000.0
+    super(ManualTimer, self).__init__()
+
+  @property
+  def now(self):
+    return self.current
+
+
+class CountingAccumulator(object):
+  def __init__(self):
+    self.accumulated = 0
+
+  def accumulate_stats(self):
+    self.accumulated += 1
+
+
+def test_buckets_dont_drift():
+  timer = ManualTimer()
+  timer.reset(timer.current)
+  loader = QueueStatsLoader(timer=timer, bucket_secs=1)
+  accumulator = CountingAccumulator()
+  loader.register_accumulator('0', accumulator)
+
+  # the loader wakes up a bit late every time, buckets still start every second
+  for i in range(1, 61):
+    timer.current = 1000.0 + i + 0.2
+    loader._rotate_buckets()
+
+  assert accumulator.accumulated == 60
+  assert timer.start == 1060.0
+
+
+def test_frozen_buckets():
+  timer = ManualTimer()
+  timer.reset(timer.current)
+  loader = QueueStatsLoader(timer=timer, bucket_secs=1)
+  accumulator = PerPathStatsAccumulator(aggregation_depth=1, window_buckets=2)
+  loader.register_accumulator('0', accumulator)
+
+  consume_packets("set_data", get_sniffer(loader.handle_request))
+  loader._load()
+  assert loader.stats('0', 10) == {}  # still in the current bucket
+
+  # i.e.: the offline read is done, what was read makes it into a bucket and stays there
+  loader.freeze()
+  loader._load()
+  for i in range(1, 11):
+    timer.current = 1000.0 + i
+    loader._load()
+
+  assert loader.stats('0', 10)["total"]["/writes"] == 20
+  assert loader.stats('0', 10, 1)["total"]["/writes"] == 20
+
+
+def test_offline_single_bucket():
+  timer = ManualTimer()
+  timer.reset(timer.current)
+  loader = QueueStatsLoader(timer=timer, bucket_secs=1, offline=True)
+  accumulator = PerPathStatsAccumulator(aggregation_depth=1, window_buckets=2)
+  loader.register_accumulator('0', accumulator)
+
+  # reading the pcap takes way longer than a bucket (& the whole window)
+  sniffer = get_sniffer(loader.handle_request)
+  for packet in PcapReader(get_full_path("set_data")):
+    sniffer.handle_packet(packet)
+    timer.current += 5
+    loader._load()
+
+  assert loader.stats('0', 10) == {}
+  loader.freeze()
+  loader._load()
+  assert loader.stats('0', 10, 1)["total"]["/writes"] == 20
+
+
+def test_top_stats():
+  stats = {"writes": dict(("/%d" % i, i) for i in range(1000)), "reads": {"/a": 1}}
+
+  top = top_stats(stats, 3)
+
+  assert top["writes"] == {"/999": 999, "/998": 998, "/997": 997}
+  assert top["reads"] == {"/a": 1}
+
+
+def test_path_trie():
+  trie = PathTrie(max_nodes=8)
+  for path in ("/a/b/c", "/a/b/d", "/", "", "/a/", "/x//y", "/tacos:tacos"):
+    for depth in range(1, 5):
+      assert trie.prefix(path, depth) == parent_path(path, depth)
+
+  assert len(trie) <= 8
+
+
+def test_stats_for_any_depth():
+  accumulator = PerPathTrieStatsAccumulator(aggregation_depth=1, include_bytes=False)
+
+  class Message(object):
+    def __init__(self, path):
+      self.path = path
+      self.name = "NodeCreated"
+
+  for path in ("/a/b/c", "/a/b/d", "/a/e", "/f"):
+    accumulator.update_event_stats(Message(path))
+  accumulator.accumulate_stats()
+
+  assert accumulator.stats(10)["NodeCreated"] == {"/a": 3, "/f": 1}
+  assert accumulator.stats(10, depth=2)["NodeCreated"] == {"/a/b": 2, "/a/e": 1, "/f": 1}
+  assert accumulator.stats(10, depth=0)["NodeCreated"] == {
+    "/a/b/c": 1, "/a/b/d": 1, "/a/e": 1, "/f": 1}
+
+  # aggregated as they are counted, so only one depth
+  try:
+    PerPathStatsAccumulator(aggregation_depth=1).stats(10, depth=2)
+    assert False, "only aggregation_depth should be available"
+  except ValueError:
+    pass
+
+
+class Message(object):
+  is_ping = is_auth = is_close = False
+
+  def __init__(self, name, xid, timestamp, path="/", client="10.0.0.1:5000"):
+    self.name, self.xid, self.timestamp, self.path, self.client = name, xid, timestamp, path, client
+
+
+def test_latencies():
+  accumulator = LatencyStatsAccumulator(aggregation_depth=1, window_buckets=2)
+
+  accumulator.update_request_stats_batch([
+    Message("GetDataRequest", 1, 10.0, "/a/b"),
+    Message("GetDataRequest", 2, 10.0, "/a/c"),
+    Message("SetDataRequest", 3, 10.0, "/d"),
+  ])
+  accumulator.update_reply_stats_batch([
+    Message("GetDataReply", 1, 10.001),
+    Message("GetDataReply", 2, 10.003),
+    Message("SetDataReply", 3, 10.01),
+    Message("SetDataReply", 4, 10.01),  # no request
+  ])
+  accumulator.accumulate_stats()
+
+  stats = accumulator.stats(10)
+  assert set(stats["ops"]) == set(["GetDataRequest", "SetDataRequest"])
+  assert stats["ops"]["GetDataRequest"]["count"] == 2
+  assert abs(stats["ops"]["GetDataRequest"]["p999"] - 0.003) <= 0.003 * 0.01
+  assert abs(stats["ops"]["SetDataRequest"]["p50"] - 0.01) <= 0.01 * 0.01
+  assert stats["paths"]["/a"]["count"] == 2
+  assert stats["paths"]["/d"]["count"] == 1
+  assert accumulator.pending.unmatched == 1
+  assert len(accumulator.pending) == 0
+
+  # the busiest paths only
+  assert list(accumulator.stats(1)["paths"]) == ["/a"]
+
+  snapshot = accumulator.snapshot()
+  merged = accumulator.stats_from_snapshots([snapshot, snapshot], 10)
+  assert merged["ops"]["GetDataRequest"]["count"] == 4
+
+
+def test_latencies_from_pcap():
+  loader = QueueStatsLoader()
+  accumulator = LatencyStatsAccumulator(aggregation_depth=1)
+  loader.register_accumulator('0', accumulator)
+  loader.start()
+
+  sniffer = get_sniffer(loader.handle_request, loader.handle_reply)
+  ops = accumulator._cur_stats["ops"]
+  wait_for_stats(sniffer, "connect_replies", lambda: sum(h.count for h in ops.values()) < 3)
+  loader.stop()
+
+  accumulator.accumulate_stats()
+  stats = accumulator.stats(10)
+  assert stats["ops"]["ConnectRequest"]["count"] == 3
+  assert stats["paths"]["/"]["p50"] > 0
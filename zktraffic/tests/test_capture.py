@@ -0,0 +1,78 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+from unittest import skipIf, TestCase
+
+from zktraffic.base.capture import (
+  BLOCK_DESC_STRUCT,
+  BLOCK_STATUS_OFFSET,
+  BLOCK_STATUS_STRUCT,
+  HAS_TPACKET,
+  TP_STATUS_KERNEL,
+  TP_STATUS_USER,
+  TPACKET3_HDR_STRUCT,
+  TPacketV3Capture,
+)
+
+
+def build_block(frames, block_size=4096):
+  """ a TPACKET_V3 block as the kernel would hand it over """
+  ring = bytearray(block_size)
+  first = 48
+  BLOCK_DESC_STRUCT.pack_into(ring, 0, 3, 0, TP_STATUS_USER, len(frames), first)
+
+  offset = first
+  for i, (frame, sec, nsec) in enumerate(frames):
+    mac = 68
+    size = mac + len(frame)
+    size += (16 - size % 16) % 16
+    next_offset = size if i < len(frames) - 1 else 0
+    TPACKET3_HDR_STRUCT.pack_into(
+      ring, offset, next_offset, sec, nsec, len(frame), len(frame), 0, mac, mac + 14)
+    ring[offset + mac:offset + mac + len(frame)] = frame
+    offset += size
+
+  return ring
+
+
+@skipIf(not HAS_TPACKET, "TPACKET_V3 is Linux only")
+class TestTPacketV3Capture(TestCase):
+  def test_consume_block(self):
+    frames = [(b"\x01" * 60, 10, 500000000), (b"\x02" * 100, 11, 0)]
+    capture = TPacketV3Capture("lo")
+    capture._ring = build_block(frames)
+
+    packets = []
+    assert capture._block_ready(0)
+    assert not capture._consume_block(0, packets.append, None)
+
+    assert [p.load for p in packets] == [frames[0][0], frames[1][0]]
+    assert [p.time for p in packets] == [10.5, 11.0]
+
+    # the block must be handed back to the kernel
+    status, = BLOCK_STATUS_STRUCT.unpack_from(capture._ring, BLOCK_STATUS_OFFSET)
+    assert status == TP_STATUS_KERNEL
+    assert not capture._block_ready(0)
+
+  def test_consume_block_stop(self):
+    frames = [(b"\x01" * 60, 10, 0), (b"\x02" * 60, 11, 0)]
+    capture = TPacketV3Capture("lo")
+    capture._ring = build_block(frames)
+
+    packets = []
+    assert capture._consume_block(0, packets.append, lambda p: True)
+    assert len(packets) == 1
@@ -0,0 +1,88 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+import pickle
+import random
+
+from zktraffic.stats.histogram import LogHistogram
+from zktraffic.stats.util import percentile
+
+
+def latencies(n, seed):
+  rand = random.Random(seed)
+  return [rand.lognormvariate(-6, 1.5) for _ in range(n)]
+
+
+def check_quantiles(histogram, values):
+  values = sorted(values)
+  for q in (0.5, 0.9, 0.95, 0.99, 0.999):
+    # the closest ranks are within accuracy, so is anything in between
+    low = values[int((len(values) - 1) * q)]
+    high = values[-1 - int((len(values) - 1) * (1 - q))]
+    assert low * (1 - histogram.accuracy) <= histogram.quantile(q) <= high * (1 + histogram.accuracy)
+
+
+def test_quantiles():
+  values = latencies(20000, 1)
+  histogram = LogHistogram(0.01)
+  for value in values:
+    histogram.add(value)
+
+  assert histogram.count == len(values)
+  assert abs(histogram.avg - sum(values) / len(values)) < 1e-9
+  check_quantiles(histogram, values)
+
+  median = percentile(sorted(values), 0.5)
+  assert abs(histogram.quantile(0.5) - median) <= median * 0.02
+
+  # fixed memory: a bucket per 2% of range, no matter how many values
+  assert len(histogram._buckets) < 1000
+
+
+def test_edges():
+  histogram = LogHistogram(0.01)
+  assert histogram.quantile(0.5) is None
+
+  histogram.add(0)
+  histogram.add(1e9)
+  histogram.add(0.001)
+
+  assert histogram.quantile(0) == 0
+  assert histogram.quantile(1) == 1e9
+  assert abs(histogram.quantile(0.5) - 0.001) <= 0.001 * 0.01
+
+
+def test_merge():
+  histograms = []
+  values = []
+  for seed in range(3):
+    histogram = LogHistogram(0.02)
+    for value in latencies(5000, seed):
+      histogram.add(value)
+      values.append(value)
+    # workers ship them pickled
+    histograms.append(pickle.loads(pickle.dumps(histogram)))
+
+  merged = LogHistogram.merged(histograms)
+  assert merged.count == len(values)
+  assert merged.max == max(values)
+  check_quantiles(merged, values)
+
+  try:
+    LogHistogram(0.01).merge(LogHistogram(0.02))
+    assert False, "merging histograms with different accuracies should fail"
+  except ValueError:
+    pass
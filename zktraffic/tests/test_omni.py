@@ -21,11 +21,11 @@ from zktraffic.base.server_message import ConnectReply, GetChildrenReply
 from zktraffic.network.sniffer import Sniffer
 import zktraffic.fle.message as FLE
 import zktraffic.zab.quorum_packet as ZAB
-from zktraffic.base.network import BadPacket
+from zktraffic.base.network import BadPacket, PacketContext, peek_flow
+from zktraffic.base.pcap import PcapReader
 from zktraffic.base.sniffer import Sniffer as ZKSniffer, SnifferConfig as ZKSnifferConfig
-from zktraffic.omni.omni_sniffer import OmniSniffer
+from zktraffic.omni.omni_sniffer import FlowCache, IGNORED, OmniSniffer, quorum_filter
 from .common import get_full_path
-from scapy.utils import rdpcap
 
 class OmniTestCase(unittest.TestCase):
   PCAP_FILE = 'omni'
@@ -65,7 +65,7 @@ class OmniTestCase(unittest.TestCase):
 
   def test_omni(self):
     sniffer = self.get_sniffer()
-    packets = rdpcap(get_full_path(self.PCAP_FILE))
+    packets = PcapReader(get_full_path(self.PCAP_FILE))
     for i, packet in enumerate(packets):
       try:
         message = sniffer.message_from_packet(packet)
@@ -75,3 +75,46 @@ class OmniTestCase(unittest.TestCase):
       except (BadPacket, struct.error) as ex:
         # exception happens on TCP SYN, RST and so on
         pass
+
+  def test_ignored_flows(self):
+    sniffer = self.get_sniffer()
+    packets = list(PcapReader(get_full_path(self.PCAP_FILE)))
+
+    # nothing's registered before the FLE initial message, so earlier flows are ignored
+    ignored = set()
+    for packet in packets[:15]:
+      try:
+        sniffer.message_from_packet(packet)
+      except (BadPacket, struct.error):
+        pass
+      flow = PacketContext(packet).flow
+      if sniffer._flows.get(flow) is IGNORED:
+        ignored.add(flow)
+    self.assertTrue(len(ignored) > 0)
+    self.assertEqual(set(sniffer._last_tcp_seq) & ignored, set())
+
+    # registering a sniffer forgets about them, they might be for its port
+    sniffer.message_from_packet(packets[15])
+    self.assertTrue(len(sniffer._sniffers) > 0)
+    self.assertEqual(len(sniffer._flows), 0)
+
+  def test_peek_flow(self):
+    for packet in PcapReader(get_full_path(self.PCAP_FILE)):
+      self.assertEqual(peek_flow(packet.load), PacketContext(packet).flow)
+    self.assertEqual(peek_flow(b"\x00" * 20), None)
+
+  def test_flow_cache(self):
+    flows = FlowCache(max_size=2)
+    for i in range(3):
+      flows.put(i, IGNORED)
+    self.assertEqual(len(flows), 3)
+    self.assertEqual(flows.get(0), IGNORED)  # back to the newest generation
+
+    flows.put(3, IGNORED)
+    self.assertEqual(flows.get(1), None)
+    self.assertEqual(flows.get(0), IGNORED)
+
+  def test_quorum_filter(self):
+    self.assertEqual(
+      quorum_filter("tcp", set([3888, 2181, 2888])),
+      "(tcp) and (port 2181 or port 2888 or port 3888)")
@@ -0,0 +1,155 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+from six import StringIO
+
+import struct
+import time
+
+from zktraffic.base.network import PacketContext
+from zktraffic.base.pcap import PcapReader
+from zktraffic.base.sniffer import Sniffer as ZKSniffer, SnifferConfig as ZKSnifferConfig
+from zktraffic.cli.printer import Printer
+from zktraffic.network.sniffer import Sniffer
+from zktraffic.omni.workers import (
+  MergeWriter,
+  OmniPipeline,
+  PipelinedOmniSniffer,
+  ProtocolDecoder,
+  RecordOutput,
+)
+import zktraffic.fle.message as FLE
+import zktraffic.zab.quorum_packet as ZAB
+
+from .common import get_full_path
+
+
+def test_record_output():
+  output = RecordOutput()
+  output.timestamp = 1.5
+  output.write("a")
+  output.write("b")
+  output.timestamp = 2.0
+  output.write("c")
+  assert output.take() == [(1.5, "a"), (1.5, "b"), (2.0, "c")]
+  assert output.take() == []
+
+
+def test_merge_writer():
+  output = StringIO()
+  writer = MergeWriter(["a", "b"], None, output)
+
+  writer.add("a", 3.0, [(1.0, "a1 "), (3.0, "a3 ")])
+  writer.write_ready()
+  assert output.getvalue() == ""  # b might still write something older
+
+  writer.add("b", 2.0, [(2.0, "b2 ")])
+  writer.write_ready()
+  assert output.getvalue() == "a1 b2 "
+  assert writer.pending == 1
+
+  # once b's done, a's watermark is all that counts
+  writer.add("b", None, [(2.5, "b2.5 ")])
+  writer.write_ready()
+  assert output.getvalue() == "a1 b2 b2.5 a3 "
+
+  writer.add("a", None, [(4.0, "a4 ")])
+  writer.write_ready()
+  assert output.getvalue() == "a1 b2 b2.5 a3 a4 "
+  assert writer.pending == 0
+
+
+def test_protocol_decoder():
+  output = RecordOutput()
+  decoder = ProtocolDecoder("zk", output)
+  for packet in PcapReader(get_full_path("omni")):
+    ctx = PacketContext(packet)
+    if 2181 in (ctx.tcp.sport, ctx.tcp.dport):
+      decoder.handle(2181, packet.load, packet.time)
+
+  lines = [text for _, text in output.take()]
+  assert "ConnectRequest" in lines[0]
+  assert "ConnectReply" in lines[1]
+  assert any("GetChildrenReply" in line for line in lines)
+
+
+def test_protocol_decoder_bad_frame():
+  output = RecordOutput()
+  decoder = ProtocolDecoder("zk", output)
+  packets = []
+  for packet in PcapReader(get_full_path("omni")):
+    ctx = PacketContext(packet)
+    if 2181 in (ctx.tcp.sport, ctx.tcp.dport):
+      packets.append((packet, len(packet.load) - len(ctx.data)))
+
+  # a request with a negative length doesn't take the decoder down
+  packet, offset = packets[0]
+  bad = packet.load[:offset] + struct.pack("!i", -5) + packet.load[offset + 4:]
+  decoder.handle(2181, bad, packet.time)
+
+  for packet, _ in packets[1:]:
+    decoder.handle(2181, packet.load, packet.time)
+  assert any("GetChildrenReply" in text for _, text in output.take())
+
+
+def test_pipeline_dead_worker():
+  output = StringIO()
+  pipeline = OmniPipeline(1, output=output)
+  pipeline.start()
+  pipeline.workers[0].terminate()
+  pipeline.workers[0].join(10)
+
+  # the dead worker's watermark doesn't hold back what the parent wrote
+  pipeline.tick(1.0)
+  pipeline.local_output.write("fle ")
+  started = time.time()
+  pipeline.stop(timeout=30)
+  assert time.time() - started < 10
+  assert output.getvalue() == "fle "
+
+
+def test_pipeline():
+  output = StringIO()
+  pipeline = OmniPipeline(2, output=output, batch_size=8)
+  printer = Printer(False, output=pipeline.local_output, start=False)
+
+  def fle_sniffer_factory(port):
+    return Sniffer(None, port, FLE.Message, printer.print_message, start=False)
+
+  def zab_sniffer_factory(port):
+    return Sniffer(None, port, ZAB.QuorumPacket, None, start=False)
+
+  def zk_sniffer_factory(port):
+    config = ZKSnifferConfig(None)
+    config.zookeeper_port = port
+    config.client_port = 0
+    return ZKSniffer(config)
+
+  pipeline.start()
+  sniffer = PipelinedOmniSniffer(
+    pipeline, fle_sniffer_factory, zab_sniffer_factory, zk_sniffer_factory, start=False)
+  sniffer.run(offline=get_full_path("omni"))
+  pipeline.stop(timeout=30)
+
+  for worker in pipeline.workers:
+    assert not worker.is_alive()
+
+  text = output.getvalue()
+  for name in ("Notification(", "FollowerInfo(", "UpToDate(", "ConnectRequest(", "CreateReply("):
+    assert name in text, name
+
+  # ZAB & ZK come from different workers, but they are merged in timestamp order
+  assert text.index("UpToDate(") < text.index("ConnectRequest(") < text.index("CreateReply(")
@@ -26,10 +26,12 @@ from zktraffic.base.server_message import (
   MultiReply,
   ReconfigReply,
 )
+from zktraffic.base.network import BadPacket, PacketContext
+from zktraffic.base.pcap import PcapReader
 from zktraffic.base.sniffer import Sniffer, SnifferConfig
 from zktraffic.stats.accumulators import PerPathStatsAccumulator
 
-from .common import consume_packets
+from .common import consume_packets, get_full_path
 
 
 def default_sniffer(aggregation_depth=1):
@@ -164,3 +166,73 @@ def test_four_letter():
 
   assert stats._cur_stats["ConnectRequest"]["/"] == 1
   assert stats._cur_stats["GetChildrenRequest"]["/"] == 1
+
+
+def test_zero_copy_same_messages():
+  def messages(pcap_name, zero_copy_min_size):
+    config = SnifferConfig()
+    config.track_replies = True
+    config.zero_copy_min_size = zero_copy_min_size
+    sniffer = Sniffer(config)
+    seen = []
+    sniffer.add_request_handler(seen.append)
+    sniffer.add_reply_handler(seen.append)
+    sniffer.add_event_handler(seen.append)
+    consume_packets(pcap_name, sniffer)
+    return [str(m) for m in seen]
+
+  for pcap_name in ('create', 'connect_replies', 'getdata_watches', 'multi', 'reconfig'):
+    assert messages(pcap_name, 0) == messages(pcap_name, 1 << 20)
+
+
+def test_lazy_decode():
+  def requests(pcap_name, lazy_decode):
+    config = SnifferConfig()
+    config.lazy_decode = lazy_decode
+    sniffer = Sniffer(config)
+    seen = []
+    sniffer.add_request_handler(seen.append)
+    consume_packets(pcap_name, sniffer)
+    return seen
+
+  for pcap_name in ('create', 'create-pyzookeeper', 'reconfig', 'setwatches'):
+    eager = requests(pcap_name, False)
+    lazy = requests(pcap_name, True)
+
+    assert [r.name for r in lazy] == [r.name for r in eager]
+    assert [r.path for r in lazy] == [r.path for r in eager]
+    assert [r.watch for r in lazy] == [r.watch for r in eager]
+
+    # touches the lazy fields
+    assert [str(r) for r in lazy] == [str(r) for r in eager]
+
+  lazy = [r for r in requests('create', True) if r.name.startswith('Create')]
+  assert all('_lazy_params' in r.__dict__ for r in lazy)
+  assert [len(r.acls) for r in lazy] == [1] * len(lazy)
+  assert not any('_lazy_params' in r.__dict__ for r in lazy)
+
+  req = [r for r in requests('setwatches', True) if isinstance(r, SetWatchesRequest)][0]
+  assert len(req.child) == 5
+  assert req.relzxid > 0
+
+
+def test_packet_context():
+  def messages(pcap_name, decode):
+    config = SnifferConfig()
+    config.track_replies = True
+    sniffer = Sniffer(config)
+    msgs = []
+    for packet in PcapReader(get_full_path(pcap_name)):
+      try:
+        msgs.append(sniffer.message_from_packet(decode(packet)))
+      except BadPacket:
+        pass
+    return [(str(m), m.client, m.server, m.timestamp) for m in msgs if m]
+
+  for pcap_name in ('connect_replies', 'getdata_watches', 'multi'):
+    assert messages(pcap_name, PacketContext) == messages(pcap_name, lambda p: p)
+
+  packet = PacketContext(next(iter(PcapReader(get_full_path('set_data')))))
+  assert packet.src_addr == "%s:%d" % packet.src
+  assert packet.dst_addr == "%s:%d" % packet.dst
+  assert packet.data == packet.tcp.data
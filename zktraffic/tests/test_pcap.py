@@ -0,0 +1,148 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+import os
+import shutil
+import struct
+import tempfile
+
+from zktraffic.base.pcap import (
+  LINKTYPE_ETHERNET,
+  LINKTYPE_NULL,
+  PCAP_MAGIC_NSEC,
+  PCAP_MAGIC_USEC,
+  PCAPNG_BYTE_ORDER_MAGIC,
+  PCAPNG_EPB,
+  PCAPNG_IDB,
+  PCAPNG_IF_TSRESOL,
+  PCAPNG_SHB,
+  PcapError,
+  PcapReader,
+)
+from zktraffic.base.sniffer import Sniffer, SnifferConfig
+
+from .common import get_full_path
+
+
+FRAMES = [(b"\x01" * 60, 1400000000, 500000), (b"\x02" * 99, 1400000001, 0)]
+
+
+def build_pcap(frames, endian="<", nsecs=False, linktype=LINKTYPE_ETHERNET):
+  magic = PCAP_MAGIC_NSEC if nsecs else PCAP_MAGIC_USEC
+  data = struct.pack(endian + "IHHiIII", magic, 2, 4, 0, 0, 65535, linktype)
+  for frame, secs, usecs in frames:
+    frac = usecs * 1000 if nsecs else usecs
+    data += struct.pack(endian + "IIII", secs, frac, len(frame), len(frame)) + frame
+  return data
+
+
+def pcapng_block(block_type, body, endian):
+  body += b"\x00" * ((4 - len(body) % 4) % 4)
+  length = len(body) + 12
+  return struct.pack(endian + "II", block_type, length) + body + struct.pack(endian + "I", length)
+
+
+def build_pcapng(frames, endian="<", tsresol=6):
+  shb = struct.pack(endian + "IHHq", PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1)
+  options = struct.pack(endian + "HHB3x", PCAPNG_IF_TSRESOL, 1, tsresol) + b"\x00" * 4
+  idb = struct.pack(endian + "HHI", LINKTYPE_ETHERNET, 0, 65535) + options
+
+  data = pcapng_block(PCAPNG_SHB, shb, endian) + pcapng_block(PCAPNG_IDB, idb, endian)
+  data += pcapng_block(0x00000005, b"\x00" * 8, endian)  # interface statistics, skipped
+  for frame, secs, usecs in frames:
+    ts = (secs * 10 ** 6 + usecs) * 10 ** (tsresol - 6)
+    epb = struct.pack(endian + "IIIII", 0, ts >> 32, ts & 0xffffffff, len(frame), len(frame))
+    data += pcapng_block(PCAPNG_EPB, epb + frame, endian)
+  return data
+
+
+def read_frames(data):
+  tmpdir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(tmpdir, "capture")
+    with open(path, "wb") as fp:
+      fp.write(data)
+    reader = PcapReader(path, buffer_size=64)
+    return reader, [(p.load, p.time) for p in reader]
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def assert_frames(packets, frames=FRAMES):
+  assert len(packets) == len(frames)
+  for (load, time), (frame, secs, usecs) in zip(packets, frames):
+    assert load == frame
+    assert abs(time - (secs + usecs * 1e-6)) < 1e-6
+
+
+def test_pcap():
+  for endian in ("<", ">"):
+    for nsecs in (False, True):
+      reader, packets = read_frames(build_pcap(FRAMES, endian, nsecs))
+      assert reader.linktype == LINKTYPE_ETHERNET
+      assert not reader.is_loopback
+      assert_frames(packets)
+
+
+def test_pcapng():
+  for endian in ("<", ">"):
+    for tsresol in (6, 9):
+      reader, packets = read_frames(build_pcapng(FRAMES, endian, tsresol))
+      assert reader.linktype == LINKTYPE_ETHERNET
+      assert_frames(packets)
+
+
+def test_loopback():
+  reader, packets = read_frames(build_pcap(FRAMES, linktype=LINKTYPE_NULL))
+  assert reader.is_loopback
+  assert_frames(packets)
+
+
+def test_truncated():
+  data = build_pcap(FRAMES)
+  _, packets = read_frames(data[:-10])
+  assert_frames(packets, FRAMES[:1])
+
+  _, packets = read_frames(build_pcap([]))
+  assert packets == []
+
+
+def test_bad_files():
+  for data in (b"", b"\x00" * 24, build_pcap(FRAMES, linktype=113)):
+    try:
+      read_frames(data)
+      assert False, "should have raised PcapError"
+    except PcapError:
+      pass
+
+
+def test_resource():
+  reader = PcapReader(get_full_path("set_data"))
+  packets = list(reader)
+  assert len(packets) == 74
+  assert abs(packets[0].time - 1373501301.086018) < 1e-6
+  assert len(packets[0].load) == 74
+
+
+def test_sniffer_offline():
+  requests = []
+  config = SnifferConfig()
+  config.offline = get_full_path("set_data")
+  sniffer = Sniffer(config, requests.append)
+  sniffer.run()
+
+  set_data = [req for req in requests if req.name == "SetDataRequest"]
+  assert len(set_data) == 20
@@ -0,0 +1,80 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+from zktraffic.base.pending import PendingRequests
+from zktraffic.base.server_message import ServerMessage
+from zktraffic.base.zookeeper import OpCodes
+
+
+def test_pop():
+  pending = PendingRequests()
+  pending.add("10.0.0.1:5000", 1, OpCodes.GETDATA, 0)
+  pending.add("10.0.0.2:5000", 1, OpCodes.CREATE, 0)
+
+  assert pending.pop("10.0.0.1:5000", 1) == OpCodes.GETDATA
+  assert pending.pop("10.0.0.1:5000", 1) is None
+  assert pending.for_client("10.0.0.2:5000").pop(1) == OpCodes.CREATE
+  assert len(pending) == 0
+  assert pending.unmatched == 1
+
+
+def test_ttl():
+  pending = PendingRequests(ttl=10)
+  pending.add("10.0.0.1:5000", 1, OpCodes.GETDATA, 100)
+  pending.add("10.0.0.1:5000", 2, OpCodes.GETDATA, 105)
+  pending.add("10.0.0.1:5000", 3, OpCodes.GETDATA, 112)
+
+  assert ("10.0.0.1:5000", 1) not in pending
+  assert len(pending) == 2
+  assert pending.expired == 1
+
+
+def test_max_size():
+  pending = PendingRequests(max_size=100)
+  for i in range(150):
+    pending.add("10.0.0.%d:5000" % (i % 7), i, OpCodes.EXISTS, 0)
+
+  assert len(pending) == 100
+  assert pending.evicted == 50
+  assert ("10.0.0.0:5000", 0) not in pending
+  assert ("10.0.0.2:5000", 149) in pending
+
+
+def test_drop_client():
+  pending = PendingRequests()
+  for i in range(10):
+    pending.add("10.0.0.1:5000", i, OpCodes.EXISTS, 0)
+  pending.add("10.0.0.2:5000", 1, OpCodes.EXISTS, 0)
+
+  pending.drop_client("10.0.0.1:5000")
+
+  assert len(pending) == 1
+  assert pending.pop("10.0.0.2:5000", 1) == OpCodes.EXISTS
+
+
+def test_server_message_view():
+  pending = PendingRequests()
+  pending.add("10.0.0.1:5000", 7, OpCodes.EXISTS, 0)
+
+  # reply to xid 7, with the stat it carries zeroed
+  data = b"\x00\x00\x00\x60" + b"\x00\x00\x00\x07" + b"\x00" * 92
+  reply = ServerMessage.from_payload(data, "10.0.0.1:5000", "10.0.0.9:2181",
+                                     pending.for_client("10.0.0.1:5000"))
+
+  assert reply.name == "ExistsReply"
+  assert reply.xid == 7
+  assert len(pending) == 0
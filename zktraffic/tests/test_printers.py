@@ -19,13 +19,18 @@ try:
 except ImportError:
   from io import StringIO
 
+from threading import Thread
+
 import time
 
 from zktraffic.base.sniffer import Sniffer, SnifferConfig
 from zktraffic.cli.printer import (
+  BufferedOutput,
   CountPrinter,
   DefaultPrinter,
   LatencyPrinter,
+  MessageQueue,
+  printer_output,
   UnpairedPrinter
 )
 
@@ -185,3 +190,88 @@ def test_latency_printer():
   assert "ExistsRequest" in output.getvalue()
   assert "GetChildrenRequest" in output.getvalue()
   assert "SetDataRequest" in output.getvalue()
+  # live percentiles while collecting
+  assert "Collecting (10/10) p50=" in output.getvalue()
+
+
+def test_message_queue():
+  queue = MessageQueue(max_wait=5)
+  queue.append(1)
+  queue.append(2)
+  assert queue.drain() == [1, 2]
+  assert len(queue) == 0
+
+  # an idle consumer gets woken up by the next append
+  drained = []
+  consumer = Thread(target=lambda: drained.extend(queue.drain()))
+  consumer.start()
+  time.sleep(0.05)
+  start = time.time()
+  queue.append(3)
+  consumer.join()
+  assert drained == [3]
+  assert time.time() - start < 1
+
+  # as well as by wakeup(), with nothing to drain
+  consumer = Thread(target=queue.drain)
+  consumer.start()
+  time.sleep(0.05)
+  queue.wakeup()
+  consumer.join(1)
+  assert not consumer.is_alive()
+
+
+class CountingOutput(StringIO):
+  def __init__(self):
+    StringIO.__init__(self)
+    self.flushes = 0
+
+  def flush(self):
+    self.flushes += 1
+
+
+def test_buffered_output():
+  output = CountingOutput()
+  buffered = BufferedOutput(output, max_bytes=10, max_delay=60)
+
+  buffered.write("12345")
+  buffered.flush()
+  assert output.getvalue() == ""
+
+  # flushed once there's max_bytes
+  buffered.write("67890")
+  buffered.flush()
+  assert output.getvalue() == "1234567890"
+  assert output.flushes == 1
+
+  # and on close
+  buffered.write("abc")
+  buffered.close()
+  assert output.getvalue() == "1234567890abc"
+
+
+def test_buffered_output_delay():
+  output = CountingOutput()
+  buffered = BufferedOutput(output, max_bytes=1 << 20, max_delay=0.01)
+  buffered.write("abc")
+  buffered.flush()
+
+  slept = 0
+  while output.getvalue() != "abc" and slept < 5:
+    time.sleep(0.01)
+    slept += 0.01
+
+  assert output.getvalue() == "abc"
+  buffered.close()
+
+
+def test_printer_output():
+  class Terminal(StringIO):
+    def isatty(self):
+      return True
+
+  terminal = Terminal()
+  assert printer_output(True, terminal) is terminal
+  assert isinstance(printer_output(True, StringIO()), BufferedOutput)
+  assert not isinstance(printer_output(False, StringIO()), BufferedOutput)
+
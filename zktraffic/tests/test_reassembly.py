@@ -0,0 +1,210 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+import struct
+
+from zktraffic.base.client_message import GetDataRequest
+from zktraffic.base.reassembly import StreamReassembler
+from zktraffic.base.sniffer import Sniffer, SnifferConfig
+
+from .common import consume_packets
+
+
+def frame(payload):
+  return struct.pack("!i", len(payload)) + payload
+
+
+def get_data_request(xid, path, watch=False):
+  path = path.encode("utf-8")
+  return frame(struct.pack("!ii", xid, 4) + struct.pack("!i", len(path)) + path +
+               struct.pack("B", 1 if watch else 0))
+
+
+def test_pipelined_frames():
+  ra = StreamReassembler()
+  frames = [frame(b"a" * 10), frame(b"b" * 20), frame(b"c" * 5)]
+
+  assert ra.add("flow", 1000, b"".join(frames)) == frames
+
+
+def test_frame_across_segments():
+  ra = StreamReassembler()
+  data = frame(b"x" * 100)
+
+  assert ra.add("flow", 1000, data[:3]) == []
+  assert ra.add("flow", 1003, data[3:50]) == []
+  assert ra.pending("flow") == 50
+  assert ra.add("flow", 1050, data[50:]) == [data]
+  assert ra.pending("flow") == 0
+
+
+def test_out_of_order_and_retransmits():
+  ra = StreamReassembler()
+  data = frame(b"x" * 30) + frame(b"y" * 30)
+
+  assert ra.add("flow", 0, data[:20]) == []
+  assert ra.add("flow", 40, data[40:]) == []      # hole
+  assert ra.add("flow", 0, data[:20]) == []       # retransmit
+  assert ra.add("flow", 10, data[10:40]) == [data[:34], data[34:]]
+  assert ra.pending("flow") == 0
+
+
+def test_hole_on_frame_boundary():
+  ra = StreamReassembler()
+  a, b, c = frame(b"a" * 10), frame(b"b" * 10), frame(b"c" * 10)
+
+  assert ra.add("flow", 0, a) == [a]
+  # b didn't make it into the capture, c doesn't wait for it
+  assert ra.add("flow", 2 * len(a), c) == [c]
+  assert ra.skipped_holes == 1
+  # and if it shows up after all, it's still a frame on its own
+  assert ra.add("flow", len(a), b) == [b]
+  assert ra.add("flow", 0, a) == []
+  assert ra.pending("flow") == 0
+
+
+def test_longer_retransmit_at_same_seq():
+  ra = StreamReassembler()
+  data = frame(b"x" * 30) + frame(b"y" * 30)
+
+  assert ra.add("flow", 0, data[:10]) == []
+  assert ra.add("flow", 20, data[20:26]) == []    # hole
+  assert ra.add("flow", 20, data[20:]) == []      # the full retransmit
+  assert ra.add("flow", 10, data[10:20]) == [data[:34], data[34:]]
+  assert ra.pending("flow") == 0
+
+
+def test_overlapping_out_of_order_segments():
+  ra = StreamReassembler()
+  data = frame(b"x" * 30) + frame(b"y" * 30)
+
+  assert ra.add("flow", 0, data[:4]) == []
+  assert ra.add("flow", 10, data[10:15]) == []
+  assert ra.add("flow", 12, data[12:]) == []
+  # both are remapped to 14, the longest one has to win
+  assert ra.add("flow", 4, data[4:14]) == [data[:34], data[34:]]
+  assert ra.pending("flow") == 0
+
+
+def test_sequence_wraps():
+  ra = StreamReassembler()
+  data = frame(b"z" * 16)
+  seq = (1 << 32) - 8
+
+  assert ra.add("flow", seq, data[:8]) == []
+  assert ra.add("flow", 0, data[8:]) == [data]
+
+
+def test_syn_resets_flow():
+  ra = StreamReassembler()
+  data = frame(b"z" * 16)
+
+  assert ra.add("flow", 500, data[:8]) == []
+  assert ra.add("flow", 99, b"", syn=True) == []
+  assert ra.add("flow", 100, data) == [data]
+
+
+def test_bogus_length_resyncs():
+  ra = StreamReassembler(max_buffer=64)
+  data = frame(b"z" * 16)
+
+  # handed over as is, the sniffer gets to decide what it is
+  assert ra.add("flow", 0, b"\x7f\x00\x00\x00" + b"garbage") == [b"\x7f\x00\x00\x00garbage"]
+  assert ra.unframed == 1
+  assert ra.pending("flow") == 0
+  assert ra.add("flow", 11, data) == [data]
+
+
+def test_unprefixed_requests():
+  config = SnifferConfig()
+  config.reassemble = True
+  sniffer = Sniffer(config)
+
+  # no length, the xid comes first (see ClientMessage.from_payload)
+  ping = struct.pack("!ii", -2, 11)
+  data = get_data_request(1, "/a")
+  key = ("127.0.0.1:5000", True)
+  frames = sniffer._reassembler.add(key, 0, ping)
+  frames += sniffer._reassembler.add(key, len(ping), data)
+  requests = [sniffer._client_message(f, "127.0.0.1:5000", "127.0.0.1:2181", 0) for f in frames]
+
+  assert [r.name for r in requests] == ["PingRequest", "GetDataRequest"]
+
+
+def test_limits():
+  ra = StreamReassembler(max_flows=2, max_out_of_order=16)
+
+  ra.add("a", 0, b"\x00")
+  ra.add("b", 0, b"\x00")
+  ra.add("c", 0, b"\x00")
+  assert len(ra) == 2
+  assert ra.evicted_flows == 1
+  assert ra.pending("a") == 0
+
+  data = frame(b"x" * 28)
+  assert ra.add("c", 100, data) == [data]  # too far ahead, start over from there
+  assert ra.resyncs == 1
+  assert ra.pending("c") == 0
+
+
+def test_memory_budget():
+  ra = StreamReassembler(max_buffer=64, max_bytes=100)
+  data = frame(b"x" * 60)
+
+  for key in "abcd":
+    assert ra.add(key, 0, data[:40]) == []
+  # d pushed the oldest flows (a & b) out
+  assert ra.evicted_flows == 2
+  assert ra.buffered == 80
+  assert ra.pending("a") == ra.pending("b") == 0
+
+  assert ra.add("c", 40, data[40:]) == [data]
+  assert ra.buffered == 40
+  ra.close("d")
+  assert ra.buffered == 0
+
+
+def test_sniffer_pipelined_requests():
+  config = SnifferConfig()
+  config.reassemble = True
+  sniffer = Sniffer(config)
+
+  data = get_data_request(1, "/a", True) + get_data_request(2, "/b")
+  key = ("127.0.0.1:5000", True)
+  frames = sniffer._reassembler.add(key, 0, data[:-5])
+  frames += sniffer._reassembler.add(key, len(data) - 5, data[-5:])
+  requests = [sniffer._client_message(f, "127.0.0.1:5000", "127.0.0.1:2181", 0) for f in frames]
+
+  assert [type(r) for r in requests] == [GetDataRequest, GetDataRequest]
+  assert [r.path for r in requests] == ["/a", "/b"]
+  assert [r.watch for r in requests] == [True, False]
+
+
+def test_sniffer_reassembly_same_messages():
+  def messages(reassemble):
+    config = SnifferConfig()
+    config.track_replies = True
+    config.reassemble = reassemble
+    sniffer = Sniffer(config)
+    seen = []
+    sniffer.add_request_handler(seen.append)
+    sniffer.add_reply_handler(seen.append)
+    sniffer.add_event_handler(seen.append)
+    consume_packets("dump", sniffer)
+    return [str(m) for m in seen]
+
+  assert messages(True) == messages(False)
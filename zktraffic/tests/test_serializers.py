@@ -0,0 +1,79 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+from io import BytesIO
+
+import json
+
+from zktraffic.base.sniffer import Sniffer, SnifferConfig
+from zktraffic.cli.printer import DefaultPrinter
+from zktraffic.cli.serializers import (
+  BinarySerializer,
+  FIELDS,
+  JsonLinesSerializer,
+  read_binary_records,
+  record_of,
+)
+
+from .common import consume_packets
+
+
+def messages(pcap_name):
+  config = SnifferConfig()
+  config.track_replies = True
+  sniffer = Sniffer(config)
+  seen = []
+  sniffer.add_request_handler(seen.append)
+  sniffer.add_reply_handler(seen.append)
+  sniffer.add_event_handler(seen.append)
+  consume_packets(pcap_name, sniffer)
+  return seen
+
+
+def test_json_lines():
+  serializer = JsonLinesSerializer()
+  for msg in messages("connect_replies"):
+    line = serializer.serialize(msg)
+    assert line.endswith("\n") and line.count("\n") == 1
+
+    record = json.loads(line)
+    assert set(record) == set(FIELDS)
+    assert record == record_of(msg)
+
+  request = messages("multi")[0]
+  assert json.loads(serializer.serialize(request, 0.25)) == record_of(request, 0.25)
+
+
+def test_binary_round_trip():
+  serializer = BinarySerializer()
+  msgs = messages("multi") + messages("getdata_watches")
+  data = b"".join(serializer.serialize(msg, 0.25) for msg in msgs)
+
+  records = list(read_binary_records(data))
+  assert len(records) == len(msgs)
+  for msg, record in zip(msgs, records):
+    assert record == record_of(msg, 0.25)
+
+
+def test_paired_latency():
+  request, reply = messages("multi")
+  output = BytesIO()
+  printer = DefaultPrinter(False, False, output, BinarySerializer())
+  printer.write(request, reply)
+
+  records = list(read_binary_records(output.getvalue()))
+  assert records[0]["latency"] is None
+  assert abs(records[1]["latency"] - (reply.timestamp - request.timestamp)) < 1e-9
@@ -0,0 +1,193 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+from bisect import bisect
+from collections import Counter
+import random
+
+import pickle
+
+from zktraffic.stats.accumulators import (
+  merge_path_counts,
+  merge_stats,
+  PathCountsAccumulator,
+  PerPathStatsAccumulator,
+  top_stats,
+)
+from zktraffic.stats.sketches import CountMinSketch, SpaceSaving
+
+
+def zipf_stream(n, keys, seed):
+  rand = random.Random(seed)
+  cumulative = []
+  total = 0
+  for i in range(keys):
+    total += 1.0 / (i + 1)
+    cumulative.append(total)
+  return ["/k/%d" % bisect(cumulative, rand.random() * total) for _ in range(n)]
+
+
+def check_bounds(table, true_counts):
+  for key, count in table.items():
+    assert count - table.error(key) <= true_counts[key] <= count
+
+  for key, count in true_counts.items():
+    if key not in table:
+      assert count <= table.min_count
+
+
+def test_exact_when_there_is_room():
+  table = SpaceSaving(10)
+  for key in ("/a", "/b", "/a", "/c", "/a"):
+    table[key] += 1
+
+  assert dict(table.items()) == {"/a": 3, "/b": 1, "/c": 1}
+  assert table.error("/a") == 0
+  assert table.min_count == 0
+
+
+def test_bounds():
+  stream = zipf_stream(20000, 2000, 1)
+  table = SpaceSaving(100)
+  for key in stream:
+    table[key] += 1
+
+  true_counts = Counter(stream)
+  assert len(table) == 100
+  check_bounds(table, true_counts)
+
+  # anything seen more than total / capacity times is there
+  for key, count in true_counts.items():
+    if count > len(stream) / 100:
+      assert key in table
+
+
+def test_weights():
+  table = SpaceSaving(2)
+  table["/a"] += 10
+  table["/b"] += 5
+  table["/c"] += 1
+
+  assert "/b" not in table
+  assert table["/c"] == 6
+  assert table.error("/c") == 5
+
+
+def test_merge():
+  streams = [zipf_stream(5000, 1000, seed) for seed in range(4)]
+  tables = []
+  for stream in streams:
+    table = SpaceSaving(50)
+    for key in stream:
+      table[key] += 1
+    tables.append(table)
+
+  merged = SpaceSaving.merge(tables)
+
+  assert len(merged) == 50
+  check_bounds(merged, Counter(key for stream in streams for key in stream))
+
+
+def test_accumulator():
+  accumulator = PerPathStatsAccumulator(0, include_bytes=False, window_buckets=2, capacity=8)
+
+  for bucket in range(2):
+    for key in zipf_stream(1000, 100, bucket):
+      accumulator._cur_stats["GetDataRequest"][key] += 1
+    accumulator.accumulate_stats()
+
+  stats = accumulator.stats(3)
+  assert len(stats["GetDataRequest"]) == 3
+  assert set(stats["GetDataRequestErrorBound"]) == set(stats["GetDataRequest"])
+  assert stats["GetDataRequest"]["/k/0"] >= max(stats["GetDataRequest"].values())
+
+  # snapshots keep the summaries, so workers can be merged properly
+  snapshot = accumulator.snapshot()
+  assert isinstance(snapshot["GetDataRequest"], SpaceSaving)
+  merged = top_stats(merge_stats([snapshot, snapshot]), 3)
+  assert merged["GetDataRequest"]["/k/0"] == 2 * accumulator.stats(3, 1)["GetDataRequest"]["/k/0"]
+
+
+def test_count_min_bounds():
+  stream = zipf_stream(20000, 2000, 2)
+  sketch = CountMinSketch(512, 4)
+  for key in stream:
+    sketch.add(key)
+
+  true_counts = Counter(stream)
+  assert sketch.total == len(stream)
+  for key, count in true_counts.items():
+    assert count <= sketch.query(key) <= count + 3 * len(stream) / 512
+
+  assert sketch.query("/never/seen") <= 3 * len(stream) / 512
+
+
+def test_count_min_rows_differ():
+  # every row must use its own column, or the sketch is as good as depth 1
+  for width in (8, 2048, 1009):
+    sketch = CountMinSketch(width, 4)
+    for i in range(5000):
+      assert len(set(sketch._indexes("/key/%d" % i))) == 4
+
+
+def test_count_min_merge():
+  streams = [zipf_stream(2000, 500, seed) for seed in range(3)]
+  sketches = []
+  for stream in streams:
+    sketch = CountMinSketch(256, 4)
+    for key in stream:
+      sketch.add(key)
+    # workers ship them pickled
+    sketches.append(pickle.loads(pickle.dumps(sketch)))
+
+  merged = CountMinSketch.merge(sketches)
+  true_counts = Counter(key for stream in streams for key in stream)
+  assert merged.total == sum(true_counts.values())
+  for key, count in true_counts.items():
+    assert count <= merged.query(key)
+
+  try:
+    CountMinSketch.merge([CountMinSketch(256, 4), CountMinSketch(128, 4)])
+    assert False, "merging sketches with different dimensions should fail"
+  except ValueError:
+    pass
+
+
+class Request(object):
+  def __init__(self, name, path):
+    self.name = name
+    self.path = path
+
+
+def test_path_counts():
+  accumulator = PathCountsAccumulator(1024, 4, window_buckets=2)
+
+  assert accumulator.counts("/a") == {}
+
+  accumulator.update_request_stats_batch(
+    [Request("GetDataRequest", "/a")] * 3 + [Request("SetDataRequest", "/a/b")])
+  accumulator.accumulate_stats()
+  accumulator.update_request_stats_batch([Request("GetDataRequest", "/a")] * 2)
+  accumulator.accumulate_stats()
+
+  assert accumulator.counts("/a") == {"GetDataRequest": 5}
+  assert accumulator.counts("/a", 1) == {"GetDataRequest": 2}
+  assert accumulator.counts("/a/b") == {"SetDataRequest": 1}
+  assert accumulator.counts("/c") == {}
+
+  snapshot = accumulator.snapshot()
+  assert merge_path_counts([snapshot, snapshot], "/a") == {"GetDataRequest": 4}
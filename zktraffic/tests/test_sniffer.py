@@ -20,7 +20,7 @@ import signal
 import socket
 import sys
 
-from zktraffic.base.sniffer import Sniffer, SnifferConfig
+from zktraffic.base.sniffer import sampling_filter, Sniffer, SnifferConfig
 
 from scapy.sendrecv import sniff
 import mock
@@ -91,3 +91,14 @@ class TestSniffer(TestCase):
     self.zkt.config.update_filter()
     assert self.zkt.config.filter == '%s and (host %s or host %s or host %s)' % (
         filter_text, included_ip, included_ip_two, included_ip_three)
+
+  def test_sampling(self):
+    filter_text = 'port 2181'
+    self.zkt.config.sampling = 0.25
+    self.zkt.config.update_filter()
+    assert self.zkt.config.filter == '%s and %s' % (filter_text, sampling_filter(0.25))
+    assert '& 1023) < 256' in self.zkt.config.filter
+
+    self.zkt.config.sampling = 1.0
+    self.zkt.config.update_filter()
+    assert self.zkt.config.filter == filter_text
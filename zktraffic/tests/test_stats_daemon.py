@@ -22,7 +22,7 @@ import time
 from zktraffic.stats.timer import Timer
 from zktraffic.endpoints.stats_server import StatsServer
 
-from .common import consume_packets
+from .common import consume_packets, get_full_path
 
 import bottle
 from twitter.common.http import HttpServer
@@ -141,3 +141,106 @@ def test_endpoints():
   assert auths_dump["127.0.0.1:59817"] == "noauth"
 
   conn.close()
+
+
+def stats_server(pcap="set_data", **kwargs):
+  """ a StatsServer with the stats for pcap (& the ZAB traffic in omni, if zab_port) """
+  stats = StatsServer("yolo", 2181, 1, 10, 100, 100, 100, False, FakeTimer(), **kwargs)
+  if stats.zab_sniffer:
+    stats.zab_sniffer.run(offline=get_full_path("omni"))
+  consume_packets(pcap, stats.sniffer)
+
+  # everything that was read makes it into a bucket
+  stats.freeze()
+  for _ in range(500):
+    if stats.has_stats:
+      break
+    time.sleep(0.01)
+  else:
+    raise Exception("no stats")
+
+  return stats
+
+
+def get(handler, query=""):
+  """ calls the handler for an endpoint, as if it had been asked for with query """
+  bottle.request.bind({"QUERY_STRING": query})
+  return handler()
+
+
+def get_error(handler, query=""):
+  """ the status of the error returned by the handler """
+  try:
+    get(handler, query)
+  except bottle.HTTPError as ex:
+    return ex.status_code
+  raise AssertionError("no error for %s" % query)
+
+
+def test_json_paths():
+  stats = stats_server()
+
+  paths = get(stats.json_paths)
+  assert paths["SetDataRequest/load-testing"] == 20
+  assert paths["total/writes"] == 20
+  assert get(stats.json_paths, "window=1m") == paths
+  assert get(stats.json_paths, "depth=1") == paths
+
+  assert get_error(stats.json_paths, "window=tacos") == 400
+  assert get_error(stats.json_paths, "window=-1s") == 400
+  assert get_error(stats.json_paths, "depth=tacos") == 400
+  assert get_error(stats.json_paths, "depth=-1") == 400
+  assert get_error(stats.json_paths, "depth=2") == 400  # needs any_depth
+
+  assert get(stats.json_ips, "window=10s")["per_ip/total/writes"] == 20
+  assert get(stats.json_auths, "window=10s")["per_auth/ConnectRequest:noauth"] == 6
+
+
+def test_json_paths_any_depth():
+  stats = stats_server(any_depth=True)
+
+  assert get(stats.json_paths)["SetDataRequest/load-testing"] == 20
+  paths = get(stats.json_paths, "depth=2")
+  assert paths["SetDataRequest/load-testing/0"] == 4
+  assert paths["total/writes"] == 20
+  assert get(stats.json_paths, "depth=5") == paths
+
+
+def test_json_path():
+  assert get_error(stats_server().json_path, "p=/load-testing") == 404
+
+  stats = stats_server(path_counts_width=1024)
+  assert get(stats.json_path, "p=/load-testing/0") == {"SetDataRequest/load-testing/0": 4}
+  assert get(stats.json_path, "p=/load-testing/0&window=10s")["SetDataRequest/load-testing/0"] == 4
+  assert get(stats.json_path, "p=/never/seen") == {}
+
+  assert get_error(stats.json_path) == 400
+  assert get_error(stats.json_path, "p=load-testing") == 400
+  assert get_error(stats.json_path, "p=/load-testing&window=tacos") == 400
+
+
+def test_json_latencies():
+  assert get_error(stats_server().json_latencies) == 404
+
+  stats = stats_server("connect_replies", latencies=True)
+  latencies = get(stats.json_latencies)
+  assert set(latencies) == set(["ops", "paths"])
+  connects = latencies["ops"]["ConnectRequest"]
+  assert connects["count"] == 3
+  assert 0 < connects["p50"] <= connects["p99"]
+  assert latencies["paths"]["/"]["count"] == 3
+  assert get(stats.json_latencies, "window=1m") == latencies
+  assert get_error(stats.json_latencies, "window=tacos") == 400
+
+
+def test_json_learners():
+  assert get_error(stats_server().json_learners) == 404
+
+  stats = stats_server(zab_port=2781)
+  learners = get(stats.json_learners)
+  assert learners["leader"]["zxid"] == 0x100000002
+  assert sorted(learners["syncs"]) == ["diff", "snap"]
+  for learner in learners["learners"].values():
+    assert learner["lag"] == 0
+  assert get(stats.json_learners, "window=1m") == learners
+  assert get_error(stats.json_learners, "window=tacos") == 400
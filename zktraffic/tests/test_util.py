@@ -17,10 +17,52 @@
 
 import struct
 
-from zktraffic.base.util import read_string
+from zktraffic.base.util import parent_path, parse_duration, PathCache, read_string
 
 
 def test_bad_unicode():
     bad = b'0\xf5'
     data = struct.Struct('!i').pack(len(bad)) + bad
     assert read_string(data, 0)[0] == "unreadable"
+
+
+def test_read_string_from_buffers():
+    data = struct.Struct('!i').pack(5) + b'/path' + b'trailing'
+    for buf in (data, bytearray(data), memoryview(data)):
+        assert read_string(buf, 0) == ("/path", 9)
+
+
+def test_parse_duration():
+    assert parse_duration("10") == 10
+    assert parse_duration("10s") == 10
+    assert parse_duration("5m") == 300
+    assert parse_duration("1h") == 3600
+
+    for bad in ("", "m", "0", "-1s", "5d"):
+        try:
+            parse_duration(bad)
+            assert False, "%s should be a bad duration" % bad
+        except ValueError:
+            pass
+
+
+def test_path_cache():
+    cache = PathCache(max_size=2)
+
+    assert cache.key("/a/b/c", 2) == parent_path("/a/b/c", 2) == "/a/b"
+    assert cache.key("/a/b/c", 2, "10.0.0.1") == "/a/b:10.0.0.1"
+    assert cache.key("/a/b/c") == "/a/b/c"
+    assert cache.key("", 2) == ""
+    assert (cache.hits, cache.misses) == (0, 4)
+
+    # /a/b/c at depth 2 is in the old generation, so it's moved back
+    assert cache.key("/a/b/c", 2) == "/a/b"
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert len(cache) <= 4
+
+    # the least recently used ones are gone
+    cache.key("/x", 1)
+    cache.key("/y", 1)
+    cache.key("/a/b/c", 2, "10.0.0.1")
+    assert cache.misses == 7
+
@@ -0,0 +1,116 @@
+# ==================================================================================================
+# Copyright 2014 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+from threading import Thread
+
+from six.moves.queue import Queue
+
+from zktraffic.base.capture import TPACKET
+from zktraffic.base.sniffer import SnifferConfig
+from zktraffic.stats.accumulators import (
+  merge_stats,
+  PerPathStatsAccumulator,
+  PerPathTrieStatsAccumulator,
+)
+from zktraffic.stats.workers import StatsWorkerPool, WorkerStatsLoader
+
+
+def test_merge_stats():
+  merged = merge_stats([
+    {"writes": {"/a": 1, "/b": 2}},
+    {"writes": {"/a": 3}, "reads": {"/c": 4}},
+  ])
+
+  assert merged["writes"]["/a"] == 4
+  assert merged["writes"]["/b"] == 2
+  assert merged["reads"]["/c"] == 4
+
+
+def test_worker_ships_snapshots():
+  results = Queue()
+  loader = WorkerStatsLoader(7, results)
+  accumulator = PerPathStatsAccumulator(aggregation_depth=0)
+  accumulator._cur_stats["writes"]["/a"] = 3
+  loader.register_accumulator("per_path", accumulator)
+
+  loader._accumulate_stats()
+
+  worker_id, snapshots, auth_by_client = results.get_nowait()
+  assert worker_id == 7
+  assert snapshots["per_path"]["writes"]["/a"] == 3
+  assert auth_by_client == {}
+
+
+def test_pool_merges_workers():
+  config = SnifferConfig()
+  config.capture_backend = TPACKET
+  pool = StatsWorkerPool(2, config, dict)
+
+  assert len(pool.workers) == 2
+  assert pool.workers[0]._config.fanout_group is not None
+  assert config.fanout_group is None  # the caller's config is left alone
+
+  pool._snapshots[0].append({"per_path": {"writes": {"/a": 1, "/b": 5}}})
+  pool._snapshots[1].append({"per_path": {"writes": {"/a": 2, "/c": 1}}})
+
+  assert pool.stats("per_path", 2) == {"writes": {"/a": 3, "/b": 5}}
+
+
+def test_pool_windows():
+  config = SnifferConfig()
+  config.capture_backend = TPACKET
+  pool = StatsWorkerPool(2, config, dict, bucket_secs=1, window_buckets=3)
+
+  for i in range(5):
+    pool._snapshots[0].append({"per_path": {"writes": {"/a": 1}}})
+    pool._snapshots[1].append({"per_path": {"writes": {"/a": 10}}})
+
+  assert pool.stats("per_path", 10, 1) == {"writes": {"/a": 11}}
+  assert pool.stats("per_path", 10, 2) == {"writes": {"/a": 22}}
+  assert pool.stats("per_path", 10) == {"writes": {"/a": 33}}
+  assert pool.stats("per_path", 10, 60) == {"writes": {"/a": 33}}
+
+
+def test_pool_freeze():
+  config = SnifferConfig()
+  config.capture_backend = TPACKET
+  pool = StatsWorkerPool(2, config, dict)
+  collector = Thread(target=pool.run)
+  collector.daemon = True
+  collector.start()
+
+  # what the workers ship once they are told to freeze
+  pool._results.put((0, {"per_path": {"writes": {"/a": 1}}}, {}))
+  pool._results.put((0, None, None))
+  pool._results.put((1, {"per_path": {"writes": {"/a": 2}}}, {}))
+  pool._results.put((1, None, None))
+  pool.freeze(timeout=10)
+
+  assert pool.stats("per_path", 10) == {"writes": {"/a": 3}}
+
+
+def test_pool_depths():
+  config = SnifferConfig()
+  config.capture_backend = TPACKET
+  factory = lambda: {"per_path": PerPathTrieStatsAccumulator(aggregation_depth=1)}
+  pool = StatsWorkerPool(2, config, factory)
+
+  pool._snapshots[0].append({"per_path": {"writes": {"/a/b": 1, "/c": 5}}})
+  pool._snapshots[1].append({"per_path": {"writes": {"/a/d": 2}}})
+
+  assert pool.stats("per_path", 10) == {"writes": {"/a": 3, "/c": 5}}
+  assert pool.stats("per_path", 10, depth=2) == {"writes": {"/a/b": 1, "/a/d": 2, "/c": 5}}
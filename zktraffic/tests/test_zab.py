@@ -16,7 +16,11 @@
 
 import unittest
 
-from zktraffic.base.network import BadPacket
+import dpkt
+
+from zktraffic.base.capture import RawPacket
+from zktraffic.base.network import BadPacket, PacketContext
+from zktraffic.base.pcap import PcapReader
 from zktraffic.base.zookeeper import OpCodes
 from zktraffic.network.sniffer import Sniffer
 from zktraffic.zab.quorum_packet import (
@@ -40,6 +44,17 @@ from .common import get_full_path
 LEADER_PORT = 20022
 
 
+def with_payload(packet, payload):
+  """ the same packet, carrying payload instead """
+  eth = dpkt.ethernet.Ethernet(packet.load)
+  ip_p = eth.data
+  ip_p.len += len(payload) - len(ip_p.data.data)
+  ip_p.sum = 0
+  ip_p.data.data = payload
+  ip_p.data.sum = 0
+  return RawPacket(bytes(eth), packet.time)
+
+
 def run_sniffer(handler, pcapfile, port=LEADER_PORT):
   sniffer = Sniffer(
     iface=None,
@@ -201,3 +216,47 @@ class ZabTestCase(unittest.TestCase):
 
     assert len(snaps) == 1
     assert snaps[0].zxid_literal == "0x100000000"
+
+  def test_frame_length(self):
+    proposal = b''.join((
+      b'\x00\x00\x00\x02',                  # type
+      b'\x00\x00\x00\x01\x00\x00\x00\x02',  # zxid
+      b'\x00\x00\x00\x03abc',               # data
+      b'\x00\x00\x00\x01',                  # authinfo: one Id
+      b'\x00\x00\x00\x02ip',                # scheme
+      b'\x00\x00\x00\x01x',                 # id
+    ))
+    ack = b'\x00\x00\x00\x03' + b'\x00' * 8 + b'\xff\xff\xff\xff' + b'\x00' * 4
+    buf = proposal + ack
+
+    assert QuorumPacket.frame_length(buf, 0, len(buf)) == len(proposal)
+    assert QuorumPacket.frame_length(buf, len(proposal), len(buf)) == len(ack)
+    assert QuorumPacket.frame_length(buf, 0, 10) is None
+    assert QuorumPacket.frame_length(buf, 0, 20) < len(proposal)  # only a lower bound
+    assert QuorumPacket.frame_length(b'\x00\x00\x00\x63' + b'\x00' * 12, 0, 16) == -1
+
+  def test_coalesced_segments(self):
+    """ one segment carrying several QuorumPackets yields all of them """
+    def run(packets):
+      messages = []
+      sniffer = Sniffer(None, LEADER_PORT, QuorumPacket, messages.append, False, start=False)
+      for packet in packets:
+        sniffer.handle_packet(packet)
+      return [(type(m), m.zxid) for m in messages]
+
+    to_follower = []
+    for packet in PcapReader(get_full_path("zab_request")):
+      ctx = PacketContext(packet)
+      if ctx.tcp.sport == LEADER_PORT and ctx.tcp.dport == 38382 and ctx.data:
+        to_follower.append((packet, ctx.data))
+
+    # Nagle (or a busy leader) would send a proposal & its commit along with pings
+    coalesced = []
+    for i in range(0, len(to_follower), 3):
+      group = to_follower[i:i + 3]
+      coalesced.append(with_payload(group[0][0], b''.join(data for _, data in group)))
+
+    expected = run(packet for packet, _ in to_follower)
+    assert len(coalesced) < len(expected)
+    assert Proposal in [cls for cls, _ in expected]
+    assert run(coalesced) == expected
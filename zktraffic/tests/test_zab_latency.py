@@ -0,0 +1,105 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+from six import StringIO
+
+from zktraffic.zab.latency import ProposalTracker
+from zktraffic.zab.quorum_packet import Ack, Commit, PacketType, Proposal
+
+from .test_zab import run_sniffer
+
+
+LEADER = "10.0.0.1:2888"
+FOLLOWERS = ["10.0.0.2:40000", "10.0.0.3:40000", "10.0.0.4:40000", "10.0.0.5:40000"]
+
+
+def proposal(timestamp, follower, zxid):
+  return Proposal(timestamp, LEADER, follower, PacketType.PROPOSAL, zxid, 0, 0, 0, zxid, 0, 1)
+
+
+def ack(timestamp, follower, zxid):
+  return Ack(timestamp, follower, LEADER, PacketType.ACK, zxid, 0)
+
+
+def commit(timestamp, follower, zxid):
+  return Commit(timestamp, LEADER, follower, PacketType.COMMIT, zxid, 0)
+
+
+def test_quorum_and_commit():
+  committed = []
+  tracker = ProposalTracker(on_commit=committed.append)
+
+  # 5 voters: the leader + 2 acks make a quorum
+  for follower in FOLLOWERS:
+    tracker.handle(proposal(10.0, follower, 1))
+  tracker.handle(ack(10.1, FOLLOWERS[0], 1))
+  tracker.handle(ack(10.3, FOLLOWERS[1], 1))
+  tracker.handle(ack(10.3, FOLLOWERS[1], 1))  # dup
+  for follower in FOLLOWERS:
+    tracker.handle(commit(10.4, follower, 1))
+
+  assert len(committed) == 1
+  latency = committed[0]
+  assert latency.zxid == 1
+  assert abs(latency.quorum - 0.3) < 1e-9
+  assert abs(latency.commit - 0.4) < 1e-9
+  assert latency.acks == 2
+  assert tracker.committed == committed
+
+  # late acks count towards their follower's latency, then the proposal is done
+  assert tracker.inflight == 1
+  tracker.handle(ack(11.0, FOLLOWERS[2], 1))
+  tracker.handle(ack(12.0, FOLLOWERS[3], 1))
+  assert tracker.inflight == 0
+
+  latencies = tracker.ack_latencies
+  assert sorted(latencies) == sorted(FOLLOWERS)
+  assert abs(latencies[FOLLOWERS[3]].max - 2.0) < 1e-9
+  assert latencies[FOLLOWERS[1]].count == 1
+  assert tracker.commit_latencies.count == 1
+
+
+def test_bounded():
+  tracker = ProposalTracker(max_inflight=10, max_committed=5)
+  for zxid in range(100):
+    tracker.handle(proposal(zxid, FOLLOWERS[0], zxid))
+  assert tracker.inflight == 10
+
+  for zxid in range(90, 100):
+    tracker.handle(commit(zxid + 0.5, FOLLOWERS[0], zxid))
+  assert [latency.zxid for latency in tracker.committed] == list(range(95, 100))
+
+  # unknown (or evicted) zxids are ignored
+  tracker.handle(ack(200, FOLLOWERS[0], 1))
+  tracker.handle(commit(200, FOLLOWERS[0], 1))
+  assert tracker.commit_latencies.count == 10
+
+
+def test_from_pcap():
+  tracker = ProposalTracker()
+  run_sniffer(tracker.handle, "zab_request")
+
+  assert [latency.zxid for latency in tracker.committed] == [
+    0x100000001, 0x100000002, 0x100000003]
+  assert len(tracker.ack_latencies) == 2
+  for latency in tracker.committed:
+    assert 0 < latency.quorum <= latency.commit
+
+  output = StringIO()
+  tracker.report(output)
+  lines = output.getvalue().splitlines()
+  assert len(lines) == 2 + 2 + 2  # headers, followers, quorum & commit
+  assert lines[-1].startswith("commit")
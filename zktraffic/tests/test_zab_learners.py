@@ -0,0 +1,137 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+from six import StringIO
+
+from zktraffic.zab.learners import LearnerMonitor, zxid_lag
+from zktraffic.zab.quorum_packet import (
+  Ack,
+  Diff,
+  FollowerInfo,
+  ObserverInfo,
+  PacketType,
+  Proposal,
+  Snap,
+  UpToDate,
+)
+
+from .test_zab import run_sniffer
+
+
+LEADER = "10.0.0.1:2888"
+EPOCH = 5 << 32
+
+
+def follower_info(timestamp, learner, sid, zxid, cls=FollowerInfo):
+  return cls(timestamp, learner, LEADER, cls.PTYPE, zxid, 0, sid, 0x10000, 0)
+
+
+def sync(cls, timestamp, learner, zxid):
+  return cls(timestamp, LEADER, learner, cls.PTYPE, zxid, 0)
+
+
+def uptodate(timestamp, learner):
+  return UpToDate(timestamp, LEADER, learner, PacketType.UPTODATE, -1, 0)
+
+
+def proposal(timestamp, learner, zxid):
+  return Proposal(timestamp, LEADER, learner, PacketType.PROPOSAL, zxid, 0, 0, 0, zxid, 0, 1)
+
+
+def ack(timestamp, learner, zxid):
+  return Ack(timestamp, learner, LEADER, PacketType.ACK, zxid, 0)
+
+
+def test_zxid_lag():
+  assert zxid_lag(EPOCH + 10, EPOCH + 4) == 6
+  assert zxid_lag(EPOCH + 10, EPOCH + 12) == 0
+  assert zxid_lag(EPOCH + 10, 4) is None
+  assert zxid_lag(None, EPOCH) is None
+
+
+def test_syncs_and_lag():
+  syncs = []
+  monitor = LearnerMonitor(window_buckets=2, on_sync=syncs.append)
+
+  monitor.handle(follower_info(1.0, "10.0.0.2:4000", 2, EPOCH + 1))
+  monitor.handle(sync(Diff, 1.1, "10.0.0.2:4000", EPOCH + 3))
+  monitor.handle(follower_info(1.0, "10.0.0.3:4000", 3, 0))
+  monitor.handle(sync(Snap, 1.2, "10.0.0.3:4000", EPOCH + 3))
+  monitor.handle(follower_info(1.5, "10.0.0.4:4000", 4, EPOCH, ObserverInfo))
+
+  stats = monitor.stats()
+  assert stats["learners"]["10.0.0.3:4000"]["syncing"]
+  assert stats["syncs"] == {}
+
+  monitor.handle(uptodate(1.5, "10.0.0.2:4000"))
+  monitor.handle(uptodate(11.0, "10.0.0.3:4000"))
+  monitor.handle(uptodate(12.0, "10.0.0.5:4000"))  # never saw its FollowerInfo
+  assert [(s.learner, s.sid, s.mode, s.zxid) for s in syncs] == [
+    ("10.0.0.2:4000", 2, "diff", EPOCH + 3), ("10.0.0.3:4000", 3, "snap", EPOCH + 3)]
+  assert abs(syncs[1].secs - 10.0) < 1e-9
+
+  for zxid in range(EPOCH + 4, EPOCH + 11):
+    monitor.handle(proposal(12.0, "10.0.0.2:4000", zxid))
+  monitor.handle(ack(12.1, "10.0.0.2:4000", EPOCH + 10))
+  monitor.handle(ack(12.1, "10.0.0.3:4000", EPOCH + 6))
+  monitor.handle(ack(12.2, "10.0.0.3:4000", EPOCH + 5))  # out of order
+
+  stats = monitor.stats()
+  assert stats["leader"]["zxid"] == EPOCH + 10
+  learners = stats["learners"]
+  assert learners["10.0.0.2:4000"]["lag"] == 0
+  assert learners["10.0.0.3:4000"]["lag"] == 4
+  assert learners["10.0.0.3:4000"]["sync"] == "snap"
+  assert not learners["10.0.0.3:4000"]["syncing"]
+  assert learners["10.0.0.4:4000"]["type"] == "observer"
+  assert learners["10.0.0.4:4000"]["syncing"]
+  assert learners["10.0.0.4:4000"]["lag"] is None  # observers don't ack
+
+  # sync stats are windowed, over completed buckets only
+  assert stats["syncs"] == {}
+  monitor.accumulate_stats()
+  stats = monitor.stats()
+  assert stats["syncs"]["snap"]["count"] == 1
+  assert stats["syncs"]["diff"]["count"] == 1
+  assert monitor.stats(buckets=1)["syncs"]["snap"]["count"] == 1
+  assert monitor.stats(buckets=0)["syncs"] == {}
+  monitor.accumulate_stats()
+  monitor.accumulate_stats()
+  assert monitor.stats()["syncs"] == {}
+  assert len(monitor.stats()["learners"]) == 3
+
+
+def test_reconnect():
+  monitor = LearnerMonitor()
+  monitor.handle(follower_info(1.0, "10.0.0.2:4000", 2, EPOCH))
+  monitor.handle(follower_info(2.0, "10.0.0.2:4001", 2, EPOCH))
+  assert [learner.addr for learner in monitor.learners] == ["10.0.0.2:4001"]
+
+
+def test_from_pcap():
+  syncs = []
+  monitor = LearnerMonitor(on_sync=syncs.append)
+  run_sniffer(monitor.handle, "omni", port=2781)
+
+  assert sorted((s.sid, s.mode) for s in syncs) == [(1, "diff"), (3, "snap")]
+  stats = monitor.stats()
+  assert stats["leader"]["zxid"] == 0x100000002
+  for learner in stats["learners"].values():
+    assert learner["lag"] == 0
+
+  output = StringIO()
+  monitor.report(output)
+  assert "snap" in output.getvalue()
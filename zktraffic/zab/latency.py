@@ -0,0 +1,195 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+'''
+Proposal -> ack -> commit latencies, from the leader's ZAB traffic.
+
+The leader sends a Proposal for each txn to every follower, each follower acks it and once
+a quorum has acked it (the leader's own ack isn't on the wire) the leader sends a Commit.
+'''
+
+from collections import defaultdict, deque, OrderedDict
+from threading import Lock
+
+import sys
+
+from tabulate import tabulate
+
+from zktraffic.stats.histogram import LogHistogram
+
+from .quorum_packet import Ack, Commit, CommitAndActivate, Proposal
+
+
+class ZxidLatency(object):
+  """ how long a txn took to be acked by a quorum and to be committed, since it was proposed """
+
+  __slots__ = ("zxid", "proposed", "quorum", "commit", "acks")
+
+  def __init__(self, zxid, proposed, quorum, commit, acks):
+    self.zxid = zxid
+    self.proposed = proposed
+    self.quorum = quorum
+    self.commit = commit
+    self.acks = acks
+
+  def __str__(self):
+    return "zxid=0x%x quorum=%.6f commit=%.6f acks=%d" % (
+      self.zxid, self.quorum, self.commit, self.acks)
+
+
+class InFlight(object):
+  """ a proposal that hasn't been committed (or acked by every follower) yet """
+
+  __slots__ = ("zxid", "proposed", "sent", "acks", "quorum", "committed")
+
+  def __init__(self, zxid, proposed):
+    self.zxid = zxid
+    self.proposed = proposed
+    self.sent = {}  # follower -> when it was sent the proposal
+    self.acks = {}  # follower -> when it acked
+    self.quorum = None
+    self.committed = None
+
+  @property
+  def needed_acks(self):
+    """ acks (from followers) for a quorum, the leader's own ack isn't on the wire """
+    voters = len(self.sent) + 1
+    return voters // 2
+
+  @property
+  def done(self):
+    return self.committed is not None and len(self.acks) >= len(self.sent)
+
+
+class ProposalTracker(object):
+  """
+  Indexes in-flight proposals by zxid and keeps fixed memory histograms (see LogHistogram)
+  of each follower's ack latency and of the leader's quorum & commit latencies.
+
+  At most max_inflight proposals are tracked (the oldest ones are dropped) and the latencies
+  of the last max_committed zxids are kept. on_commit, if given, is called with the
+  ZxidLatency of every committed zxid.
+  """
+
+  def __init__(self, max_inflight=10000, max_committed=1000, accuracy=0.01, on_commit=None):
+    self._lock = Lock()
+    self._max_inflight = max_inflight
+    self._inflight = OrderedDict()  # zxid -> InFlight
+    self._committed = deque(maxlen=max_committed)
+    self._on_commit = on_commit
+    self._ack_latencies = defaultdict(lambda: LogHistogram(accuracy))  # follower -> latencies
+    self._quorum_latencies = LogHistogram(accuracy)
+    self._commit_latencies = LogHistogram(accuracy)
+
+  @property
+  def inflight(self):
+    return len(self._inflight)
+
+  @property
+  def committed(self):
+    """ the latencies of the last max_committed zxids """
+    with self._lock:
+      return list(self._committed)
+
+  @property
+  def ack_latencies(self):
+    with self._lock:
+      return dict(self._ack_latencies)
+
+  @property
+  def quorum_latencies(self):
+    return self._quorum_latencies
+
+  @property
+  def commit_latencies(self):
+    return self._commit_latencies
+
+  def handle(self, message):
+    """ a QuorumPacket handler, anything but proposals, acks & commits is ignored """
+    # Inform & InformAndActivate subclass Proposal, but they go to observers (which don't ack)
+    mtype = type(message)
+    if mtype is Proposal:
+      self._handle_proposal(message)
+    elif mtype is Ack:
+      self._handle_ack(message)
+    elif mtype is Commit or mtype is CommitAndActivate:
+      self._handle_commit(message)
+
+  def _handle_proposal(self, proposal):
+    with self._lock:
+      inflight = self._inflight.get(proposal.zxid)
+      if inflight is None:
+        inflight = self._inflight[proposal.zxid] = InFlight(proposal.zxid, proposal.timestamp)
+        if len(self._inflight) > self._max_inflight:
+          self._inflight.popitem(last=False)
+
+      if proposal.dst not in inflight.sent:
+        inflight.sent[proposal.dst] = proposal.timestamp
+
+  def _handle_ack(self, ack):
+    with self._lock:
+      inflight = self._inflight.get(ack.zxid)
+      if inflight is None or ack.src in inflight.acks:
+        return
+
+      inflight.acks[ack.src] = ack.timestamp
+      sent = inflight.sent.get(ack.src, inflight.proposed)
+      self._ack_latencies[ack.src].add(ack.timestamp - sent)
+
+      if inflight.quorum is None and len(inflight.acks) >= inflight.needed_acks:
+        inflight.quorum = ack.timestamp
+
+      if inflight.done:
+        del self._inflight[ack.zxid]
+
+  def _handle_commit(self, commit):
+    with self._lock:
+      inflight = self._inflight.get(commit.zxid)
+      if inflight is None or inflight.committed is not None:
+        return  # a commit for another follower
+
+      inflight.committed = commit.timestamp
+      quorum = (inflight.quorum or commit.timestamp) - inflight.proposed
+      latency = ZxidLatency(
+        inflight.zxid, inflight.proposed, quorum, commit.timestamp - inflight.proposed,
+        len(inflight.acks))
+      self._quorum_latencies.add(latency.quorum)
+      self._commit_latencies.add(latency.commit)
+      self._committed.append(latency)
+
+      # late acks still count towards their follower's latencies
+      if inflight.done:
+        del self._inflight[commit.zxid]
+
+    if self._on_commit:
+      self._on_commit(latency)
+
+  def report(self, output=sys.stdout):
+    """ writes a table with the ack latencies per follower & the quorum/commit latencies """
+    rows = []
+    for name, latencies in sorted(self.ack_latencies.items()):
+      rows.append(self._row("ack %s" % name, latencies))
+    rows.append(self._row("quorum", self._quorum_latencies))
+    rows.append(self._row("commit", self._commit_latencies))
+
+    headers = ["latency", "count", "avg", "p50", "p95", "p99"]
+    output.write("%s\n" % tabulate(rows, headers=headers))
+    output.flush()
+
+  @staticmethod
+  def _row(name, latencies):
+    return tuple([name, latencies.count, latencies.avg] + latencies.quantiles((0.5, 0.95, 0.99)))
@@ -0,0 +1,258 @@
+# ==================================================================================================
+# Copyright 2015 Twitter, Inc.
+# --------------------------------------------------------------------------------------------------
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this work except in compliance with the License.
+# You may obtain a copy of the License in the LICENSE file, or at:
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==================================================================================================
+
+
+'''
+Learner lag & syncs, from the leader's ZAB traffic.
+
+A learner connects with FollowerInfo (or ObserverInfo), the leader syncs it with a DIFF,
+TRUNC or SNAP and tells it it's done with UPTODATE. From then on followers ack proposals,
+so their lag is how far their last ack is behind the leader's last proposal. Observers
+don't ack, so they have no lag.
+'''
+
+from collections import deque
+from threading import Lock
+
+import sys
+
+from tabulate import tabulate
+
+from zktraffic.stats.accumulators import latency_stats
+from zktraffic.stats.histogram import LogHistogram
+
+from .quorum_packet import (
+  Ack,
+  Diff,
+  FollowerInfo,
+  ObserverInfo,
+  Proposal,
+  Snap,
+  Trunc,
+  UpToDate,
+)
+
+
+SYNC_MODES = {Diff: "diff", Trunc: "trunc", Snap: "snap"}
+
+
+def zxid_lag(leader_zxid, zxid):
+  """ how many txns zxid is behind leader_zxid, None if they are from different epochs """
+  if leader_zxid is None or zxid is None or leader_zxid >> 32 != zxid >> 32:
+    return None
+  return max(0, leader_zxid - zxid)
+
+
+class Learner(object):
+  """ what we know about a learner's connection to the leader """
+
+  __slots__ = ("addr", "sid", "observer", "acked_zxid", "sync_mode", "sync_zxid",
+               "sync_started", "sync_secs")
+
+  def __init__(self, addr, sid=None, observer=False):
+    self.addr = addr
+    self.sid = sid
+    self.observer = observer
+    self.acked_zxid = None
+    self.sync_mode = None
+    self.sync_zxid = None  # the zxid of the DIFF, TRUNC or SNAP
+    self.sync_started = None  # while syncing, when FollowerInfo was sent
+    self.sync_secs = None  # how long the last sync took
+
+  @property
+  def syncing(self):
+    return self.sync_started is not None
+
+
+class Sync(object):
+  """ a learner's sync, from FollowerInfo to UpToDate """
+
+  __slots__ = ("learner", "sid", "mode", "zxid", "secs")
+
+  def __init__(self, learner, sid, mode, zxid, secs):
+    self.learner = learner
+    self.sid = sid
+    self.mode = mode
+    self.zxid = zxid
+    self.secs = secs
+
+  def __str__(self):
+    zxid = "0x%x" % self.zxid if self.zxid is not None else None
+    return "learner=%s sid=%s sync=%s zxid=%s secs=%.6f" % (
+      self.learner, self.sid, self.mode, zxid, self.secs)
+
+
+class LearnerMonitor(object):
+  """
+  Tracks each learner's last acked zxid against the leader's last proposed zxid and times
+  their syncs, per mode, in fixed memory histograms (see LogHistogram).
+
+  It's a QuorumPacket handler (see handle) and also quacks like a stats accumulator: sync
+  stats are kept in window_buckets buckets, moved along by accumulate_stats(). Learners
+  are keyed by their connection's address; when a server reconnects (same sid) its old
+  connection is forgotten. on_sync, if given, is called with every completed Sync.
+  """
+
+  def __init__(self, window_buckets=1, accuracy=0.01, on_sync=None):
+    self._lock = Lock()
+    self._accuracy = accuracy
+    self._on_sync = on_sync
+    self._leader_zxid = None
+    self._learners = {}  # addr -> Learner
+    self._buckets = deque(maxlen=window_buckets)  # sync mode -> LogHistogram, newest last
+    self.init_cur_stats()
+
+  def init_cur_stats(self):
+    self._cur_stats = {}
+
+  @property
+  def leader_zxid(self):
+    return self._leader_zxid
+
+  @property
+  def learners(self):
+    with self._lock:
+      return list(self._learners.values())
+
+  def handle(self, message):
+    """ a QuorumPacket handler """
+    mtype = type(message)
+    sync = None
+    with self._lock:
+      if mtype is Proposal:
+        if self._leader_zxid is None or message.zxid > self._leader_zxid:
+          self._leader_zxid = message.zxid
+      elif mtype is Ack:
+        learner = self._learner(message.src)
+        if learner.acked_zxid is None or message.zxid > learner.acked_zxid:
+          learner.acked_zxid = message.zxid
+      elif mtype is FollowerInfo or mtype is ObserverInfo:
+        self._handle_learner_info(message)
+      elif mtype in SYNC_MODES:
+        learner = self._learner(message.dst)
+        learner.sync_mode = SYNC_MODES[mtype]
+        learner.sync_zxid = message.zxid
+      elif mtype is UpToDate:
+        sync = self._handle_uptodate(message)
+      else:
+        return
+
+    if sync is not None and self._on_sync:
+      self._on_sync(sync)
+
+  def _learner(self, addr):
+    learner = self._learners.get(addr)
+    if learner is None:
+      learner = self._learners[addr] = Learner(addr)
+    return learner
+
+  def _handle_learner_info(self, info):
+    # a reconnect: forget the server's previous connection(s)
+    for addr, learner in list(self._learners.items()):
+      if learner.sid == info.sid and addr != info.src:
+        del self._learners[addr]
+
+    learner = self._learner(info.src)
+    learner.sid = info.sid
+    learner.observer = type(info) is ObserverInfo
+    learner.acked_zxid = info.zxid
+    learner.sync_mode = None
+    learner.sync_zxid = None
+    learner.sync_started = info.timestamp
+
+  def _handle_uptodate(self, uptodate):
+    learner = self._learners.get(uptodate.dst)
+    if learner is None or not learner.syncing:
+      return None  # we missed the start of the sync
+
+    learner.sync_secs = uptodate.timestamp - learner.sync_started
+    learner.sync_started = None
+    mode = learner.sync_mode or "unknown"
+
+    histogram = self._cur_stats.get(mode)
+    if histogram is None:
+      histogram = self._cur_stats[mode] = LogHistogram(self._accuracy)
+    histogram.add(learner.sync_secs)
+
+    return Sync(learner.addr, learner.sid, mode, learner.sync_zxid, learner.sync_secs)
+
+  def accumulate_stats(self):
+    with self._lock:
+      self._buckets.append(self._cur_stats)
+      self.init_cur_stats()
+
+  def stats(self, top=0, buckets=None, depth=None):
+    """
+    the leader's last proposed zxid, each learner's state & lag and the sync stats
+    (per mode) across the last N completed buckets. top & depth are ignored.
+    """
+    with self._lock:
+      window = list(self._buckets)
+      if buckets is not None:
+        window = window[-buckets:] if buckets > 0 else []
+      return self._stats(window)
+
+  def _stats(self, window):
+    """ stats with the sync times of the given buckets, the lock must be held """
+    histograms = {}
+    for snapshot in window:
+      for mode, histogram in snapshot.items():
+        histograms.setdefault(mode, []).append(histogram)
+
+    learners = dict((learner.addr, self._learner_stats(learner))
+                    for learner in self._learners.values())
+
+    return {
+      "leader": {"zxid": self._leader_zxid},
+      "learners": learners,
+      "syncs": dict((mode, latency_stats(LogHistogram.merged(h))) for mode, h in histograms.items()),
+    }
+
+  def _learner_stats(self, learner):
+    return {
+      "sid": learner.sid,
+      "type": "observer" if learner.observer else "follower",
+      "acked_zxid": learner.acked_zxid,
+      # observers don't ack proposals, so there's nothing to tell their lag from
+      "lag": None if learner.observer else zxid_lag(self._leader_zxid, learner.acked_zxid),
+      "syncing": learner.syncing,
+      "sync": learner.sync_mode,
+      "sync_secs": learner.sync_secs,
+    }
+
+  def report(self, output=sys.stdout):
+    """
+    writes a table with each learner's lag & last sync, and one with the sync times of
+    every bucket kept, the current one included
+    """
+    with self._lock:
+      stats = self._stats(list(self._buckets) + [self._cur_stats])
+
+    rows = []
+    for addr, learner in sorted(stats["learners"].items()):
+      acked = learner["acked_zxid"]
+      rows.append((addr, learner["sid"], learner["type"],
+                   "0x%x" % acked if acked is not None else None, learner["lag"],
+                   learner["sync"], learner["sync_secs"]))
+    headers = ["learner", "sid", "type", "acked", "lag", "sync", "sync_secs"]
+    output.write("%s\n\n" % tabulate(rows, headers=headers))
+
+    rows = []
+    for mode, sync_stats in sorted(stats["syncs"].items()):
+      rows.append((mode, sync_stats["count"], sync_stats["avg"], sync_stats["p50"],
+                   sync_stats["p99"]))
+    output.write("%s\n" % tabulate(rows, headers=["sync", "count", "avg", "p50", "p99"]))
+    output.flush()
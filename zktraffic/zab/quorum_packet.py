@@ -19,7 +19,7 @@ from datetime import datetime
 from six import string_types
 
 from zktraffic.base.network import BadPacket
-from zktraffic.base.util import read_long, read_number
+from zktraffic.base.util import INT_STRUCT, read_long, read_number
 from zktraffic.base.zookeeper import ZK_REQUEST_TYPES
 
 
@@ -125,6 +125,35 @@ class QuorumPacket(QuorumPacketBase("QuorumPacketBase", (object,), {})):
   def with_params(cls, timestamp, src, dst, ptype, zxid, data, offset):
     return cls(timestamp, src, dst, ptype, zxid, len(data))
 
+  @classmethod
+  def frame_length(cls, buf, offset, end):
+    """
+    the length of the QuorumPacket that starts at offset (see StreamReassembler): type,
+    zxid, data (a buffer) & authinfo (a vector of Ids, two strings each), there's no
+    length prefix. If there aren't enough bytes (up to end) it's as much as can be told
+    (None if nothing), -1 if it's bogus
+    """
+    pos = offset + INT_STRUCT.size * 2 + 8  # type, zxid & data's length
+    if pos > end:
+      return None
+
+    ptype, = INT_STRUCT.unpack_from(buf, offset)
+    data_len, = INT_STRUCT.unpack_from(buf, pos - INT_STRUCT.size)
+    if PacketType.invalid(ptype) or data_len < -1:
+      return -1
+
+    pos += max(data_len, 0) + INT_STRUCT.size
+    if pos <= end:
+      ids, = INT_STRUCT.unpack_from(buf, pos - INT_STRUCT.size)
+      for _ in range(max(ids, 0) * 2):  # scheme & id
+        pos += INT_STRUCT.size
+        if pos > end:
+          break
+        slen, = INT_STRUCT.unpack_from(buf, pos - INT_STRUCT.size)
+        pos += max(slen, 0)
+
+    return pos - offset
+
   @classmethod
   def from_payload(cls, data, src, dst, timestamp):
     if len(data) < cls.MIN_SIZE: